@@ -0,0 +1,234 @@
+"""Static asset pipeline and response compression.
+
+``flask assets build`` minifies the stylesheet and scripts, writes them
+under content-hashed names with precompressed ``.gz`` (and ``.br`` when the
+``brotli`` package is installed) siblings, and records the mapping in
+``manifest.json``. ``/assets/<name>`` serves the best precompressed variant
+the client accepts through ``send_file``, which lets the WSGI server use
+``sendfile``, with a far-future immutable cache lifetime since the name
+changes whenever the content does. Templates link assets with
+``{{ asset_url('main.css') }}``.
+
+JSON API responses above ``COMPRESS_MIN_SIZE`` bytes are gzipped on the fly
+when the client accepts it; cached catalog responses keep their gzip variant
+in the catalog cache so a hit is not compressed again. ``flask assets report`` prints bytes on the wire
+per asset and the homepage time to first byte.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+
+import click
+from flask import abort, current_app, request, send_file, url_for
+from flask.cli import AppGroup
+
+try:
+    import brotli
+except ImportError:  # Optional, only .gz variants are built without it
+    brotli = None
+
+ASSET_SOURCES = ('main.css', 'main.js', 'cart-handler.js')
+MANIFEST_NAME = 'manifest.json'
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+COMPRESS_MIN_SIZE = 2048
+COMPRESS_LEVEL = 6
+
+assets_cli = AppGroup('assets', help='Build and inspect static assets.')
+
+_CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+_CSS_SPACE_RE = re.compile(r'\s+')
+_CSS_PUNCTUATION_RE = re.compile(r'\s*([{};,>])\s*')
+
+
+def minify_css(source):
+    """Strip comments and redundant whitespace from a stylesheet"""
+    source = _CSS_COMMENT_RE.sub('', source)
+    source = _CSS_SPACE_RE.sub(' ', source)
+    source = _CSS_PUNCTUATION_RE.sub(r'\1', source)
+    return source.replace(';}', '}').strip()
+
+
+def minify_js(source):
+    """Conservatively shrink a script by dropping indentation, blank lines and whole-line comments
+
+    Nothing inside a line is touched, so string literals and regular
+    expressions survive unchanged.
+    """
+    lines = (line.strip() for line in source.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+
+MINIFIERS = {
+    '.css': minify_css,
+    '.js': minify_js
+}
+
+
+def _hashed_name(name, content):
+    stem, extension = os.path.splitext(name)
+    return f'{stem}.{hashlib.sha256(content).hexdigest()[:10]}{extension}'
+
+
+def build_assets(source_dir, output_dir, sources=ASSET_SOURCES):
+    """Minify, fingerprint and precompress ``sources`` into ``output_dir``
+
+    Returns the manifest mapping each logical name to its hashed file name.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = {}
+    for name in sources:
+        with open(os.path.join(source_dir, name), encoding='utf-8') as handle:
+            source = handle.read()
+        minify = MINIFIERS.get(os.path.splitext(name)[1], lambda text: text)
+        content = minify(source).encode('utf-8')
+
+        hashed = _hashed_name(name, content)
+        path = os.path.join(output_dir, hashed)
+        with open(path, 'wb') as handle:
+            handle.write(content)
+        with open(path + '.gz', 'wb') as handle:
+            handle.write(gzip.compress(content, 9, mtime=0))
+        if brotli is not None:
+            with open(path + '.br', 'wb') as handle:
+                handle.write(brotli.compress(content, quality=11))
+        manifest[name] = hashed
+
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w', encoding='utf-8') as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+    return manifest
+
+
+def _output_dir(app):
+    return app.config.get('ASSET_OUTPUT_DIR') or os.path.join(app.static_folder, 'dist')
+
+
+def _load_manifest(app):
+    try:
+        with open(os.path.join(_output_dir(app), MANIFEST_NAME), encoding='utf-8') as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+
+def asset_url(name):
+    """URL of the fingerprinted build of ``name``, or the plain static file before a build"""
+    hashed = current_app.extensions['assets'].get(name)
+    if hashed is None:
+        return url_for('static', filename=name)
+    return url_for('assets', filename=hashed)
+
+
+def serve_asset(filename):
+    """Serve a built asset, preferring a precompressed variant the client accepts"""
+    if filename not in current_app.extensions['assets_files']:
+        abort(404)
+
+    path = os.path.join(_output_dir(current_app), filename)
+    accepted = request.accept_encodings
+    encoding = None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted[candidate] and os.path.exists(path + suffix):
+            encoding, path = candidate, path + suffix
+            break
+
+    response = send_file(path, mimetype=_mimetype(filename), conditional=True, max_age=IMMUTABLE_MAX_AGE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.immutable = True
+    response.cache_control.public = True
+    return response
+
+
+def _mimetype(filename):
+    return 'text/css' if filename.endswith('.css') else 'application/javascript'
+
+
+def wants_gzip(body):
+    """Whether ``body`` is large enough to compress and the client accepts gzip"""
+    return (bool(request.accept_encodings['gzip'])
+            and len(body) >= current_app.config.get('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE))
+
+
+def gzip_body(body):
+    return gzip.compress(body, COMPRESS_LEVEL)
+
+
+def set_gzip_body(response, compressed):
+    """Send ``compressed``, the gzipped body of ``response``, in its place"""
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def compress_response(response):
+    """Gzip large JSON responses for clients that accept it
+
+    Responses that already carry a ``Content-Encoding``, such as cached
+    catalog bodies whose gzip variant is cached with them, are left alone.
+    """
+    if (response.status_code != 200
+            or response.mimetype != 'application/json'
+            or response.direct_passthrough
+            or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    body = response.get_data()
+    if not wants_gzip(body):
+        return response
+    return set_gzip_body(response, gzip_body(body))
+
+
+@assets_cli.command('build')
+def build_command():
+    """Minify, fingerprint and precompress the static assets"""
+    app = current_app
+    manifest = build_assets(app.config.get('ASSET_SOURCE_DIR') or app.static_folder, _output_dir(app))
+    for name, hashed in sorted(manifest.items()):
+        click.echo(f'{name} -> {hashed}')
+
+
+@assets_cli.command('report')
+@click.option('--path', default='/', show_default=True, help='Page to time')
+def report_command(path):
+    """Print bytes on the wire per asset and time to first byte for a page"""
+    app = current_app
+    source_dir = app.config.get('ASSET_SOURCE_DIR') or app.static_folder
+    output_dir = _output_dir(app)
+    manifest = _load_manifest(app)
+
+    click.echo(f'{"asset":<20}{"raw":>10}{"minified":>10}{"gzip":>10}{"brotli":>10}')
+    for name in ASSET_SOURCES:
+        sizes = [os.path.getsize(os.path.join(source_dir, name))]
+        hashed = manifest.get(name)
+        for suffix in ('', '.gz', '.br'):
+            built = os.path.join(output_dir, hashed + suffix) if hashed else None
+            sizes.append(os.path.getsize(built) if built and os.path.exists(built) else None)
+        click.echo(f'{name:<20}' + ''.join(f'{size if size is not None else "-":>10}' for size in sizes))
+
+    client = app.test_client()
+    for encoding in ('identity', 'gzip, br'):
+        started = time.perf_counter()
+        response = client.get(path, headers={'Accept-Encoding': encoding}, buffered=False)
+        chunks = iter(response.response)
+        size = len(next(chunks, b''))
+        ttfb = (time.perf_counter() - started) * 1000
+        size += sum(len(chunk) for chunk in chunks)
+        response.close()
+        click.echo(f'{path} [{encoding}]: status {response.status_code}, {size} bytes, TTFB {ttfb:.2f} ms')
+
+
+def init_assets(app):
+    """Register the asset route, template helper, compression hook and CLI"""
+    manifest = _load_manifest(app)
+    app.extensions['assets'] = manifest
+    app.extensions['assets_files'] = frozenset(manifest.values())
+    app.add_url_rule('/assets/<path:filename>', 'assets', serve_asset)
+    app.add_template_global(asset_url)
+    app.after_request(compress_response)
+    app.cli.add_command(assets_cli)
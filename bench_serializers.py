@@ -0,0 +1,90 @@
+"""Microbenchmark for the compiled book serializer.
+
+Compares the original hand-written ``Book.to_dict`` (two ``strftime`` calls
+and a fresh dict per row) with ``BOOK_SCHEMA`` on ORM-like objects and on
+plain result tuples, and reports rows per second::
+
+    python bench_serializers.py --rows 100000
+"""
+import argparse
+import time
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+from src.models.ecommerce.book import BOOK_SCHEMA
+from src.models.ecommerce.serializers import dumps
+
+
+def legacy_to_dict(book):
+    """``Book.to_dict`` as it was before the compiled serializers"""
+    return {
+        'id': book.id,
+        'title': book.title,
+        'author': book.author,
+        'description': book.description,
+        'price': book.price,
+        'cover_image': book.cover_image,
+        'isbn': book.isbn,
+        'publication_date': book.publication_date.strftime('%Y-%m-%d') if book.publication_date else None,
+        'pages': book.pages,
+        'stock': book.stock,
+        'featured': book.featured,
+        'category': book.category,
+        'created_at': book.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'updated_at': book.updated_at.strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+
+def make_books(count):
+    started = datetime(2024, 1, 1)
+    return [SimpleNamespace(
+        id=index,
+        title=f'The Cold Case Files, Volume {index}',
+        author='A. N. Author',
+        description='A detective reopens a case nobody wanted solved. ' * 4,
+        price=14.99,
+        cover_image=f'/static/images/covers/{index}.jpg',
+        isbn=f'978{index:010d}',
+        publication_date=date(2020, 1, 1) + timedelta(days=index % 1500),
+        pages=320,
+        stock=12,
+        featured=index % 10 == 0,
+        category='Crime Thriller',
+        created_at=started + timedelta(seconds=index * 37),
+        updated_at=started + timedelta(seconds=index * 41)
+    ) for index in range(1, count + 1)]
+
+
+def measure(label, function, items, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for item in items:
+            function(item)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{label:<40} {len(items) / best:>12,.0f} rows/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    books = make_books(args.rows)
+    rows = [tuple(getattr(book, field) for field in BOOK_SCHEMA.field_names) for book in books]
+    compiled = BOOK_SCHEMA.compile()
+    from_row = BOOK_SCHEMA.row_serializer(BOOK_SCHEMA.field_names)
+
+    assert compiled(books[0]) == legacy_to_dict(books[0])
+
+    measure('legacy to_dict', legacy_to_dict, books, args.repeat)
+    measure('compiled schema', compiled, books, args.repeat)
+    measure('compiled schema, row tuples', from_row, rows, args.repeat)
+    measure('legacy to_dict + dumps', lambda book: dumps(legacy_to_dict(book)), books, args.repeat)
+    measure('compiled schema + dumps', lambda book: dumps(compiled(book)), books, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,33 @@
 from datetime import datetime
 from src.models.user import db
+from src.models.ecommerce.serializers import Field, Schema
+
+BOOK_SCHEMA = Schema('Book', [
+    Field('id'),
+    Field('title'),
+    Field('author'),
+    Field('description'),
+    Field('price'),
+    Field('cover_image'),
+    Field('isbn'),
+    Field('publication_date', 'date'),
+    Field('pages'),
+    Field('stock'),
+    Field('featured'),
+    Field('category'),
+    Field('created_at', 'datetime'),
+    Field('updated_at', 'datetime')
+])
 
 class Book(db.Model):
     """Book model for storing book details"""
     __tablename__ = 'books'
+    __table_args__ = (
+        db.Index('ix_books_category', 'category'),
+        db.Index('ix_books_created_at_id', 'created_at', 'id'),
+        db.Index('ix_books_featured', 'id', sqlite_where=db.text('featured = 1'),
+                 postgresql_where=db.text('featured')),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
@@ -35,21 +59,11 @@ class Book(db.Model):
         self.featured = featured
         self.category = category
 
-    def to_dict(self):
-        """Convert book object to dictionary"""
-        return {
-            'id': self.id,
-            'title': self.title,
-            'author': self.author,
-            'description': self.description,
-            'price': self.price,
-            'cover_image': self.cover_image,
-            'isbn': self.isbn,
-            'publication_date': self.publication_date.strftime('%Y-%m-%d') if self.publication_date else None,
-            'pages': self.pages,
-            'stock': self.stock,
-            'featured': self.featured,
-            'category': self.category,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-            'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S')
-        }
+    # Serialized fields in output order; ``to_dict(fields=...)`` only touches
+    # the attributes it is asked for, so rows loaded with ``load_only`` never
+    # trigger a lazy load of a deferred column.
+    SERIALIZABLE_FIELDS = BOOK_SCHEMA.field_names
+
+    def to_dict(self, fields=None):
+        """Convert book object to dictionary, optionally limited to ``fields``"""
+        return BOOK_SCHEMA.serialize(self, fields)
@@ -1,57 +1,349 @@
-from flask import Blueprint, jsonify, request
-from src.models.ecommerce.book import Book
+import base64
+import binascii
+import io
+import json
+import os
+import time
+from datetime import datetime
+import click
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import load_only
+from src.assets import gzip_body, set_gzip_body, wants_gzip
+from src.database import read_query, read_session
+from src.models.ecommerce.book import BOOK_SCHEMA, Book
+from src.models.ecommerce.catalog_io import (
+    DEFAULT_BATCH_SIZE, EXPORT_FORMATS, FORMATS, READERS, export_books, import_books
+)
+from src.models.ecommerce.catalog_cache import (
+    ALL_BOOKS_KEY, CATALOG_VERSION, FEATURED_KEY, book_key, cached_books, category_key, encoded_key,
+    get_catalog_cache, invalidate_book
+)
+from src.models.ecommerce.http_cache import (
+    CACHE_POLICIES, apply_validators, book_validators, is_not_modified, listing_validators, not_modified
+)
+from src.models.ecommerce.recommendations import (
+    DEFAULT_TOP_K, SETTLE_SECONDS, get_recommendation_index, recommendation_paths, update_recommendations
+)
+from src.models.ecommerce.search import get_search_index
+from src.models.ecommerce.serializers import dumps, encode
+from src.models.ecommerce.streaming import stream_json_response
 from src.models.user import db
 
 book_bp = Blueprint('book', __name__)
 
+# Keyset pagination settings for the /books listing
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+MAX_RESPONSE_BYTES = 256 * 1024  # Stop filling a page once the JSON body reaches this size
+SORT_KEYS = ('id', 'created_at')
+STREAM_BATCH_SIZE = 500  # Rows fetched per round trip for ``stream=true`` dumps
+
+
+def _pack_entry(etag, last_modified, body):
+    stamp = last_modified.isoformat() if last_modified else ''
+    return b'%s\n%s\n%s' % (etag.encode('ascii'), stamp.encode('ascii'), body)
+
+
+def _unpack_entry(entry):
+    etag, stamp, body = entry.split(b'\n', 2)
+    last_modified = datetime.fromisoformat(stamp.decode('ascii')) if stamp else None
+    return etag.decode('ascii'), last_modified, body
+
+
+def _cached_response(key, build, validators, policy='listing'):
+    """Serve the JSON body cached under ``key``, building it on a miss
+
+    Cache entries keep the ETag and Last-Modified of the body they hold, so
+    conditional requests that hit the cache are answered without touching the
+    database. On a miss ``validators`` returns the current ``(etag,
+    last_modified)`` and a matching conditional request gets its 304 before
+    ``build`` loads or serializes anything. Either callable may return
+    ``None`` when there is nothing to serve (for example a missing book).
+    """
+    cache = get_catalog_cache()
+    entry = cache.get(key)
+    if entry is not None:
+        etag, last_modified, body = _unpack_entry(entry)
+    else:
+        current = validators()
+        if current is None:
+            return None
+        etag, last_modified = current
+        if is_not_modified(etag, last_modified):
+            return not_modified(etag, last_modified, policy)
+        payload = build()
+        if payload is None:
+            return None
+        body = dumps(payload)
+        cache.set(key, _pack_entry(etag, last_modified, body))
+
+    if is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified, policy)
+    response = Response(body, status=200, mimetype='application/json')
+    if wants_gzip(body):
+        set_gzip_body(response, _cached_gzip(key, etag, body))
+    return apply_validators(response, etag, last_modified, policy)
+
+
+def _cached_gzip(key, etag, body):
+    """Return ``body`` gzipped, compressing it only once per ETag"""
+    cache = get_catalog_cache()
+    entry = cache.get(encoded_key(key, 'gzip'))
+    if entry is not None:
+        cached_etag, compressed = entry.split(b'\n', 1)
+        if cached_etag.decode('ascii') == etag:
+            return compressed
+    compressed = gzip_body(body)
+    cache.set(encoded_key(key, 'gzip'), b'%s\n%s' % (etag.encode('ascii'), compressed))
+    return compressed
+
+
+def _encode_cursor(order_by, direction, book):
+    """Build an opaque cursor pointing just after ``book`` in the listing order"""
+    value = book.created_at.isoformat() if order_by == 'created_at' else None
+    payload = json.dumps([order_by, direction, value, book.id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor, order_by, direction):
+    """Return the ``(value, id)`` position stored in ``cursor``
+
+    Raises ``ValueError`` if the cursor is malformed or was issued for a
+    different ordering.
+    """
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        key, cursor_direction, value, book_id = json.loads(base64.urlsafe_b64decode(padded))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Invalid cursor')
+
+    if key != order_by or cursor_direction != direction or not isinstance(book_id, int):
+        raise ValueError('Cursor does not match the requested ordering')
+
+    if order_by == 'created_at':
+        try:
+            value = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid cursor')
+    return value, book_id
+
+
+def _parse_fields(raw_fields):
+    """Validate a comma separated ``fields=`` projection, ``id`` is always included"""
+    fields = ['id']
+    for field in raw_fields.split(','):
+        field = field.strip()
+        if not field or field in fields:
+            continue
+        if field not in Book.SERIALIZABLE_FIELDS:
+            raise ValueError(f'Unknown field: {field}')
+        fields.append(field)
+    return fields
+
+
+def _paginate_books(query, fields, validators):
+    """Serve one keyset-paginated page of ``query``
+
+    ``validators`` returns the ETag and Last-Modified of the page, checked
+    before the page is loaded.
+    """
+    order_by = request.args.get('order_by', 'id')
+    direction = request.args.get('order', 'asc').lower()
+
+    if order_by not in SORT_KEYS or direction not in ('asc', 'desc'):
+        return jsonify({
+            'success': False,
+            'message': 'order_by must be id or created_at and order must be asc or desc'
+        }), 400
+
+    try:
+        limit = min(max(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': 'limit must be an integer'
+        }), 400
+
+    etag, last_modified = validators()
+    if is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified)
+
+    sort_column = Book.created_at if order_by == 'created_at' else Book.id
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            value, last_id = _decode_cursor(cursor, order_by, direction)
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'message': str(e)
+            }), 400
+
+        if direction == 'asc':
+            id_after = Book.id > last_id
+            after = id_after if order_by == 'id' else or_(
+                Book.created_at > value, and_(Book.created_at == value, id_after))
+        else:
+            id_after = Book.id < last_id
+            after = id_after if order_by == 'id' else or_(
+                Book.created_at < value, and_(Book.created_at == value, id_after))
+        query = query.filter(after)
+
+    if direction == 'asc':
+        ordering = [sort_column.asc(), Book.id.asc()]
+    else:
+        ordering = [sort_column.desc(), Book.id.desc()]
+    if order_by == 'id':
+        ordering = ordering[1:]
+
+    # Fetch one extra row to learn whether another page exists
+    books = query.order_by(*ordering).limit(limit + 1).all()
+    has_more = len(books) > limit
+    books = books[:limit]
+
+    serialize = BOOK_SCHEMA.compile(fields)
+    encoded = []
+    size = 0
+    for book in books:
+        row = encode(serialize, book)
+        if encoded and size + len(row) > MAX_RESPONSE_BYTES:
+            has_more = True
+            break
+        encoded.append(row)
+        size += len(row) + 1
+
+    next_cursor = None
+    if has_more and encoded:
+        next_cursor = _encode_cursor(order_by, direction, books[len(encoded) - 1])
+
+    body = b'{"success":true,"books":[%s],"next_cursor":%s}' % (
+        b','.join(encoded), dumps(next_cursor))
+    response = Response(body, status=200, mimetype='application/json')
+    return apply_validators(response, etag, last_modified)
+
+
 @book_bp.route('/books', methods=['GET'])
 def get_books():
-    """Get all books or filter by category"""
+    """Get all books or filter by category
+
+    Passing ``limit`` or ``cursor`` switches to keyset pagination ordered by
+    ``order_by`` (``id`` or ``created_at``); ``stream=true`` streams the full
+    listing as chunked JSON instead. ``fields`` restricts both the columns
+    loaded from the database and the keys returned per book.
+    """
     category = request.args.get('category')
     featured = request.args.get('featured')
     
-    query = Book.query
+    query = read_query(Book, CATALOG_VERSION)
     
     if category:
         query = query.filter_by(category=category)
     
     if featured and featured.lower() == 'true':
         query = query.filter_by(featured=True)
+
+    variant = request.query_string.decode('utf-8', 'replace')
+    fields = None
+    if request.args.get('fields'):
+        try:
+            fields = _parse_fields(request.args['fields'])
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'message': str(e)
+            }), 400
+        # Defer every column that is not needed for the response or the cursor
+        columns = set(fields) | {'created_at'}
+        query = query.options(load_only(*[getattr(Book, name) for name in columns]))
+
+    if 'limit' in request.args or 'cursor' in request.args:
+        return _paginate_books(query, fields, lambda: listing_validators(variant))
+
+    if request.args.get('stream', '').lower() == 'true':
+        books = query.order_by(Book.id).yield_per(STREAM_BATCH_SIZE)
+        return stream_json_response('books', books, BOOK_SCHEMA.compile(fields))
+
+    only_featured = bool(featured and featured.lower() == 'true')
+    if fields is None and not (category and only_featured):
+        if category:
+            key = category_key(category)
+        else:
+            key = FEATURED_KEY if only_featured else ALL_BOOKS_KEY
+        return _cached_response(key, lambda: {
+            'success': True,
+            'books': BOOK_SCHEMA.serialize_many(query)
+        }, lambda: listing_validators(key))
+    
+    etag, last_modified = listing_validators(variant)
+    if is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified)
     
     books = query.all()
-    return jsonify({
+    response = jsonify({
         'success': True,
-        'books': [book.to_dict() for book in books]
-    }), 200
+        'books': BOOK_SCHEMA.serialize_many(books, fields)
+    })
+    return apply_validators(response, etag, last_modified), 200
 
 @book_bp.route('/books/<int:book_id>', methods=['GET'])
 def get_book(book_id):
     """Get a specific book by ID"""
-    book = Book.query.get(book_id)
-    
-    if not book:
+    def build():
+        book = read_session(CATALOG_VERSION).get(Book, book_id)
+        if not book:
+            return None
+        return {
+            'success': True,
+            'book': book.to_dict()
+        }
+
+    response = _cached_response(book_key(book_id), build, lambda: book_validators(book_id), 'book')
+    if response is None:
         return jsonify({
             'success': False,
             'message': 'Book not found'
         }), 404
     
-    return jsonify({
+    return response
+
+@book_bp.route('/books/<int:book_id>/recommendations', methods=['GET'])
+def get_book_recommendations(book_id):
+    """Get the books most often bought together with a book"""
+    limit = request.args.get('limit', type=int)
+    
+    index = get_recommendation_index()
+    neighbours = index.neighbours(book_id, limit) if index else []
+    books = cached_books([neighbour.book_id for neighbour in neighbours])
+    
+    response = jsonify({
         'success': True,
-        'book': book.to_dict()
-    }), 200
+        'book_id': book_id,
+        'recommendations': [{
+            'book': books[neighbour.book_id],
+            'score': round(neighbour.score, 4),
+            'orders_together': neighbour.count
+        } for neighbour in neighbours if neighbour.book_id in books]
+    })
+    response.headers['Cache-Control'] = CACHE_POLICIES['listing']
+    return response, 200
 
 @book_bp.route('/books/featured', methods=['GET'])
 def get_featured_books():
     """Get featured books"""
-    books = Book.query.filter_by(featured=True).all()
-    return jsonify({
+    featured = read_query(Book, CATALOG_VERSION).filter_by(featured=True)
+    return _cached_response(FEATURED_KEY, lambda: {
         'success': True,
-        'books': [book.to_dict() for book in books]
-    }), 200
+        'books': BOOK_SCHEMA.serialize_many(featured)
+    }, lambda: listing_validators(FEATURED_KEY))
 
 @book_bp.route('/books/search', methods=['GET'])
 def search_books():
-    """Search books by title or author"""
+    """Search books by title, author, category or description
+
+    Every search term is matched as a prefix and results are ranked by
+    relevance; ``limit`` and ``offset`` page through them.
+    """
     query = request.args.get('q', '')
     
     if not query:
@@ -59,18 +351,52 @@ def search_books():
             'success': False,
             'message': 'Search query is required'
         }), 400
+
+    try:
+        limit = min(max(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': 'limit and offset must be integers'
+        }), 400
+
+    book_ids, total = get_search_index().search(query, limit=limit, offset=offset)
+
+    books_by_id = {}
+    if book_ids:
+        books_by_id = {book.id: book for book in read_query(Book, CATALOG_VERSION).filter(Book.id.in_(book_ids))}
     
-    books = Book.query.filter(
-        (Book.title.ilike(f'%{query}%')) | 
-        (Book.author.ilike(f'%{query}%'))
-    ).all()
-    
-    return jsonify({
+    response = jsonify({
         'success': True,
-        'books': [book.to_dict() for book in books]
-    }), 200
+        'books': [books_by_id[book_id].to_dict() for book_id in book_ids if book_id in books_by_id],
+        'total': total
+    })
+    response.headers['Cache-Control'] = CACHE_POLICIES['search']
+    return response, 200
 
 # Admin routes for book management
+def _commit_indexed(book=None, removed_id=None):
+    """Commit the session with the search entry of ``book`` refreshed, or of ``removed_id`` dropped
+
+    Database-backed indexes are written in the same transaction; the
+    in-memory index is only changed once the commit has succeeded.
+    """
+    search_index = get_search_index()
+    
+    def update_index():
+        if book is not None:
+            search_index.index_book(book)
+        else:
+            search_index.remove_book(removed_id)
+    
+    if search_index.transactional:
+        update_index()
+        db.session.commit()
+    else:
+        db.session.commit()
+        update_index()
+
 @book_bp.route('/admin/books', methods=['POST'])
 def create_book():
     """Create a new book (admin only)"""
@@ -101,7 +427,9 @@ def create_book():
     )
     
     db.session.add(book)
-    db.session.commit()
+    db.session.flush()  # Assign the id before indexing
+    _commit_indexed(book)
+    invalidate_book(categories=[book.category], featured=book.featured)
     
     return jsonify({
         'success': True,
@@ -121,6 +449,7 @@ def update_book(book_id):
         }), 404
     
     data = request.get_json()
+    previous_category, previous_featured = book.category, book.featured
     
     # Update book fields
     if 'title' in data:
@@ -146,7 +475,9 @@ def update_book(book_id):
     if 'category' in data:
         book.category = data['category']
     
-    db.session.commit()
+    _commit_indexed(book)
+    invalidate_book(book.id, categories=[previous_category, book.category],
+                    featured=previous_featured or book.featured)
     
     return jsonify({
         'success': True,
@@ -165,10 +496,109 @@ def delete_book(book_id):
             'message': 'Book not found'
         }), 404
     
+    category, featured = book.category, book.featured
     db.session.delete(book)
-    db.session.commit()
+    _commit_indexed(removed_id=book_id)
+    invalidate_book(book_id, categories=[category], featured=featured)
     
     return jsonify({
         'success': True,
         'message': 'Book deleted successfully'
     }), 200
+
+@book_bp.route('/admin/books/import', methods=['POST'])
+def import_books_route():
+    """Bulk upsert books from a CSV, JSON Lines or ONIX-like request body (admin only)"""
+    fmt = request.args.get('format', 'csv')
+    
+    if fmt not in FORMATS:
+        return jsonify({
+            'success': False,
+            'message': f'format must be one of: {", ".join(FORMATS)}'
+        }), 400
+    
+    stream = request.stream
+    if fmt != 'onix':
+        stream = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    
+    report = import_books(READERS[fmt](stream))
+    
+    return jsonify({
+        'success': True,
+        'message': 'Import finished',
+        'inserted': report.inserted,
+        'updated': report.updated,
+        'error_count': report.error_count,
+        'errors': report.errors
+    }), 200
+
+@book_bp.route('/admin/books/export', methods=['GET'])
+def export_books_route():
+    """Stream the whole catalog as CSV or JSON Lines (admin only)"""
+    fmt = request.args.get('format', 'csv')
+    
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({
+            'success': False,
+            'message': f'format must be one of: {", ".join(EXPORT_FORMATS)}'
+        }), 400
+    
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(export_books(fmt)), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=books.{fmt}'
+    })
+
+@book_bp.cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='Defaults to the file extension')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True)
+def import_command(path, fmt, batch_size):
+    """Bulk upsert books from a catalog file"""
+    if fmt is None:
+        extension = path.rsplit('.', 1)[-1].lower()
+        fmt = {'xml': 'onix', 'ndjson': 'jsonl'}.get(extension, extension)
+    if fmt not in FORMATS:
+        raise click.BadParameter(f'cannot infer format from {path}, pass --format')
+    
+    if fmt == 'onix':
+        with open(path, 'rb') as stream:
+            report = import_books(READERS[fmt](stream), batch_size=batch_size)
+    else:
+        with open(path, encoding='utf-8', newline='') as stream:
+            report = import_books(READERS[fmt](stream), batch_size=batch_size)
+    
+    click.echo(f'Inserted {report.inserted}, updated {report.updated}, {report.error_count} invalid rows')
+    for error in report.errors:
+        click.echo(f"  row {error['row']}: {error['message']}", err=True)
+
+@book_bp.cli.command('export')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(EXPORT_FORMATS), default='csv', show_default=True)
+def export_command(path, fmt):
+    """Write the whole catalog to a CSV or JSON Lines file"""
+    with open(path, 'w', encoding='utf-8', newline='') as output:
+        for chunk in export_books(fmt):
+            output.write(chunk)
+
+@book_bp.cli.command('recommendations')
+@click.option('--full', is_flag=True, help='Discard the counts and rebuild from every order')
+@click.option('--top-k', type=int, default=None, help=f'Neighbours kept per book [default: {DEFAULT_TOP_K}]')
+@click.option('--settle', default=SETTLE_SECONDS, show_default=True,
+              help='Seconds an order must be old before it is folded in')
+def recommendations_command(full, top_k, settle):
+    """Fold new orders into the co-purchase recommendations"""
+    app = current_app
+    index_path, counts_path = recommendation_paths(app)
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    
+    started = time.perf_counter()
+    report = update_recommendations(
+        index_path,
+        counts_path,
+        top_k=top_k or app.config.get('RECOMMENDATIONS_TOP_K', DEFAULT_TOP_K),
+        full=full,
+        settle=settle
+    )
+    elapsed = time.perf_counter() - started
+    click.echo(f'Folded {report.orders} orders, rebuilt {report.rows} books, '
+               f'{report.pairs} neighbours in {elapsed:.2f}s')
@@ -1,9 +1,40 @@
+import sqlite3
+from collections import namedtuple
 from datetime import datetime
+from sqlalchemy import bindparam, delete, func, insert, literal, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from src.models.user import db
+from src.models.ecommerce.book import BOOK_SCHEMA, Book
+from src.models.ecommerce.serializers import Field, Schema
+
+# Aggregate view of a cart: distinct lines, total copies and total price
+CartTotals = namedtuple('CartTotals', ['item_count', 'quantity', 'total'])
+
+# Operations accepted by ``CartItem.apply_batch``
+BATCH_OPERATIONS = ('add', 'update', 'remove')
+
+# SQLite learned INSERT ... ON CONFLICT DO UPDATE in 3.24
+SQLITE_HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+CART_ITEM_SCHEMA = Schema('CartItem', [
+    Field('id'),
+    Field('user_id'),
+    Field('book_id'),
+    Field('book', schema=BOOK_SCHEMA),
+    Field('quantity'),
+    Field('created_at', 'datetime'),
+    Field('updated_at', 'datetime')
+])
 
 class CartItem(db.Model):
     """Cart item model for storing shopping cart items"""
     __tablename__ = 'cart_items'
+    __table_args__ = (
+        # One line per book and user; also serves every lookup by user_id
+        db.Index('uq_cart_items_user_book', 'user_id', 'book_id', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, nullable=False)
@@ -20,14 +51,223 @@ class CartItem(db.Model):
         self.book_id = book_id
         self.quantity = quantity
 
+    @classmethod
+    def for_user(cls, user_id):
+        """Query a user's cart lines with their books joined in the same round trip"""
+        return cls.query.options(joinedload(cls.book)).filter_by(user_id=user_id)
+
+    @classmethod
+    def totals_for(cls, user_id):
+        """Return the ``CartTotals`` for a user's cart in a single aggregate query"""
+        item_count, quantity, total = db.session.query(
+            func.count(cls.id),
+            func.coalesce(func.sum(cls.quantity), 0),
+            func.coalesce(func.sum(Book.price * cls.quantity), 0.0)
+        ).join(Book, Book.id == cls.book_id).filter(cls.user_id == user_id).one()
+        return CartTotals(item_count, quantity, total)
+
+    @classmethod
+    def add(cls, user_id, book_id, quantity):
+        """Add ``quantity`` copies of a book to a user's cart in one statement
+
+        Runs ``INSERT ... SELECT FROM books ... ON CONFLICT (user_id, book_id)
+        DO UPDATE SET quantity = quantity + :q`` so the existence check, the
+        insert and the increment are a single atomic round trip; concurrent
+        adds of the same book can no longer create duplicate lines. Databases
+        without upsert support fall back to an update followed by an insert.
+        Returns ``False`` when the book does not exist and raises
+        ``ValueError`` for a quantity below 1. Does not commit.
+        """
+        if quantity < 1:
+            raise ValueError('quantity must be at least 1')
+        table = cls.__table__
+        now = datetime.utcnow()
+        columns = ['user_id', 'book_id', 'quantity', 'created_at', 'updated_at']
+        source = select(
+            literal(user_id), Book.id, literal(quantity), literal(now), literal(now)
+        ).where(Book.id == book_id)
+
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql' or (dialect == 'sqlite' and SQLITE_HAS_UPSERT):
+            dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            statement = dialect_insert(table).from_select(columns, source)
+            statement = statement.on_conflict_do_update(
+                index_elements=['user_id', 'book_id'],
+                set_={'quantity': table.c.quantity + statement.excluded.quantity, 'updated_at': now}
+            )
+            return db.session.execute(statement).rowcount > 0
+
+        increment = update(table).where(
+            table.c.user_id == user_id, table.c.book_id == book_id
+        ).values(quantity=table.c.quantity + quantity, updated_at=now)
+        if db.session.execute(increment).rowcount:
+            return True
+        try:
+            with db.session.begin_nested():
+                return db.session.execute(insert(table).from_select(columns, source)).rowcount > 0
+        except IntegrityError:
+            # Lost the race against a concurrent insert of the same line
+            return db.session.execute(increment).rowcount > 0
+
+    @classmethod
+    def merge(cls, user_id, lines):
+        """Add the ``{book_id: quantity}`` lines of a guest cart to a user's cart
+
+        Lines for books that no longer exist are dropped, then the rest are
+        written as one multi-row ``INSERT ... ON CONFLICT DO UPDATE`` that adds
+        to the quantities already in the cart. Databases without upsert
+        support go through ``apply_batch``. Returns the number of lines
+        merged. Does not commit.
+        """
+        lines = {book_id: quantity for book_id, quantity in lines.items() if quantity > 0}
+        if lines:
+            found = set(db.session.execute(select(Book.id).where(Book.id.in_(list(lines)))).scalars())
+            lines = {book_id: quantity for book_id, quantity in lines.items() if book_id in found}
+        if not lines:
+            return 0
+
+        dialect = db.engine.dialect.name
+        if not (dialect == 'postgresql' or (dialect == 'sqlite' and SQLITE_HAS_UPSERT)):
+            cls.apply_batch(user_id, [
+                {'op': 'add', 'book_id': book_id, 'quantity': quantity} for book_id, quantity in lines.items()
+            ])
+            return len(lines)
+
+        table = cls.__table__
+        now = datetime.utcnow()
+        dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        statement = dialect_insert(table).values([
+            {'user_id': user_id, 'book_id': book_id, 'quantity': quantity, 'created_at': now, 'updated_at': now}
+            for book_id, quantity in sorted(lines.items())
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=['user_id', 'book_id'],
+            set_={'quantity': table.c.quantity + statement.excluded.quantity, 'updated_at': now}
+        )
+        db.session.execute(statement)
+        return len(lines)
+
+    @classmethod
+    def apply_batch(cls, user_id, operations):
+        """Apply a list of add/update/remove operations to a user's cart
+
+        Each operation is a dict with ``op``, a ``book_id`` or ``cart_item_id``
+        and, for add and update, a ``quantity``. Operations are folded into
+        the final quantity per book in order, then written with at most one
+        bulk ``DELETE``, one ``UPDATE`` and one executemany of new lines.
+        New lines go through the same ``ON CONFLICT (user_id, book_id)``
+        upsert as ``add``, so a line inserted concurrently is added to (or,
+        after an update, overwritten) instead of failing the batch.
+        Raises ``ValueError`` for an invalid operation, a quantity below 1 or
+        an unknown book, before anything is written. Does not commit.
+        """
+        table = cls.__table__
+        current = {}
+        book_for_item = {}
+        rows = db.session.execute(
+            select(table.c.id, table.c.book_id, table.c.quantity)
+            .where(table.c.user_id == user_id)
+            .with_for_update()
+        )
+        for item_id, book_id, quantity in rows:
+            current[book_id] = quantity
+            book_for_item[item_id] = book_id
+
+        wanted = dict(current)
+        absolute = set()  # Books whose final quantity was set rather than added to
+        for index, operation in enumerate(operations):
+            op = operation.get('op') if isinstance(operation, dict) else None
+            if op not in BATCH_OPERATIONS:
+                raise ValueError(f'Operation {index}: op must be one of {", ".join(BATCH_OPERATIONS)}')
+
+            if 'book_id' in operation:
+                try:
+                    book_id = int(operation['book_id'])
+                except (TypeError, ValueError):
+                    raise ValueError(f'Operation {index}: book_id must be an integer')
+            else:
+                try:
+                    book_id = book_for_item[int(operation.get('cart_item_id'))]
+                except (KeyError, TypeError, ValueError):
+                    raise ValueError(f'Operation {index}: cart item not found')
+
+            if op == 'remove':
+                wanted[book_id] = 0
+                absolute.add(book_id)
+                continue
+            try:
+                quantity = int(operation['quantity'])
+            except (KeyError, TypeError, ValueError):
+                raise ValueError(f'Operation {index}: quantity must be an integer')
+            if quantity < 1:
+                raise ValueError(f'Operation {index}: quantity must be at least 1; use remove to drop a line')
+            if op == 'add':
+                wanted[book_id] = wanted.get(book_id, 0) + quantity
+            else:
+                wanted[book_id] = quantity
+                absolute.add(book_id)
+
+        new_books = [book_id for book_id, quantity in wanted.items()
+                     if quantity > 0 and book_id not in current]
+        if new_books:
+            found = set(db.session.execute(select(Book.id).where(Book.id.in_(new_books))).scalars())
+            missing = sorted(set(new_books) - found)
+            if missing:
+                raise ValueError(f'Book not found: {", ".join(map(str, missing))}')
+
+        now = datetime.utcnow()
+        removed = [book_id for book_id, quantity in wanted.items()
+                   if quantity <= 0 and book_id in current]
+        changed = [{'b_book_id': book_id, 'b_quantity': quantity}
+                   for book_id, quantity in wanted.items()
+                   if quantity > 0 and book_id in current and quantity != current[book_id]]
+
+        if removed:
+            db.session.execute(delete(table).where(
+                table.c.user_id == user_id, table.c.book_id.in_(removed)))
+        if changed:
+            db.session.execute(
+                update(table)
+                .where(table.c.user_id == user_id, table.c.book_id == bindparam('b_book_id'))
+                .values(quantity=bindparam('b_quantity'), updated_at=now),
+                changed
+            )
+        if new_books:
+            cls._insert_lines(user_id, {book_id: wanted[book_id] for book_id in new_books}, absolute, now)
+
+    @classmethod
+    def _insert_lines(cls, user_id, lines, absolute, now):
+        """Insert new cart lines, merging with any a concurrent request inserted first
+
+        Quantities of books in ``absolute`` replace a conflicting line's
+        quantity; the others are added to it.
+        """
+        table = cls.__table__
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql' or (dialect == 'sqlite' and SQLITE_HAS_UPSERT):
+            dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            for replace in (False, True):
+                rows = [{'user_id': user_id, 'book_id': book_id, 'quantity': quantity,
+                         'created_at': now, 'updated_at': now}
+                        for book_id, quantity in sorted(lines.items()) if (book_id in absolute) == replace]
+                if not rows:
+                    continue
+                statement = dialect_insert(table)
+                quantity = statement.excluded.quantity if replace else table.c.quantity + statement.excluded.quantity
+                db.session.execute(statement.on_conflict_do_update(
+                    index_elements=['user_id', 'book_id'],
+                    set_={'quantity': quantity, 'updated_at': now}
+                ), rows)
+            return
+
+        for book_id, quantity in sorted(lines.items()):
+            if book_id in absolute and db.session.execute(
+                update(table).where(table.c.user_id == user_id, table.c.book_id == book_id)
+                .values(quantity=quantity, updated_at=now)
+            ).rowcount:
+                continue
+            cls.add(user_id, book_id, quantity)
+
     def to_dict(self):
         """Convert cart item object to dictionary"""
-        return {
-            'id': self.id,
-            'user_id': self.user_id,
-            'book_id': self.book_id,
-            'book': self.book.to_dict() if self.book else None,
-            'quantity': self.quantity,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-            'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S')
-        }
+        return CART_ITEM_SCHEMA.serialize(self)
@@ -1,25 +1,106 @@
 from flask import Blueprint, jsonify, request
-from src.models.ecommerce.cart import CartItem
-from src.models.ecommerce.book import Book
+from src.models.ecommerce.cart import CART_ITEM_SCHEMA, CartItem
+from src.models.ecommerce.catalog_cache import cached_books
+from src.models.ecommerce.guest_cart import (
+    apply_guest_operations, clear_guest_cart, guest_carts_enabled, load_guest_cart,
+    merge_guest_cart, price_guest_cart, save_guest_cart
+)
 from src.models.user import db
 
 cart_bp = Blueprint('cart', __name__)
 
+MAX_BATCH_OPERATIONS = 500
+
+def _cart_payload(user_id):
+    """Load the cart with its books in one query and total it from the loaded rows"""
+    cart_items = CartItem.for_user(user_id).populate_existing().all()
+    
+    total = sum(item.book.price * item.quantity for item in cart_items if item.book)
+    
+    return {
+        'cart_items': CART_ITEM_SCHEMA.serialize_many(cart_items),
+        'total': total,
+        'item_count': len(cart_items),
+        'quantity': sum(item.quantity for item in cart_items)
+    }
+
+def _include_cart():
+    """Whether the client asked for the resulting cart with ``?include_cart=1``"""
+    return request.args.get('include_cart', '').lower() in ('1', 'true', 'yes')
+
+def _is_guest(user_id):
+    """Requests without a user keep their cart in the guest cookie while guest carts are enabled"""
+    return user_id is None and guest_carts_enabled()
+
+def _guest_update(lines, operations, message, book_id=None):
+    """Apply ``operations`` to the guest cart and send it back in the cookie
+
+    Pricing a guest cart needs no query, so the cart is always included.
+    """
+    try:
+        lines = apply_guest_operations(lines, operations)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    
+    payload = price_guest_cart(lines)
+    response = {
+        'success': True,
+        'message': message,
+        **payload
+    }
+    if book_id is not None:
+        response['cart_item'] = next((item for item in payload['cart_items'] if item['book_id'] == book_id), None)
+        if response['cart_item'] is None:
+            # The operation dropped the line instead of leaving one to return
+            return jsonify({
+                'success': False,
+                'message': 'quantity must be at least 1'
+            }), 400
+    
+    return save_guest_cart(jsonify(response), lines), 200
+
 @cart_bp.route('/cart', methods=['GET'])
 def get_cart():
     """Get user's shopping cart"""
     # In a real app, get user_id from session/token
-    user_id = request.args.get('user_id', 1)  # Default to 1 for demo
+    user_id = request.args.get('user_id')
+    if _is_guest(user_id):
+        return jsonify({
+            'success': True,
+            **price_guest_cart(load_guest_cart())
+        }), 200
+    user_id = user_id or 1  # Default to 1 for demo
     
-    cart_items = CartItem.query.filter_by(user_id=user_id).all()
+    return jsonify({
+        'success': True,
+        **_cart_payload(user_id)
+    }), 200
+
+@cart_bp.route('/cart/summary', methods=['GET'])
+def get_cart_summary():
+    """Get the item count and total for the header mini-cart"""
+    # In a real app, get user_id from session/token
+    user_id = request.args.get('user_id')
+    if _is_guest(user_id):
+        payload = price_guest_cart(load_guest_cart())
+        return jsonify({
+            'success': True,
+            'item_count': payload['item_count'],
+            'quantity': payload['quantity'],
+            'total': payload['total']
+        }), 200
+    user_id = user_id or 1  # Default to 1 for demo
     
-    total = sum(item.book.price * item.quantity for item in cart_items if item.book)
+    totals = CartItem.totals_for(user_id)
     
     return jsonify({
         'success': True,
-        'cart_items': [item.to_dict() for item in cart_items],
-        'total': total,
-        'item_count': len(cart_items)
+        'item_count': totals.item_count,
+        'quantity': totals.quantity,
+        'total': totals.total
     }), 200
 
 @cart_bp.route('/cart/add', methods=['POST'])
@@ -37,36 +118,107 @@ def add_to_cart():
             }), 400
     
     # In a real app, get user_id from session/token
-    user_id = data.get('user_id', 1)  # Default to 1 for demo
-    book_id = data['book_id']
-    quantity = int(data['quantity'])
+    user_id = data.get('user_id')
+    try:
+        book_id = int(data['book_id'])
+        quantity = int(data['quantity'])
+    except (TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'message': 'book_id and quantity must be integers'
+        }), 400
+    if quantity < 1:
+        return jsonify({
+            'success': False,
+            'message': 'quantity must be at least 1'
+        }), 400
+    
+    if _is_guest(user_id):
+        if book_id not in cached_books([book_id]):
+            return jsonify({
+                'success': False,
+                'message': 'Book not found'
+            }), 404
+        return _guest_update(load_guest_cart(), [
+            {'op': 'add', 'book_id': book_id, 'quantity': quantity}
+        ], 'Item added to cart', book_id=book_id)
+    user_id = user_id or 1  # Default to 1 for demo
     
-    # Check if book exists
-    book = Book.query.get(book_id)
-    if not book:
+    if not CartItem.add(user_id, book_id, quantity):
+        db.session.rollback()
         return jsonify({
             'success': False,
             'message': 'Book not found'
         }), 404
     
-    # Check if item already in cart
-    cart_item = CartItem.query.filter_by(user_id=user_id, book_id=book_id).first()
-    
-    if cart_item:
-        # Update quantity if already in cart
-        cart_item.quantity += quantity
+    # Read the line back and total the cart in the same transaction
+    if _include_cart():
+        payload = _cart_payload(user_id)
+        cart_item = next(item for item in payload['cart_items'] if item['book_id'] == book_id)
+        response = {
+            'success': True,
+            'message': 'Item added to cart',
+            'cart_item': cart_item,
+            **payload
+        }
     else:
-        # Add new item to cart
-        cart_item = CartItem(user_id=user_id, book_id=book_id, quantity=quantity)
-        db.session.add(cart_item)
+        cart_item = CartItem.for_user(user_id).filter_by(book_id=book_id).populate_existing().one()
+        totals = CartItem.totals_for(user_id)
+        response = {
+            'success': True,
+            'message': 'Item added to cart',
+            'cart_item': cart_item.to_dict(),
+            'total': totals.total,
+            'item_count': totals.item_count,
+            'quantity': totals.quantity
+        }
     
     db.session.commit()
     
-    return jsonify({
+    return jsonify(response), 200
+
+@cart_bp.route('/cart/batch', methods=['POST'])
+def batch_update_cart():
+    """Apply several add/update/remove operations in one transaction"""
+    data = request.get_json()
+    
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return jsonify({
+            'success': False,
+            'message': 'operations must be a non-empty list'
+        }), 400
+    
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify({
+            'success': False,
+            'message': f'At most {MAX_BATCH_OPERATIONS} operations per batch'
+        }), 400
+    
+    # In a real app, get user_id from session/token
+    user_id = data.get('user_id')
+    if _is_guest(user_id):
+        return _guest_update(load_guest_cart(), operations, 'Cart updated successfully')
+    user_id = user_id or 1  # Default to 1 for demo
+    
+    try:
+        CartItem.apply_batch(user_id, operations)
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    
+    response = {
         'success': True,
-        'message': 'Item added to cart',
-        'cart_item': cart_item.to_dict()
-    }), 200
+        'message': 'Cart updated successfully',
+        **_cart_payload(user_id)
+    }
+    
+    db.session.commit()
+    
+    return jsonify(response), 200
 
 @cart_bp.route('/cart/update', methods=['PUT'])
 def update_cart_item():
@@ -82,8 +234,27 @@ def update_cart_item():
                 'message': f'Missing required field: {field}'
             }), 400
     
-    cart_item_id = data['cart_item_id']
-    quantity = int(data['quantity'])
+    try:
+        cart_item_id = int(data['cart_item_id'])
+        quantity = int(data['quantity'])
+    except (TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'message': 'cart_item_id and quantity must be integers'
+        }), 400
+    
+    # Guest lines are keyed by book id
+    if _is_guest(data.get('user_id')):
+        lines = load_guest_cart()
+        if cart_item_id not in lines:
+            return jsonify({
+                'success': False,
+                'message': 'Cart item not found'
+            }), 404
+        # Like a stored line, a guest line set to 0 or below is removed
+        operation = {'op': 'update', 'book_id': cart_item_id, 'quantity': quantity} if quantity > 0 else \
+            {'op': 'remove', 'book_id': cart_item_id}
+        return _guest_update(lines, [operation], 'Cart updated successfully')
     
     # Find cart item
     cart_item = CartItem.query.get(cart_item_id)
@@ -101,16 +272,32 @@ def update_cart_item():
         # Update quantity
         cart_item.quantity = quantity
     
-    db.session.commit()
-    
-    return jsonify({
+    response = {
         'success': True,
         'message': 'Cart updated successfully'
-    }), 200
+    }
+    if _include_cart():
+        response.update(_cart_payload(cart_item.user_id))
+    
+    db.session.commit()
+    
+    return jsonify(response), 200
 
 @cart_bp.route('/cart/remove/<int:cart_item_id>', methods=['DELETE'])
 def remove_from_cart(cart_item_id):
     """Remove item from shopping cart"""
+    # Guest lines are keyed by book id
+    if _is_guest(request.args.get('user_id')):
+        lines = load_guest_cart()
+        if cart_item_id not in lines:
+            return jsonify({
+                'success': False,
+                'message': 'Cart item not found'
+            }), 404
+        return _guest_update(lines, [
+            {'op': 'remove', 'book_id': cart_item_id}
+        ], 'Item removed from cart')
+    
     cart_item = CartItem.query.get(cart_item_id)
     
     if not cart_item:
@@ -120,23 +307,63 @@ def remove_from_cart(cart_item_id):
         }), 404
     
     db.session.delete(cart_item)
-    db.session.commit()
     
-    return jsonify({
+    response = {
         'success': True,
         'message': 'Item removed from cart'
-    }), 200
+    }
+    if _include_cart():
+        response.update(_cart_payload(cart_item.user_id))
+    
+    db.session.commit()
+    
+    return jsonify(response), 200
 
 @cart_bp.route('/cart/clear', methods=['DELETE'])
 def clear_cart():
     """Clear all items from shopping cart"""
     # In a real app, get user_id from session/token
-    user_id = request.args.get('user_id', 1)  # Default to 1 for demo
+    user_id = request.args.get('user_id')
+    guest = _is_guest(user_id)
+    if not guest:
+        user_id = user_id or 1  # Default to 1 for demo
+        CartItem.query.filter_by(user_id=user_id).delete()
+        db.session.commit()
     
-    CartItem.query.filter_by(user_id=user_id).delete()
-    db.session.commit()
-    
-    return jsonify({
+    response = {
         'success': True,
         'message': 'Cart cleared successfully'
-    }), 200
+    }
+    if _include_cart():
+        # Nothing left to load
+        response.update(cart_items=[], total=0, item_count=0, quantity=0)
+    
+    if guest:
+        return clear_guest_cart(jsonify(response)), 200
+    return jsonify(response), 200
+
+@cart_bp.route('/cart/merge', methods=['POST'])
+def merge_cart():
+    """Move the guest cart cookie into a user's cart after sign-in"""
+    data = request.get_json()
+    
+    if 'user_id' not in data:
+        return jsonify({
+            'success': False,
+            'message': 'Missing required field: user_id'
+        }), 400
+    
+    # In a real app, get user_id from session/token
+    user_id = data['user_id']
+    merged = merge_guest_cart(user_id)
+    
+    response = {
+        'success': True,
+        'message': 'Guest cart merged' if merged else 'No guest cart to merge',
+        'merged': merged,
+        **_cart_payload(user_id)
+    }
+    
+    db.session.commit()
+    
+    return clear_guest_cart(jsonify(response)), 200
@@ -0,0 +1,229 @@
+"""Read-through cache for catalog responses.
+
+Entries are pre-serialized JSON bodies stored under per-book and per-listing
+keys, so a hit is returned as-is without touching the database, ``to_dict``
+or ``jsonify``. The admin write routes invalidate exactly the keys a change
+can affect via ``invalidate_book``, which also bumps the data version tokens
+that rendered pages and fragments are keyed on.
+
+The default backend is an in-process LRU with a TTL. Its invalidations only
+reach the worker that handled the write: every other worker keeps serving
+its own entries until ``CATALOG_CACHE_TTL`` expires them. Deployments with
+more than one worker should set ``CATALOG_CACHE_REDIS_URL`` (in the config or
+the environment), which switches to a shared backend speaking the Redis
+protocol so that invalidations and version tokens reach every worker.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import current_app
+
+DEFAULT_TTL = 300
+DEFAULT_MAXSIZE = 2048
+VERSION_TTL = 30 * 24 * 3600
+
+_lock = threading.Lock()
+_caches = {}
+
+
+def book_key(book_id):
+    return f'book:{book_id}'
+
+
+def category_key(category):
+    return f'books:category:{category}'
+
+
+def encoded_key(key, encoding):
+    """Key of the ``encoding`` (e.g. ``gzip``) variant of the body cached under ``key``"""
+    return f'{key}:{encoding}'
+
+
+def version_key(name):
+    return f'version:{name}'
+
+
+def serialized_book_key(book_id, version):
+    return f'book:serialized:{book_id}:{version}'
+
+
+ALL_BOOKS_KEY = 'books:all'
+FEATURED_KEY = 'books:featured'
+
+# Data sets whose version tokens key rendered pages and fragments
+CATALOG_VERSION = 'catalog'
+FEATURED_VERSION = 'featured'
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache whose entries expire after ``ttl`` seconds"""
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    """Shared cache backend for any client implementing the redis-py API
+
+    Only ``get``, ``set(name, value, ex=...)``, ``delete`` and ``scan_iter``
+    are used, so a small dict-backed fake is enough to exercise it locally.
+    """
+
+    def __init__(self, client, prefix='catalog:', ttl=DEFAULT_TTL):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ex=self.ttl if ttl is None else ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+def shared_cache_url(config):
+    """Return the Redis URL of the shared backend, or ``None`` when each process keeps its own cache"""
+    return config.get('CATALOG_CACHE_REDIS_URL') or os.environ.get('CATALOG_CACHE_REDIS_URL')
+
+
+def _create_cache(config):
+    ttl = config.get('CATALOG_CACHE_TTL', DEFAULT_TTL)
+    url = shared_cache_url(config)
+    if url:
+        import redis  # Optional dependency, only needed for the shared backend
+        return RedisCache(redis.Redis.from_url(url), ttl=ttl)
+    return LRUCache(maxsize=config.get('CATALOG_CACHE_SIZE', DEFAULT_MAXSIZE), ttl=ttl)
+
+
+def get_catalog_cache():
+    """Return the catalog cache for the current app, creating it on first use"""
+    app = current_app._get_current_object()
+    cache = _caches.get(app)
+    if cache is None:
+        with _lock:
+            cache = _caches.get(app)
+            if cache is None:
+                cache = _caches[app] = _create_cache(app.config)
+    return cache
+
+
+def bump_version(name):
+    """Give data set ``name`` a fresh version token, orphaning everything keyed on the old one"""
+    token = f'{uuid.uuid4().hex[:12]}-{int(time.time())}'
+    get_catalog_cache().set(version_key(name), token, ttl=VERSION_TTL)
+    return token
+
+
+def version_age(name):
+    """Seconds since data set ``name`` was last bumped, or ``None`` if it has no token"""
+    token = get_catalog_cache().get(version_key(name))
+    if token is None:
+        return None
+    if isinstance(token, bytes):
+        token = token.decode('ascii')
+    return time.time() - int(token.rsplit('-', 1)[1])
+
+
+def data_versions(*names):
+    """Return the current version token of each named data set
+
+    A token that was evicted or cleared is replaced by a new one, so losing it
+    can only cause extra misses, never stale hits.
+    """
+    cache = get_catalog_cache()
+    tokens = []
+    for name in names:
+        token = cache.get(version_key(name))
+        if token is None:
+            token = bump_version(name)
+        elif isinstance(token, bytes):
+            token = token.decode('ascii')
+        tokens.append(token)
+    return tokens
+
+
+def invalidate_book(book_id=None, categories=(), featured=False):
+    """Drop every cached response that may include the given book
+
+    ``categories`` and ``featured`` should describe the book both before and
+    after the write so that listings it left are refreshed as well.
+    """
+    keys = [ALL_BOOKS_KEY]
+    if book_id is not None:
+        keys.append(book_key(book_id))
+    keys.extend(category_key(category) for category in set(categories) if category)
+    if featured:
+        keys.append(FEATURED_KEY)
+    get_catalog_cache().delete(*keys, *[encoded_key(key, 'gzip') for key in keys])
+
+    bump_version(CATALOG_VERSION)
+    if featured:
+        bump_version(FEATURED_VERSION)
+
+
+def cached_books(book_ids):
+    """Return serialized books by id, loading only the ones missing from the catalog cache"""
+    # Imported here because src.database imports this module
+    from src.database import read_query
+    from src.models.ecommerce.book import BOOK_SCHEMA, Book
+    from src.models.ecommerce.serializers import dumps
+
+    cache = get_catalog_cache()
+    version = data_versions(CATALOG_VERSION)[0]
+    books, missing = {}, []
+    for book_id in book_ids:
+        entry = cache.get(serialized_book_key(book_id, version))
+        if entry is None:
+            missing.append(book_id)
+        else:
+            books[book_id] = json.loads(entry)
+    if missing:
+        for book in read_query(Book, CATALOG_VERSION).filter(Book.id.in_(missing)):
+            books[book.id] = BOOK_SCHEMA.serialize(book)
+            cache.set(serialized_book_key(book.id, version), dumps(books[book.id]))
+    return books
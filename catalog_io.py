@@ -0,0 +1,305 @@
+"""Bulk catalog import and export.
+
+Imports are a generator pipeline: a reader turns CSV, JSON Lines or
+ONIX-like XML into raw records, ``validate_rows`` normalizes them, and
+``import_books`` upserts on ``isbn`` in batches with
+``bulk_insert_mappings``/``bulk_update_mappings`` and one commit per batch.
+Only one batch is ever held in memory, and invalid rows are reported with
+their row number instead of aborting the run; so are the rows of a batch the
+database rejects, which is rolled back on its own.
+
+``export_books`` streams the catalog back out as CSV or JSON Lines from a
+server-side cursor over plain column tuples.
+"""
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import date, datetime
+from xml.etree import ElementTree
+
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from src.models.user import db
+from src.models.ecommerce.book import BOOK_SCHEMA, Book
+from src.models.ecommerce.catalog_cache import CATALOG_VERSION, bump_version, get_catalog_cache
+from src.models.ecommerce.search import get_search_index
+from src.models.ecommerce.serializers import format_date, format_datetime
+
+FORMATS = ('csv', 'jsonl', 'onix')
+EXPORT_FORMATS = ('csv', 'jsonl')
+DEFAULT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+
+EXPORT_FIELDS = (
+    'id', 'isbn', 'title', 'author', 'description', 'price', 'cover_image',
+    'publication_date', 'pages', 'stock', 'featured', 'category'
+)
+
+# ONIX-like element names mapped onto Book fields
+ONIX_FIELDS = {
+    'isbn': 'isbn',
+    'productidentifier': 'isbn',
+    'title': 'title',
+    'titletext': 'title',
+    'author': 'author',
+    'personname': 'author',
+    'contributor': 'author',
+    'description': 'description',
+    'othertext': 'description',
+    'price': 'price',
+    'priceamount': 'price',
+    'coverimage': 'cover_image',
+    'publicationdate': 'publication_date',
+    'publishingdate': 'publication_date',
+    'pages': 'pages',
+    'numberofpages': 'pages',
+    'stock': 'stock',
+    'onhand': 'stock',
+    'category': 'category',
+    'subjectheadingtext': 'category',
+    'featured': 'featured'
+}
+
+ImportReport = namedtuple('ImportReport', ['inserted', 'updated', 'error_count', 'errors'])
+
+
+class RowError(Exception):
+    """A record that cannot be imported"""
+
+
+def read_csv(stream):
+    """Yield ``(row_number, record)`` from a text stream of CSV with a header row"""
+    for row_number, record in enumerate(csv.DictReader(stream), start=1):
+        yield row_number, record
+
+
+def read_jsonl(stream):
+    """Yield ``(row_number, record)`` from a text stream of JSON objects, one per line"""
+    for row_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield row_number, RowError(f'Invalid JSON: {e}')
+            continue
+        if not isinstance(record, dict):
+            record = RowError('Expected a JSON object')
+        yield row_number, record
+
+
+def read_onix(stream):
+    """Yield ``(row_number, record)`` for each ``<Product>`` in a binary XML stream"""
+    row_number = 0
+    for _, element in ElementTree.iterparse(stream, events=('end',)):
+        if _local_name(element.tag) != 'product':
+            continue
+        row_number += 1
+        record = {}
+        for child in element.iter():
+            field = ONIX_FIELDS.get(_local_name(child.tag))
+            value = (child.text or '').strip()
+            if field and value and field not in record:
+                record[field] = value
+        element.clear()  # Keep memory flat on large feeds
+        yield row_number, record
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1].lower()
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+    'onix': read_onix
+}
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+def _parse_date(value):
+    if isinstance(value, date):
+        return value
+    value = str(value).strip()
+    for pattern in ('%Y-%m-%d', '%Y%m%d', '%Y'):
+        try:
+            return datetime.strptime(value, pattern).date()
+        except ValueError:
+            continue
+    raise RowError(f'Invalid publication_date: {value}')
+
+
+def _parse_number(kind, field, value):
+    try:
+        number = kind(value)
+    except (TypeError, ValueError):
+        raise RowError(f'Invalid {field}: {value}')
+    if number < 0:
+        raise RowError(f'{field} must not be negative')
+    return number
+
+
+def validate_row(record):
+    """Normalize one raw record into Book column values, raising ``RowError``"""
+    values = {}
+    for field in ('isbn', 'title', 'author', 'price'):
+        value = record.get(field)
+        if value is None or str(value).strip() == '':
+            raise RowError(f'Missing required field: {field}')
+
+    values['isbn'] = str(record['isbn']).replace('-', '').strip()
+    if len(values['isbn']) > 20:
+        raise RowError('isbn is longer than 20 characters')
+    values['title'] = str(record['title']).strip()
+    values['author'] = str(record['author']).strip()
+    values['price'] = _parse_number(float, 'price', record['price'])
+
+    for field in ('description', 'cover_image', 'category'):
+        if record.get(field) not in (None, ''):
+            values[field] = str(record[field])
+    if record.get('publication_date') not in (None, ''):
+        values['publication_date'] = _parse_date(record['publication_date'])
+    if record.get('pages') not in (None, ''):
+        values['pages'] = _parse_number(int, 'pages', record['pages'])
+    if record.get('stock') not in (None, ''):
+        values['stock'] = _parse_number(int, 'stock', record['stock'])
+    if record.get('featured') not in (None, ''):
+        values['featured'] = _parse_bool(record['featured'])
+    return values
+
+
+def validate_rows(records):
+    """Yield ``(row_number, values_or_error)`` for each raw record"""
+    for row_number, record in records:
+        if isinstance(record, RowError):
+            yield row_number, record
+            continue
+        try:
+            yield row_number, validate_row(record)
+        except RowError as e:
+            yield row_number, e
+
+
+def _upsert_batch(batch):
+    """Insert or update one batch of validated rows keyed on isbn"""
+    # Later rows win when an isbn repeats inside the batch
+    by_isbn = {}
+    for values in batch:
+        by_isbn[values['isbn']] = values
+
+    existing = dict(db.session.execute(
+        select(Book.isbn, Book.id).where(Book.isbn.in_(list(by_isbn)))
+    ).all())
+
+    now = datetime.utcnow()
+    inserts, updates = [], []
+    for isbn, values in by_isbn.items():
+        values['updated_at'] = now
+        if isbn in existing:
+            values['id'] = existing[isbn]
+            updates.append(values)
+        else:
+            values.setdefault('stock', 0)
+            values.setdefault('featured', False)
+            values['created_at'] = now
+            inserts.append(values)
+
+    if inserts:
+        db.session.bulk_insert_mappings(Book, inserts)
+    if updates:
+        db.session.bulk_update_mappings(Book, updates)
+    db.session.commit()
+    return len(inserts), len(updates)
+
+
+def _import_batch(batch):
+    """Upsert ``(row_number, values)`` pairs and return ``(inserted, updated, errors)``
+
+    A batch the database rejects is rolled back and every row in it is
+    returned as an error, so the rest of the import still runs.
+    """
+    try:
+        added, changed = _upsert_batch([values for _, values in batch])
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        message = f'Batch rolled back: {getattr(e, "orig", None) or e}'
+        return 0, 0, [{'row': row_number, 'message': message} for row_number, _ in batch]
+    return added, changed, []
+
+
+def import_books(records, batch_size=DEFAULT_BATCH_SIZE):
+    """Upsert validated ``records`` into ``books`` and return an ``ImportReport``"""
+    inserted = updated = error_count = 0
+    errors = []
+    batch = []
+
+    for row_number, values in validate_rows(records):
+        if isinstance(values, RowError):
+            error_count += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({'row': row_number, 'message': str(values)})
+            continue
+        batch.append((row_number, values))
+        if len(batch) >= batch_size:
+            added, changed, failed = _import_batch(batch)
+            inserted, updated, error_count = inserted + added, updated + changed, error_count + len(failed)
+            errors.extend(failed[:MAX_REPORTED_ERRORS - len(errors)])
+            batch = []
+
+    if batch:
+        added, changed, failed = _import_batch(batch)
+        inserted, updated, error_count = inserted + added, updated + changed, error_count + len(failed)
+        errors.extend(failed[:MAX_REPORTED_ERRORS - len(errors)])
+
+    if inserted or updated:
+        get_search_index().rebuild()
+        db.session.commit()
+        get_catalog_cache().clear()
+        bump_version(CATALOG_VERSION)
+
+    return ImportReport(inserted, updated, error_count, errors)
+
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return format_datetime(value)
+    if isinstance(value, date):
+        return format_date(value)
+    return value
+
+
+def export_books(fmt='csv', chunk_rows=500):
+    """Yield the catalog as CSV or JSON Lines text chunks ordered by id"""
+    columns = [getattr(Book, field) for field in EXPORT_FIELDS]
+    rows = db.session.execute(
+        select(*columns).order_by(Book.id).execution_options(yield_per=chunk_rows)
+    )
+
+    buffer = io.StringIO()
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+    else:
+        serialize = BOOK_SCHEMA.row_serializer(EXPORT_FIELDS)
+
+    for count, row in enumerate(rows, start=1):
+        if writer:
+            writer.writerow([_export_value(value) for value in row])
+        else:
+            buffer.write(json.dumps(serialize(row)))
+            buffer.write('\n')
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
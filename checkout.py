@@ -0,0 +1,221 @@
+"""Transactional checkout.
+
+``place_order`` turns a user's cart into an order in one transaction:
+
+1. Stock is reserved with one conditional ``UPDATE ... WHERE stock >= q`` per
+   title, so two buyers can never both take the last copy. Rows are touched
+   in ``book_id`` order, which keeps concurrent checkouts from deadlocking.
+2. The order and all of its items are inserted, the items as one
+   ``executemany``.
+3. Exactly the cart lines that were read are deleted, so an item added while
+   the checkout is running stays in the cart.
+
+An optional idempotency key makes retries return the original order instead
+of charging stock twice; a unique constraint on ``(user_id, idempotency_key)``
+settles races between concurrent retries.
+
+``apply_payment_event`` settles an order from a verified PaymentIntent
+webhook event, ignoring events that do not match the order.
+"""
+from collections import OrderedDict
+
+from sqlalchemy import delete, insert, update
+from sqlalchemy.exc import IntegrityError
+from src.models.user import db
+from src.models.ecommerce.book import Book
+from src.models.ecommerce.cart import CartItem
+from src.models.ecommerce.catalog_cache import book_key, get_catalog_cache
+from src.models.ecommerce.order import Order, OrderItem
+
+
+class CheckoutError(Exception):
+    """Raised when a cart cannot be turned into an order"""
+
+    status_code = 400
+
+
+class PaymentNotConfirmedError(CheckoutError):
+    """Raised when the gateway does not report a successful payment for an order"""
+
+    status_code = 402
+
+
+class EmptyCartError(CheckoutError):
+    def __init__(self):
+        super().__init__('Cart is empty')
+
+
+class InvalidQuantityError(CheckoutError):
+    def __init__(self, book_ids):
+        super().__init__('Quantities must be at least 1')
+        self.book_ids = book_ids
+
+
+class OutOfStockError(CheckoutError):
+    status_code = 409
+
+    def __init__(self, book_ids):
+        super().__init__('Not enough stock for some items')
+        self.book_ids = book_ids
+
+
+# PaymentIntent events that settle an order, and the status they set
+PAYMENT_EVENT_STATUSES = {
+    'payment_intent.succeeded': 'paid',
+    'payment_intent.payment_failed': 'payment_failed'
+}
+
+# Order statuses a payment event may still change
+PAYABLE_STATUSES = ('pending', 'payment_failed')
+
+
+def order_amount_cents(order):
+    return int(round(order.total_amount * 100))
+
+
+def _find_order(user_id, idempotency_key):
+    return Order.query.filter_by(user_id=user_id, idempotency_key=idempotency_key).first()
+
+
+def place_order(user_id, shipping_address, billing_address, idempotency_key=None, guest_lines=None):
+    """Create an order from the user's cart
+
+    ``guest_lines`` is a guest cart (``{book_id: quantity}``) to merge into
+    the user's cart first, in the same transaction as the order. With
+    ``user_id=None`` the order is a guest's: it is priced from
+    ``guest_lines`` alone and no cart rows are touched. Returns
+    ``(order, created)``; ``created`` is ``False`` when an order for
+    ``idempotency_key`` already existed and was returned unchanged. Raises
+    ``CheckoutError`` subclasses when the cart is empty, holds a quantity below 1
+    or is out of stock, in which case nothing is written.
+    """
+    if idempotency_key:
+        order = _find_order(user_id, idempotency_key)
+        if order:
+            return order, False
+
+    if user_id is None:
+        guest_lines = guest_lines or {}
+        prices = dict(db.session.query(Book.id, Book.price).filter(Book.id.in_(list(guest_lines))).all())
+        rows = [(None, book_id, quantity, prices[book_id])
+                for book_id, quantity in sorted(guest_lines.items()) if book_id in prices]
+    else:
+        if guest_lines:
+            CartItem.merge(user_id, guest_lines)
+        rows = db.session.query(
+            CartItem.id, CartItem.book_id, CartItem.quantity, Book.price
+        ).join(Book, Book.id == CartItem.book_id).filter(
+            CartItem.user_id == user_id
+        ).order_by(CartItem.book_id).all()
+
+    if not rows:
+        raise EmptyCartError()
+
+    # Merge duplicate lines for the same book, keeping book_id order
+    lines = OrderedDict()
+    for _, book_id, quantity, price in rows:
+        if book_id in lines:
+            lines[book_id][0] += quantity
+        else:
+            lines[book_id] = [quantity, price]
+
+    # A non-positive line would turn the stock reservation below into a refund
+    invalid = [book_id for book_id, (quantity, _) in lines.items() if quantity < 1]
+    if invalid:
+        db.session.rollback()
+        raise InvalidQuantityError(invalid)
+
+    books = Book.__table__
+    try:
+        short = []
+        for book_id, (quantity, _) in lines.items():
+            result = db.session.execute(
+                update(books)
+                .where(books.c.id == book_id, books.c.stock >= quantity)
+                .values(stock=books.c.stock - quantity)
+            )
+            if result.rowcount != 1:
+                short.append(book_id)
+        if short:
+            raise OutOfStockError(short)
+
+        order = Order(
+            user_id=user_id,
+            total_amount=sum(price * quantity for quantity, price in lines.values()),
+            shipping_address=shipping_address,
+            billing_address=billing_address
+        )
+        order.idempotency_key = idempotency_key
+        db.session.add(order)
+        db.session.flush()  # Get order ID without committing
+
+        db.session.execute(insert(OrderItem.__table__), [
+            {'order_id': order.id, 'book_id': book_id, 'quantity': quantity, 'price': price}
+            for book_id, (quantity, price) in lines.items()
+        ])
+        cart_item_ids = [row[0] for row in rows if row[0] is not None]
+        if cart_item_ids:
+            db.session.execute(
+                delete(CartItem.__table__).where(CartItem.__table__.c.id.in_(cart_item_ids))
+            )
+        db.session.commit()
+    except CheckoutError:
+        db.session.rollback()
+        raise
+    except IntegrityError:
+        db.session.rollback()
+        # A concurrent retry with the same key committed first
+        order = _find_order(user_id, idempotency_key) if idempotency_key else None
+        if order is None:
+            raise
+        return order, False
+
+    # Stock changed, so drop the cached detail pages; listings refresh on their TTL
+    get_catalog_cache().delete(*[book_key(book_id) for book_id in lines])
+    return order, True
+
+
+def apply_payment_event(event):
+    """Apply a verified PaymentIntent webhook event to its order
+
+    Returns the updated order, or ``None`` when the event is not a payment
+    outcome, names no known order, belongs to a superseded intent, does not
+    match the order total, or arrives after the order has moved on. Does not
+    commit.
+    """
+    status = PAYMENT_EVENT_STATUSES.get(event.get('type'))
+    if status is None:
+        return None
+
+    intent = event['data']['object']
+    order_id = (intent.get('metadata') or {}).get('order_id')
+    order = db.session.get(Order, int(order_id)) if order_id and str(order_id).isdigit() else None
+    if order is None or order.status not in PAYABLE_STATUSES:
+        return None
+    if order.payment_id not in (None, intent['id']):
+        return None
+    if status == 'paid' and intent.get('amount') != order_amount_cents(order):
+        return None
+
+    order.payment_id = intent['id']
+    order.status = status
+    return order
+
+
+def confirm_order_payment(order, intent):
+    """Mark ``order`` paid if the gateway's ``intent`` shows it was paid in full
+
+    ``intent`` must come from the gateway itself, never from the client.
+    Raises ``PaymentNotConfirmedError`` otherwise. Does not commit.
+    """
+    if (intent.status != 'succeeded'
+            or str((intent.metadata or {}).get('order_id')) != str(order.id)
+            or intent.amount != order_amount_cents(order)):
+        raise PaymentNotConfirmedError('Payment has not succeeded for this order')
+    if order.payment_id not in (None, intent.id):
+        raise PaymentNotConfirmedError('Order is being paid with a different payment')
+
+    order.payment_id = intent.id
+    if order.status in PAYABLE_STATUSES:
+        order.status = 'paid'
+    return order
@@ -0,0 +1,247 @@
+"""Engine, pool and session configuration for the SQLAlchemy layer.
+
+``init_database`` builds ``SQLALCHEMY_ENGINE_OPTIONS`` from the
+``DATABASE_*`` settings below before binding ``db`` to the app, so every
+engine gets an explicitly sized ``TimedQueuePool`` with pre-ping, recycling
+and a bounded statement cache:
+
+``DATABASE_POOL_SIZE`` / ``DATABASE_MAX_OVERFLOW``
+    Connections kept open per process, and extra ones allowed under bursts.
+    Size them against the threads per gunicorn worker.
+``DATABASE_POOL_TIMEOUT``
+    Seconds a request waits for a connection before failing.
+``DATABASE_POOL_RECYCLE`` / ``DATABASE_POOL_PRE_PING``
+    Replace connections before the server or a proxy drops them, and test
+    each one on checkout.
+``DATABASE_QUERY_CACHE_SIZE``
+    Compiled statements cached per engine.
+``DATABASE_REPLICA_URL`` / ``DATABASE_REPLICA_LAG``
+    Optional read replica for GET routes, and how many seconds after a write
+    readers of the written data keep going to the primary. The time of the
+    last write is kept in the catalog cache, so the replica needs the shared
+    backend (``CATALOG_CACHE_REDIS_URL``); without it, another worker would
+    not see the write and could read stale rows from the replica. When the
+    shared backend is missing, reads stay on the primary unless
+    ``DATABASE_REPLICA_SINGLE_PROCESS`` promises that only one process
+    serves the app.
+
+Engines must not be shared across ``fork``: gunicorn calls
+``dispose_engines`` in every new worker. Pool checkouts, wait times and
+timeouts are recorded per engine and served at ``/admin/database/pool``.
+"""
+import os
+import threading
+import time
+
+from flask import current_app, g, jsonify
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from src.models.user import db
+from src.models.ecommerce.catalog_cache import bump_version, shared_cache_url, version_age
+
+REPLICA_BIND = 'replica'
+
+DEFAULTS = {
+    'DATABASE_POOL_SIZE': 5,
+    'DATABASE_MAX_OVERFLOW': 10,
+    'DATABASE_POOL_TIMEOUT': 10,
+    'DATABASE_POOL_RECYCLE': 1800,
+    'DATABASE_POOL_PRE_PING': True,
+    'DATABASE_QUERY_CACHE_SIZE': 1000,
+    'DATABASE_REPLICA_LAG': 5,
+    'DATABASE_REPLICA_SINGLE_PROCESS': False
+}
+
+# Upper bounds, in milliseconds, of the pool wait histogram buckets
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class PoolStats:
+    """Thread-safe counters for connection checkouts from one pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.buckets = [0] * (len(WAIT_BUCKETS_MS) + 1)
+
+    def record(self, waited, timed_out=False):
+        waited_ms = waited * 1000
+        index = next((i for i, bound in enumerate(WAIT_BUCKETS_MS) if waited_ms <= bound), len(WAIT_BUCKETS_MS))
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.buckets[index] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_total_ms': round(self.wait_total * 1000, 3),
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+                'wait_avg_ms': round(self.wait_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+                'wait_buckets_ms': dict(zip([*map(str, WAIT_BUCKETS_MS), '+Inf'], self.buckets))
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """``QueuePool`` that records how long each checkout waited for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record(time.perf_counter() - started, timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - started)
+        return connection
+
+    def recreate(self):
+        # dispose() swaps in a fresh pool; keep counting into the same stats
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def normalize_url(url):
+    """Accept the ``postgres://`` scheme some hosts hand out"""
+    if url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def engine_options(config, url):
+    """Build ``create_engine`` keyword arguments for ``url`` from ``config``"""
+    def setting(name):
+        return config.get(name, DEFAULTS[name])
+
+    options = {
+        'pool_pre_ping': setting('DATABASE_POOL_PRE_PING'),
+        'query_cache_size': setting('DATABASE_QUERY_CACHE_SIZE')
+    }
+    parsed = make_url(url)
+    if parsed.get_backend_name() == 'sqlite' and parsed.database in (None, '', ':memory:'):
+        return options  # In-memory SQLite keeps its single shared connection
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=setting('DATABASE_POOL_SIZE'),
+        max_overflow=setting('DATABASE_MAX_OVERFLOW'),
+        pool_timeout=setting('DATABASE_POOL_TIMEOUT'),
+        pool_recycle=setting('DATABASE_POOL_RECYCLE'),
+        pool_use_lifo=True  # Lets surplus connections sit idle long enough to be recycled
+    )
+    return options
+
+
+def _read_sessions():
+    """Sessionmaker bound to the replica engine, or ``None`` without a replica"""
+    engine = db.engines.get(REPLICA_BIND)
+    if engine is None:
+        return None
+    state = current_app.extensions['database']
+    if state['read_sessionmaker'] is None:
+        state['read_sessionmaker'] = sessionmaker(bind=engine, query_cls=db.Query, autoflush=False)
+    return state['read_sessionmaker']
+
+
+def read_session(written=None):
+    """Session for read-only queries: the replica when configured, else ``db.session``
+
+    ``written`` names the data version the read depends on (see
+    ``catalog_cache.data_versions``); while that data was written less than
+    ``DATABASE_REPLICA_LAG`` seconds ago the primary is used instead, so
+    readers never cache or return what the replica has not caught up on.
+    """
+    factory = _read_sessions()
+    if factory is None:
+        return db.session
+    if written is not None:
+        age = version_age(written)
+        if age is not None and age < current_app.config.get('DATABASE_REPLICA_LAG', DEFAULTS['DATABASE_REPLICA_LAG']):
+            return db.session
+
+    session = g.get('_read_session')
+    if session is None:
+        session = g._read_session = factory()
+    return session
+
+
+def read_query(model, written=None):
+    """``model.query`` equivalent that reads from ``read_session(written)``"""
+    return read_session(written).query(model)
+
+
+def mark_written(name):
+    """Record a write to data set ``name`` so ``read_session`` keeps its readers on the primary"""
+    bump_version(name)
+
+
+def _close_read_session(exception=None):
+    session = g.pop('_read_session', None)
+    if session is not None:
+        session.close()
+
+
+def dispose_engines(app):
+    """Drop connections inherited from a parent process without closing them under it"""
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def pool_status():
+    """Current size, usage and checkout statistics of every engine's pool"""
+    status = {}
+    for name, engine in db.engines.items():
+        pool = engine.pool
+        entry = {'class': type(pool).__name__}
+        if isinstance(pool, QueuePool):
+            entry.update(size=pool.size(), checked_out=pool.checkedout(),
+                         idle=pool.checkedin(), overflow=pool.overflow())
+        if isinstance(pool, TimedQueuePool):
+            entry.update(pool.stats.snapshot())
+        status[name or 'primary'] = entry
+    return status
+
+
+def pool_status_route():
+    """Connection pool metrics (admin only)"""
+    return jsonify({
+        'success': True,
+        'pools': pool_status()
+    }), 200
+
+
+def init_database(app):
+    """Configure engines and pools from ``DATABASE_*`` settings and bind ``db`` to ``app``"""
+    config = app.config
+    url = normalize_url(config.get('SQLALCHEMY_DATABASE_URI') or os.environ.get('DATABASE_URL', 'sqlite:///coldcase.db'))
+    config['SQLALCHEMY_DATABASE_URI'] = url
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = {**engine_options(config, url), **config.get('SQLALCHEMY_ENGINE_OPTIONS', {})}
+
+    replica_url = config.get('DATABASE_REPLICA_URL') or os.environ.get('DATABASE_REPLICA_URL')
+    if replica_url and not shared_cache_url(config) and not config.get(
+            'DATABASE_REPLICA_SINGLE_PROCESS', DEFAULTS['DATABASE_REPLICA_SINGLE_PROCESS']):
+        # Write times in a per-process cache are invisible to other workers
+        app.logger.warning('DATABASE_REPLICA_URL needs CATALOG_CACHE_REDIS_URL; reading from the primary')
+        replica_url = None
+    if replica_url:
+        replica_url = normalize_url(replica_url)
+        config.setdefault('SQLALCHEMY_BINDS', {})[REPLICA_BIND] = {'url': replica_url, **engine_options(config, replica_url)}
+
+    db.init_app(app)
+    app.extensions['database'] = {'read_sessionmaker': None}
+    app.teardown_appcontext(_close_read_session)
+    app.add_url_rule('/admin/database/pool', 'database_pool', pool_status_route)
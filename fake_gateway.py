@@ -0,0 +1,189 @@
+"""Local stand-in for the Stripe PaymentIntents API.
+
+Serves just enough of ``/v1/payment_intents`` for ``payments.StripeGateway``
+with configurable latency and failure rate, and honours idempotency keys the
+way Stripe does. Useful for benchmarking payment latency and concurrency
+without network access::
+
+    python fake_gateway.py serve --port 12111 --latency 0.2
+    STRIPE_API_BASE=http://127.0.0.1:12111 gunicorn main:app
+
+With ``--webhook-url`` every new intent succeeds shortly after it is created
+and a signed ``payment_intent.succeeded`` event is posted to that URL, the
+way Stripe reports a completed payment.
+
+    python fake_gateway.py bench --latency 0.2 --requests 200 --concurrency 16
+"""
+import argparse
+import itertools
+import json
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.request import Request, urlopen
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so pooled connections are reused
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _simulate(self):
+        server = self.server
+        time.sleep(server.latency)
+        return random.random() < server.failure_rate
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        if self.path != '/v1/payment_intents':
+            return self._send(404, {'error': {'message': 'Unknown path'}})
+        if self._simulate():
+            return self._send(503, {'error': {'message': 'Simulated outage'}})
+
+        server = self.server
+        key = self.headers.get('Idempotency-Key')
+        with server.lock:
+            intent = server.intents_by_key.get(key) if key else None
+            if intent is None:
+                intent_id = 'pi_fake_%d' % next(server.counter)
+                intent = {
+                    'id': intent_id,
+                    'object': 'payment_intent',
+                    'amount': int(form.get('amount', 0)),
+                    'currency': form.get('currency', 'usd'),
+                    'client_secret': intent_id + '_secret_fake',
+                    'status': 'requires_payment_method',
+                    'metadata': {'order_id': form.get('metadata[order_id]')}
+                }
+                server.intents[intent_id] = intent
+                if key:
+                    server.intents_by_key[key] = intent
+                if server.webhook_url:
+                    threading.Timer(server.webhook_delay, server.complete_payment, (intent_id,)).start()
+        self._send(200, intent)
+
+    def do_GET(self):
+        prefix = '/v1/payment_intents/'
+        intent = self.server.intents.get(self.path[len(prefix):]) if self.path.startswith(prefix) else None
+        if intent is None:
+            return self._send(404, {'error': {'message': 'No such payment_intent'}})
+        if self._simulate():
+            return self._send(503, {'error': {'message': 'Simulated outage'}})
+        self._send(200, intent)
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, failure_rate=0.0,
+                 webhook_url=None, webhook_secret='whsec_example', webhook_delay=0.5):
+        super().__init__(address, FakeStripeHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.webhook_delay = webhook_delay
+        self.event_counter = itertools.count(1)
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+        self.intents = {}
+        self.intents_by_key = {}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def complete_payment(self, intent_id):
+        """Mark an intent as succeeded and post the signed event to ``webhook_url``"""
+        from src.models.ecommerce.payments import sign_webhook
+
+        with self.lock:
+            intent = self.intents[intent_id]
+            intent['status'] = 'succeeded'
+            event = {
+                'id': 'evt_fake_%d' % next(self.event_counter),
+                'object': 'event',
+                'type': 'payment_intent.succeeded',
+                'created': int(time.time()),
+                'data': {'object': dict(intent)}
+            }
+        payload = json.dumps(event).encode('utf-8')
+        request = Request(self.webhook_url, data=payload, method='POST', headers={
+            'Content-Type': 'application/json',
+            'Stripe-Signature': sign_webhook(payload, self.webhook_secret)
+        })
+        try:
+            urlopen(request, timeout=10).close()
+        except OSError:
+            pass  # Stripe would retry later; the fake just drops it
+
+    def start(self):
+        """Serve from a daemon thread and return ``self``"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def bench(gateway, requests=200, concurrency=16):
+    """Create ``requests`` intents with ``concurrency`` threads and return latency stats in ms"""
+    def timed(order_id):
+        started = time.perf_counter()
+        gateway.create_intent(order_id, 1999)
+        return (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(timed, range(1, requests + 1)))
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'throughput_rps': round(requests / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies), 2),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['serve', 'bench'])
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--latency', type=float, default=0.1, help='Seconds added to every request')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of requests answered with 503')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--webhook-url', help='Post signed payment_intent.succeeded events here')
+    parser.add_argument('--webhook-secret', default='whsec_example')
+    args = parser.parse_args()
+
+    server = FakeStripeServer(('127.0.0.1', args.port), args.latency, args.failure_rate,
+                              webhook_url=args.webhook_url, webhook_secret=args.webhook_secret)
+    if args.command == 'serve':
+        print(f'Fake Stripe API listening on {server.url}')
+        server.serve_forever()
+        return
+
+    from src.models.ecommerce.payments import StripeGateway
+
+    server.start()
+    gateway = StripeGateway('sk_test_fake', base_url=server.url, pool_size=args.concurrency)
+    print(json.dumps(bench(gateway, args.requests, args.concurrency), indent=2))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
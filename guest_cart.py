@@ -0,0 +1,168 @@
+"""Guest carts kept in a signed cookie.
+
+Visitors who are not signed in keep their cart in the browser instead of in
+``cart_items``: a list of ``[book_id, quantity]`` pairs signed with the app's
+``SECRET_KEY`` through ``itsdangerous``, which zlib-compresses the payload
+whenever that makes it shorter. Adding, changing and reading a guest cart
+never writes to the database, and pricing it reads books from the catalog
+cache under keys tied to the catalog version token, so a price change made
+through the admin routes shows up on the next request once the cache is
+shared (``CATALOG_CACHE_REDIS_URL``); with the in-process cache other
+workers keep the old price until their entries expire.
+
+Guest lines have no row id, so the book id doubles as the line id the cart
+routes take as ``cart_item_id``. A guest cart is merged into the user's
+``cart_items`` with one bulk upsert (``CartItem.merge``) when the user signs
+in (``POST /api/cart/merge``) or checks out; a guest who checks out without
+signing in gets an order with no user, priced from the cookie alone. Guest carts are off when the app has no ``SECRET_KEY`` or
+``GUEST_CARTS`` is false.
+"""
+from collections import OrderedDict
+
+from flask import current_app, request
+from itsdangerous import BadSignature, URLSafeSerializer
+from src.models.ecommerce.cart import BATCH_OPERATIONS, CartItem
+from src.models.ecommerce.catalog_cache import cached_books
+
+COOKIE_NAME = 'guest_cart'
+COOKIE_MAX_AGE = 30 * 24 * 3600
+COOKIE_SALT = 'guest-cart'
+
+# Keeps the signed cookie well under the 4 KB browsers accept
+MAX_GUEST_LINES = 50
+
+
+def guest_carts_enabled():
+    return bool(current_app.secret_key) and current_app.config.get('GUEST_CARTS', True)
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.secret_key, salt=COOKIE_SALT)
+
+
+def load_guest_cart():
+    """Return the request's guest cart as an ordered ``{book_id: quantity}``
+
+    A missing, tampered or unreadable cookie is an empty cart.
+    """
+    raw = request.cookies.get(COOKIE_NAME)
+    if not raw:
+        return OrderedDict()
+    try:
+        return OrderedDict((int(book_id), int(quantity)) for book_id, quantity in _serializer().loads(raw))
+    except (BadSignature, TypeError, ValueError):
+        return OrderedDict()
+
+
+def save_guest_cart(response, lines):
+    """Store ``lines`` in the guest cart cookie of ``response``, dropping the cookie when empty"""
+    if not lines:
+        return clear_guest_cart(response)
+    response.set_cookie(
+        COOKIE_NAME,
+        _serializer().dumps([[book_id, quantity] for book_id, quantity in lines.items()]),
+        max_age=COOKIE_MAX_AGE,
+        secure=request.is_secure,
+        httponly=True,
+        samesite='Lax'
+    )
+    return response
+
+
+def clear_guest_cart(response):
+    response.delete_cookie(COOKIE_NAME, secure=request.is_secure, httponly=True, samesite='Lax')
+    return response
+
+
+def price_guest_cart(lines):
+    """Build the same cart payload the signed-in routes return for guest ``lines``
+
+    Lines whose book no longer exists are removed from ``lines``.
+    """
+    books = cached_books(list(lines))
+    for book_id in [book_id for book_id in lines if book_id not in books]:
+        del lines[book_id]
+
+    cart_items = [{
+        'id': book_id,
+        'user_id': None,
+        'book_id': book_id,
+        'book': books[book_id],
+        'quantity': quantity,
+        'created_at': None,
+        'updated_at': None
+    } for book_id, quantity in lines.items()]
+
+    return {
+        'cart_items': cart_items,
+        'total': sum(item['book']['price'] * item['quantity'] for item in cart_items),
+        'item_count': len(cart_items),
+        'quantity': sum(item['quantity'] for item in cart_items)
+    }
+
+
+def apply_guest_operations(lines, operations):
+    """Return guest ``lines`` with add/update/remove ``operations`` applied
+
+    Takes the same operations as ``CartItem.apply_batch``, with the book id
+    as ``cart_item_id``. Raises ``ValueError`` for an invalid operation, a
+    quantity below 1, an unknown book or a cart over ``MAX_GUEST_LINES``
+    titles.
+    """
+    wanted = OrderedDict(lines)
+    for index, operation in enumerate(operations):
+        op = operation.get('op') if isinstance(operation, dict) else None
+        if op not in BATCH_OPERATIONS:
+            raise ValueError(f'Operation {index}: op must be one of {", ".join(BATCH_OPERATIONS)}')
+
+        if 'book_id' in operation:
+            try:
+                book_id = int(operation['book_id'])
+            except (TypeError, ValueError):
+                raise ValueError(f'Operation {index}: book_id must be an integer')
+        else:
+            # Guest lines are keyed by book id, so a cart item id is one
+            try:
+                book_id = int(operation.get('cart_item_id'))
+            except (TypeError, ValueError):
+                raise ValueError(f'Operation {index}: cart item not found')
+            if book_id not in lines:
+                raise ValueError(f'Operation {index}: cart item not found')
+
+        if op == 'remove':
+            wanted[book_id] = 0
+            continue
+        try:
+            quantity = int(operation['quantity'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f'Operation {index}: quantity must be an integer')
+        if quantity < 1:
+            raise ValueError(f'Operation {index}: quantity must be at least 1; use remove to drop a line')
+        if op == 'add':
+            wanted[book_id] = wanted.get(book_id, 0) + quantity
+        else:
+            wanted[book_id] = quantity
+
+    wanted = OrderedDict((book_id, quantity) for book_id, quantity in wanted.items() if quantity > 0)
+    if len(wanted) > MAX_GUEST_LINES:
+        raise ValueError(f'Guest carts hold at most {MAX_GUEST_LINES} titles; sign in to add more')
+
+    new_books = [book_id for book_id in wanted if book_id not in lines]
+    if new_books:
+        missing = sorted(set(new_books) - set(cached_books(new_books)))
+        if missing:
+            raise ValueError(f'Book not found: {", ".join(map(str, missing))}')
+    return wanted
+
+
+def merge_guest_cart(user_id, lines=None):
+    """Add the guest cart to ``user_id``'s cart and return the number of lines merged
+
+    Does not commit; clear the cookie with ``clear_guest_cart`` once the
+    merge is committed.
+    """
+    if lines is None:
+        lines = load_guest_cart() if guest_carts_enabled() else None
+    if not lines:
+        return 0
+    return CartItem.merge(user_id, lines)
@@ -0,0 +1,144 @@
+"""Gunicorn settings for production.
+
+Everything can be overridden from the environment so the same file serves
+every deploy target:
+
+``GUNICORN_WORKER_MODE``
+    ``gthread`` (default) runs a few processes with a thread pool each, which
+    suits this app: requests block on the database and the payment API, not
+    on CPU. ``gevent`` runs cooperative greenlets and needs the ``gevent``
+    package; use it when most time is spent waiting on slow upstreams.
+    ``sync`` is the classic one-request-per-process worker, kept for
+    comparison in ``loadtest.py``.
+``WEB_CONCURRENCY``
+    Worker processes, ``2 * CPUs + 1`` by default for ``sync`` and
+    ``CPUs + 1`` for the threaded and async modes, which get their
+    concurrency from ``GUNICORN_THREADS`` or ``GUNICORN_WORKER_CONNECTIONS``
+    instead.
+
+``WEBHOOK_WORKER``
+    ``1`` (default) runs ``flask order process-webhooks`` next to the
+    workers, since the webhook queue is a file on this host. The master
+    restarts it whenever it exits, backing off if it keeps crashing.
+
+The app is loaded once in the master (``preload_app``) and warmed there, so
+compiled templates and the in-process catalog cache are shared copy-on-write
+by every worker instead of being rebuilt per fork. ``GUNICORN_PRELOAD=0``
+turns that off, and it is off by default for ``gevent``: gevent patches
+``threading``, ``socket`` and ``ssl`` only once the worker starts, so an app
+imported before then keeps blocking locks and sockets. With
+``GUNICORN_PRELOAD=1`` under ``gevent`` this file monkey-patches the master
+before anything else is imported instead.
+"""
+import os
+
+worker_mode = os.environ.get('GUNICORN_WORKER_MODE', 'gthread')
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0' if worker_mode == 'gevent' else '1') == '1'
+if worker_mode == 'gevent' and preload_app:
+    from gevent import monkey
+    monkey.patch_all()
+
+import multiprocessing  # noqa: E402
+import random  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import threading  # noqa: E402
+import time  # noqa: E402
+
+cpus = multiprocessing.cpu_count()
+
+if worker_mode not in ('gthread', 'gevent', 'sync'):
+    raise ValueError(f'Unsupported GUNICORN_WORKER_MODE: {worker_mode}')
+
+bind = os.environ.get('GUNICORN_BIND', f'0.0.0.0:{os.environ.get("PORT", "8000")}')
+worker_class = worker_mode
+workers = int(os.environ.get('WEB_CONCURRENCY', 2 * cpus + 1 if worker_mode == 'sync' else cpus + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8)) if worker_mode == 'gthread' else 1
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 500))
+
+# Recycle workers now and then to bound slow leaks; the jitter keeps them
+# from all restarting at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', max_requests // 10))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-') or None
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+# Workers report not ready on /readyz until warm_up has run
+raw_env = ['REQUIRE_WARMUP=1']
+
+webhook_worker = os.environ.get('WEBHOOK_WORKER', '1') == '1'
+# A webhook worker that ran this long before exiting restarts without delay
+WEBHOOK_WORKER_HEALTHY_RUN = 60
+WEBHOOK_WORKER_MAX_BACKOFF = 60
+
+_webhook_process = None
+_webhook_stopping = threading.Event()
+
+
+def _supervise_webhook_worker(server):
+    """Keep ``flask order process-webhooks`` running for as long as the master is"""
+    global _webhook_process
+    backoff = 1
+    while not _webhook_stopping.is_set():
+        started = time.monotonic()
+        _webhook_process = subprocess.Popen([
+            sys.executable, '-m', 'flask', '--app', server.app.app_uri, 'order', 'process-webhooks'
+        ])
+        server.log.info('Started webhook worker (pid %s)', _webhook_process.pid)
+        code = _webhook_process.wait()
+        if _webhook_stopping.is_set():
+            return
+        if time.monotonic() - started >= WEBHOOK_WORKER_HEALTHY_RUN:
+            backoff = 1
+        server.log.error('Webhook worker exited with status %s, restarting in %ss', code, backoff)
+        _webhook_stopping.wait(backoff)
+        backoff = min(backoff * 2, WEBHOOK_WORKER_MAX_BACKOFF)
+
+
+def when_ready(server):
+    """Warm the preloaded app in the master so workers inherit a hot process"""
+    if preload_app:
+        from src.server import warm_up
+        warm_up(server.app.wsgi())
+        server.log.info('Application warmed before forking workers')
+    if webhook_worker:
+        threading.Thread(
+            target=_supervise_webhook_worker, args=(server,), name='webhook-supervisor', daemon=True
+        ).start()
+
+
+def on_exit(server):
+    """Stop the webhook worker with the server"""
+    _webhook_stopping.set()
+    if _webhook_process is not None and _webhook_process.poll() is None:
+        _webhook_process.terminate()
+        try:
+            _webhook_process.wait(timeout=graceful_timeout)
+        except subprocess.TimeoutExpired:
+            # A worker stuck in a delivery must not keep the master from exiting
+            server.log.warning('Webhook worker did not stop in %ss; killing it', graceful_timeout)
+            _webhook_process.kill()
+            _webhook_process.wait()
+
+
+def post_worker_init(worker):
+    """Without preload every worker loads, and so warms, its own copy of the app"""
+    if not preload_app:
+        # Imported here so the master never loads the app before gevent patches it
+        from src.server import warm_up
+        warm_up(worker.wsgi)
+
+
+def post_fork(server, worker):
+    """Give each worker its own random state and database connections"""
+    random.seed()
+    if preload_app:
+        # Sockets opened by the master must never be shared across processes
+        from src.database import dispose_engines
+        dispose_engines(server.app.wsgi())
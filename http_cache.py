@@ -0,0 +1,74 @@
+"""Conditional GET support for catalog routes.
+
+Catalog responses carry a weak ETag and ``Last-Modified``. A single book's
+come from its ``updated_at``, read by primary key. A listing's come from the
+catalog version token, which every catalog write bumps through
+``invalidate_book`` or the importer, so edits, additions and deletions all
+produce a new tag without an aggregate over the table. Routes answer
+``If-None-Match``/``If-Modified-Since`` with a 304 before any row is loaded
+or serialized.
+"""
+import zlib
+from datetime import datetime, timezone
+
+from flask import Response, request
+from src.database import read_query
+from src.models.ecommerce.book import Book
+from src.models.ecommerce.catalog_cache import CATALOG_VERSION, data_versions
+
+# Cache-Control per route family: how long clients and CDNs may reuse a
+# response before revalidating it
+CACHE_POLICIES = {
+    'book': 'public, max-age=300, stale-while-revalidate=60',
+    'listing': 'public, max-age=60, stale-while-revalidate=30',
+    'search': 'public, max-age=30',
+    'page': 'public, max-age=30, stale-while-revalidate=300',
+}
+
+
+def _version(value):
+    """Microsecond timestamp of ``value`` so that quick successive edits get distinct tags"""
+    return int(value.replace(tzinfo=timezone.utc).timestamp() * 1000000) if value else 0
+
+
+def book_validators(book_id):
+    """Return ``(etag, last_modified)`` for one book, or ``None`` if it does not exist"""
+    row = read_query(Book, CATALOG_VERSION).with_entities(Book.updated_at).filter(Book.id == book_id).first()
+    if row is None:
+        return None
+    return f'book-{book_id}-{_version(row[0])}', row[0]
+
+
+def listing_validators(variant='books'):
+    """Return ``(etag, last_modified)`` for a catalog listing
+
+    Both come from the catalog version token, so this is one cache read and
+    no query. ``variant`` distinguishes responses built from the same rows in
+    different shapes, such as another filter, page or field selection.
+    """
+    token = data_versions(CATALOG_VERSION)[0]
+    last_modified = datetime.fromtimestamp(int(token.rsplit('-', 1)[1]), timezone.utc).replace(tzinfo=None)
+    return '%08x-%s' % (zlib.crc32(variant.encode('utf-8')), token), last_modified
+
+
+def is_not_modified(etag, last_modified=None):
+    """Whether the client's cached copy matching these validators is still current"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= request.if_modified_since
+    return False
+
+
+def apply_validators(response, etag, last_modified=None, policy='listing'):
+    """Attach the ETag, Last-Modified and Cache-Control headers to ``response``"""
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    response.headers['Cache-Control'] = CACHE_POLICIES[policy]
+    return response
+
+
+def not_modified(etag, last_modified=None, policy='listing'):
+    """Build an empty 304 response carrying the current validators"""
+    return apply_validators(Response(status=304), etag, last_modified, policy)
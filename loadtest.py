@@ -0,0 +1,133 @@
+"""Load test harness comparing gunicorn worker modes.
+
+Starts gunicorn with ``gunicorn.conf.py`` once per worker mode, waits for
+``/readyz``, then drives the listed paths with a pool of keep-alive client
+threads and reports throughput and latency percentiles per mode::
+
+    python loadtest.py --modes sync gthread gevent --requests 2000 --concurrency 64
+    python loadtest.py --url http://127.0.0.1:8000 --paths /api/books /api/books/featured
+
+With ``--url`` the server at that address is measured as is and no gunicorn
+is started.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+DEFAULT_PATHS = ('/', '/api/books', '/api/books/featured', '/api/cart/summary')
+
+
+def _percentile(ordered, share):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def wait_until_ready(base_url, timeout=30.0):
+    """Poll ``/readyz`` until it answers 200, raising ``TimeoutError`` after ``timeout`` seconds"""
+    parts = urlsplit(base_url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=1)
+            conn.request('GET', '/readyz')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f'{base_url} was not ready after {timeout} seconds')
+
+
+def run_load(base_url, paths=DEFAULT_PATHS, requests=2000, concurrency=32):
+    """Issue ``requests`` GETs round-robin over ``paths`` and return latency stats in ms"""
+    parts = urlsplit(base_url)
+    local = threading.local()
+    counter = itertools.count()
+    errors = []
+
+    def timed(_):
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+        path = paths[next(counter) % len(paths)]
+        started = time.perf_counter()
+        try:
+            conn.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 500:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            conn.close()
+            local.conn = None
+        return (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(timed, range(requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'throughput_rps': round(requests / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies), 2),
+        'p95_ms': round(_percentile(latencies, 0.95), 2),
+        'p99_ms': round(_percentile(latencies, 0.99), 2)
+    }
+
+
+def run_mode(mode, port, paths, requests, concurrency, env=None):
+    """Start gunicorn in ``mode`` on ``port``, load it, stop it and return the stats"""
+    env = dict(os.environ, **(env or {}), GUNICORN_WORKER_MODE=mode, GUNICORN_ACCESS_LOG='')
+    bind = f'127.0.0.1:{port}'
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', '--bind', bind, 'main:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        base_url = f'http://{bind}'
+        wait_until_ready(base_url)
+        run_load(base_url, paths, min(requests, 100), concurrency)  # Warm connections and caches
+        return dict(run_load(base_url, paths, requests, concurrency), mode=mode)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', default=['sync', 'gthread', 'gevent'])
+    parser.add_argument('--paths', nargs='+', default=list(DEFAULT_PATHS))
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--url', help='Measure an already running server instead')
+    args = parser.parse_args()
+
+    if args.url:
+        wait_until_ready(args.url)
+        print(json.dumps(run_load(args.url, args.paths, args.requests, args.concurrency), indent=2))
+        return
+
+    results = [
+        run_mode(mode, args.port + offset, args.paths, args.requests, args.concurrency)
+        for offset, mode in enumerate(args.modes)
+    ]
+    print(f'{"mode":<10}{"rps":>10}{"p50":>10}{"p95":>10}{"p99":>10}{"errors":>8}')
+    for result in results:
+        print(f'{result["mode"]:<10}{result["throughput_rps"]:>10}{result["p50_ms"]:>10}'
+              f'{result["p95_ms"]:>10}{result["p99_ms"]:>10}{result["errors"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
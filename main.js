@@ -5,7 +5,7 @@
 let cart = [];
 let books = [];
 let currentUser = {
-    id: 1, // Default user ID for demo
+    id: null, // Guests keep their cart in a signed cookie until they sign in
     name: 'Guest User'
 };
 
@@ -23,8 +23,12 @@ function initApp() {
     // Load books from API
     fetchBooks();
     
-    // Load cart from API
-    fetchCart();
+    // Load the full cart only where it is displayed, otherwise just the badge
+    if (document.getElementById('cart-items')) {
+        fetchCart();
+    } else {
+        fetchCartSummary();
+    }
     
     // Check if user is logged in
     checkUserSession();
@@ -129,10 +133,18 @@ function createBookElement(book) {
     return bookElement;
 }
 
+// Add the signed-in user's id to an API URL; guests are identified by their cart cookie
+function withUser(url) {
+    if (currentUser.id === null) {
+        return url;
+    }
+    return `${url}${url.includes('?') ? '&' : '?'}user_id=${currentUser.id}`;
+}
+
 // Fetch cart from API
 async function fetchCart() {
     try {
-        const response = await fetch(`/api/cart?user_id=${currentUser.id}`);
+        const response = await fetch(withUser('/api/cart'));
         const data = await response.json();
         
         if (data.success) {
@@ -146,10 +158,29 @@ async function fetchCart() {
     }
 }
 
+// Fetch cart count for the header badge
+async function fetchCartSummary() {
+    try {
+        const response = await fetch(withUser('/api/cart/summary'));
+        const data = await response.json();
+        
+        if (data.success) {
+            const cartCount = document.getElementById('cart-count');
+            if (cartCount) {
+                cartCount.textContent = data.quantity;
+            }
+        } else {
+            console.error('Failed to fetch cart summary:', data.message);
+        }
+    } catch (error) {
+        console.error('Error fetching cart summary:', error);
+    }
+}
+
 // Add item to cart
 async function addToCart(bookId, quantity = 1) {
     try {
-        const response = await fetch('/api/cart/add', {
+        const response = await fetch('/api/cart/add?include_cart=1', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -164,8 +195,9 @@ async function addToCart(bookId, quantity = 1) {
         const data = await response.json();
         
         if (data.success) {
-            // Refresh cart
-            fetchCart();
+            // The response carries the updated cart
+            cart = data.cart_items;
+            updateCartUI();
             
             // Show success message
             showNotification('Book added to cart!', 'success');
@@ -182,12 +214,13 @@ async function addToCart(bookId, quantity = 1) {
 // Update cart quantity
 async function updateCartQuantity(cartItemId, quantity) {
     try {
-        const response = await fetch('/api/cart/update', {
+        const response = await fetch('/api/cart/update?include_cart=1', {
             method: 'PUT',
             headers: {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
+                user_id: currentUser.id,
                 cart_item_id: cartItemId,
                 quantity: quantity
             })
@@ -196,8 +229,9 @@ async function updateCartQuantity(cartItemId, quantity) {
         const data = await response.json();
         
         if (data.success) {
-            // Refresh cart
-            fetchCart();
+            // The response carries the updated cart
+            cart = data.cart_items;
+            updateCartUI();
         } else {
             console.error('Failed to update cart:', data.message);
             showNotification('Failed to update cart.', 'error');
@@ -211,15 +245,16 @@ async function updateCartQuantity(cartItemId, quantity) {
 // Remove item from cart
 async function removeFromCart(cartItemId) {
     try {
-        const response = await fetch(`/api/cart/remove/${cartItemId}`, {
+        const response = await fetch(withUser(`/api/cart/remove/${cartItemId}?include_cart=1`), {
             method: 'DELETE'
         });
         
         const data = await response.json();
         
         if (data.success) {
-            // Refresh cart
-            fetchCart();
+            // The response carries the updated cart
+            cart = data.cart_items;
+            updateCartUI();
             
             // Show success message
             showNotification('Item removed from cart.', 'success');
@@ -308,6 +343,17 @@ function updateCartUI() {
     }
 }
 
+// Idempotency key for the checkout in progress, so a retried or
+// double-submitted checkout never creates a second order
+function checkoutKey() {
+    let key = sessionStorage.getItem('checkoutKey');
+    if (!key) {
+        key = Date.now().toString(36) + Math.random().toString(36).slice(2);
+        sessionStorage.setItem('checkoutKey', key);
+    }
+    return key;
+}
+
 // Process checkout
 async function processCheckout() {
     // Get form data
@@ -320,11 +366,12 @@ async function processCheckout() {
     }
     
     try {
-        // Create order
-        const orderResponse = await fetch('/api/checkout', {
+        // Create the order and its payment intent in one request
+        const response = await fetch('/api/checkout/pay', {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': 'application/json',
+                'Idempotency-Key': checkoutKey()
             },
             body: JSON.stringify({
                 user_id: currentUser.id,
@@ -333,56 +380,18 @@ async function processCheckout() {
             })
         });
         
-        const orderData = await orderResponse.json();
-        
-        if (!orderData.success) {
-            showNotification('Failed to create order: ' + orderData.message, 'error');
-            return;
-        }
-        
-        const order = orderData.order;
-        
-        // Create payment intent
-        const paymentResponse = await fetch('/api/payment/create-intent', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                order_id: order.id
-            })
-        });
-        
-        const paymentData = await paymentResponse.json();
+        const data = await response.json();
         
-        if (!paymentData.success) {
-            showNotification('Failed to process payment: ' + paymentData.message, 'error');
+        if (!data.success) {
+            showNotification('Failed to process checkout: ' + data.message, 'error');
             return;
         }
         
-        // In a real application, we would use Stripe.js to handle payment
-        // For this demo, we'll simulate a successful payment
-        
-        // Confirm payment
-        const confirmResponse = await fetch('/api/payment/confirm', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                order_id: order.id,
-                payment_id: 'demo_payment_' + Date.now()
-            })
-        });
-        
-        const confirmData = await confirmResponse.json();
-        
-        if (confirmData.success) {
-            // Redirect to order confirmation page
-            window.location.href = `/order-confirmation?order_id=${order.id}`;
-        } else {
-            showNotification('Failed to confirm payment: ' + confirmData.message, 'error');
-        }
+        // In a real application, Stripe.js would confirm the card payment with
+        // data.clientSecret here. Payment is recorded by the server's webhook,
+        // so there is nothing left to post back.
+        sessionStorage.removeItem('checkoutKey');
+        window.location.href = `/order-confirmation?order_id=${data.order.id}`;
     } catch (error) {
         console.error('Error processing checkout:', error);
         showNotification('Error processing checkout.', 'error');
@@ -459,3 +468,29 @@ function checkUserSession() {
         userInfo.textContent = currentUser.name;
     }
 }
+
+// Move the guest cart into the user's cart; call once a user has signed in
+async function mergeGuestCart() {
+    try {
+        const response = await fetch('/api/cart/merge', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                user_id: currentUser.id
+            })
+        });
+        
+        const data = await response.json();
+        
+        if (data.success) {
+            cart = data.cart_items;
+            updateCartUI();
+        } else {
+            console.error('Failed to merge guest cart:', data.message);
+        }
+    } catch (error) {
+        console.error('Error merging guest cart:', error);
+    }
+}
@@ -1,11 +1,39 @@
 
+import os
+
 from flask import Flask, render_template
+from src.assets import init_assets
+from src.database import init_database, read_query
+from src.metrics import init_metrics
+from src.migrations import init_app as init_migrations
+from src.models.ecommerce.book import Book
+from src.models.ecommerce.catalog_cache import FEATURED_VERSION
+from src.page_cache import cached_page, init_page_cache
+from src.server import init_server
+from src.static_site import init_static_site
+
+# Featured titles shown in the homepage grid
+HOME_FEATURED_LIMIT = 4
 
 app = Flask(__name__)
+# Signs the guest cart cookie; guest carts are disabled without it
+app.secret_key = os.environ.get("SECRET_KEY")
+init_database(app)
+init_metrics(app)
+init_migrations(app)
+init_assets(app)
+init_page_cache(app)
+init_server(app)
+init_static_site(app)
+
+def render_home():
+    featured_books = read_query(Book, FEATURED_VERSION).filter_by(featured=True).order_by(Book.id).limit(HOME_FEATURED_LIMIT).all()
+    return render_template("index.html", featured_books=featured_books)
 
 @app.route("/")
 def home():
-    return render_template("index.html")
+    # Rendered once per featured-books version, then served from the page cache
+    return cached_page("index.html", render_home, versions=(FEATURED_VERSION,))
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1")
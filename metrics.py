@@ -0,0 +1,271 @@
+"""Request-level performance metrics.
+
+Every request is measured as a whole and broken down into time spent in SQL
+(via cursor execute events on every engine) and in JSON serialization (via
+the app's JSON provider and ``serializers.on_encode``). The results go into per-endpoint histograms and
+counters, and into a ``Server-Timing`` header so browser dev tools and
+synthetic checks can see where a slow response spent its time::
+
+    Server-Timing: db;dur=12.41;desc="3 queries", serialize;dur=1.20, app;dur=18.02
+
+``/metrics`` serves the histograms, counters and the connection pool
+statistics from ``database.pool_status`` in the Prometheus text format.
+Metrics are kept per process, so with several gunicorn workers each scrape
+reports the worker that answered it; add the worker count to queries, or
+scrape workers individually, when exact totals matter.
+
+Streamed responses are recorded once their body has been sent, so rows
+fetched and encoded while streaming count too; their ``Server-Timing``
+header can only cover the work done before the body starts.
+"""
+import threading
+import time
+from bisect import bisect_left
+from functools import partial
+
+from flask import Response, current_app, g, has_app_context, request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from src.database import WAIT_BUCKETS_MS, pool_status
+from src.models.ecommerce.serializers import on_encode
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Counter:
+    """Monotonic counter keyed by label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{_labels(self.labels, key)} {value}' for key, value in items]
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket bounds, keyed by label values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self._lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket in zip([*self.buckets, '+Inf'], counts):
+                cumulative += bucket
+                le = 'le="%s"' % bound
+                lines.append(f'{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {count}')
+        return lines
+
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time to produce a response', LATENCY_BUCKETS, ('endpoint', 'method')
+)
+REQUESTS = Counter('http_requests_total', 'Responses sent', ('endpoint', 'method', 'status'))
+RESPONSE_BYTES = Histogram('http_response_bytes', 'Response body size on the wire', SIZE_BUCKETS, ('endpoint',))
+DB_QUERIES = Histogram('db_queries_per_request', 'SQL statements per request', QUERY_COUNT_BUCKETS, ('endpoint',))
+DB_TIME = Histogram('db_duration_seconds', 'Time spent in SQL per request', LATENCY_BUCKETS, ('endpoint',))
+SERIALIZE_TIME = Histogram(
+    'serialization_duration_seconds', 'Time spent encoding JSON per request', LATENCY_BUCKETS, ('endpoint',)
+)
+
+METRICS = (REQUEST_LATENCY, REQUESTS, RESPONSE_BYTES, DB_QUERIES, DB_TIME, SERIALIZE_TIME)
+
+
+class RequestTimings:
+    """Time spent in each phase of the current request"""
+
+    __slots__ = ('started', 'queries', 'db', 'serialize')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.serialize = 0.0
+
+
+def _current_timings():
+    return g.get('_timings') if has_app_context() else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['_query_started'].pop()
+    timings = _current_timings()
+    if timings is not None:
+        timings.queries += 1
+        timings.db += time.perf_counter() - started
+
+
+def _handle_error(context):
+    # Failed statements never reach after_cursor_execute
+    if context.connection is not None and context.connection.info.get('_query_started'):
+        context.connection.info['_query_started'].pop()
+
+
+def _add_serialize_time(seconds):
+    timings = _current_timings()
+    if timings is not None:
+        timings.serialize += seconds
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """JSON provider that adds encoding time to the current request's timings"""
+
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            _add_serialize_time(time.perf_counter() - started)
+
+
+def _start_timer():
+    g._timings = RequestTimings()
+
+
+def _observe(timings, endpoint, method, status, size=None):
+    REQUEST_LATENCY.observe(time.perf_counter() - timings.started, endpoint, method)
+    REQUESTS.inc(endpoint, method, status)
+    DB_QUERIES.observe(timings.queries, endpoint)
+    DB_TIME.observe(timings.db, endpoint)
+    SERIALIZE_TIME.observe(timings.serialize, endpoint)
+    if size is not None:
+        RESPONSE_BYTES.observe(size, endpoint)
+
+
+def record_response(response):
+    """Record the finished request and attach its ``Server-Timing`` header"""
+    timings = g.get('_timings')
+    if timings is None:
+        return response
+    elapsed = time.perf_counter() - timings.started
+    endpoint = request.endpoint or 'unmatched'
+
+    if response.is_streamed:
+        # Timings stay on ``g`` for the body's generator and are recorded when it is done
+        response.call_on_close(partial(
+            _observe, timings, endpoint, request.method, str(response.status_code)))
+    else:
+        g.pop('_timings')
+        _observe(timings, endpoint, request.method, str(response.status_code),
+                 response.calculate_content_length() or 0)
+
+    if current_app.config.get('SERVER_TIMING', True):
+        response.headers.add('Server-Timing', ', '.join((
+            f'db;dur={timings.db * 1000:.2f};desc="{timings.queries} queries"',
+            f'serialize;dur={timings.serialize * 1000:.2f}',
+            f'app;dur={elapsed * 1000:.2f}'
+        )))
+    return response
+
+
+def _pool_lines():
+    lines = []
+    gauges = {
+        'size': 'db_pool_size',
+        'checked_out': 'db_pool_checked_out',
+        'idle': 'db_pool_idle',
+        'overflow': 'db_pool_overflow'
+    }
+    pools = pool_status()
+    for field, name in gauges.items():
+        lines.append(f'# TYPE {name} gauge')
+        lines.extend(f'{name}{_labels(("pool",), (pool,))} {entry[field]}'
+                     for pool, entry in pools.items() if field in entry)
+
+    timed = {pool: entry for pool, entry in pools.items() if 'checkouts' in entry}
+    lines.append('# TYPE db_pool_timeouts_total counter')
+    lines.extend(f'db_pool_timeouts_total{{pool="{_escape(pool)}"}} {entry["timeouts"]}' for pool, entry in timed.items())
+    lines.append('# HELP db_pool_wait_seconds Time spent waiting for a pooled connection')
+    lines.append('# TYPE db_pool_wait_seconds histogram')
+    for pool, entry in timed.items():
+        cumulative = 0
+        buckets = entry['wait_buckets_ms']
+        for bound in [*map(str, WAIT_BUCKETS_MS), '+Inf']:
+            cumulative += buckets[bound]
+            le = bound if bound == '+Inf' else int(bound) / 1000
+            lines.append(f'db_pool_wait_seconds_bucket{{pool="{_escape(pool)}",le="{le}"}} {cumulative}')
+        lines.append(f'db_pool_wait_seconds_sum{{pool="{_escape(pool)}"}} {entry["wait_total_ms"] / 1000}')
+        lines.append(f'db_pool_wait_seconds_count{{pool="{_escape(pool)}"}} {entry["checkouts"]}')
+    return lines
+
+
+def metrics_route():
+    """Prometheus scrape endpoint"""
+    lines = []
+    for metric in METRICS:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.render())
+    if 'sqlalchemy' in current_app.extensions:
+        lines.extend(_pool_lines())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+def init_metrics(app):
+    """Instrument every request of ``app`` and serve ``/metrics``
+
+    Register before other ``after_request`` hooks, such as response
+    compression, so response sizes are measured as sent.
+    """
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+    app.json = TimedJSONProvider(app)
+    on_encode(_add_serialize_time)
+    app.before_request(_start_timer)
+    app.after_request(record_response)
+    app.add_url_rule('/metrics', 'metrics', metrics_route)
@@ -0,0 +1,271 @@
+"""Versioned schema migrations for the e-commerce tables.
+
+Migrations are plain functions registered with ``@migration(version, ...)``
+and applied in version order by ``upgrade``; applied versions are recorded in
+``schema_migrations``. Every step is written to be safe on a database that
+``db.create_all()`` already built from the current models, so fresh installs
+and upgraded ones converge on the same schema.
+
+``check_query_plans`` EXPLAINs the queries behind the hot routes, with their
+parameters bound as the app sends them, and reports any that would fall back
+to a full table scan. Run it in CI with ``flask check-query-plans``; it exits
+non-zero on a regression.
+"""
+import json
+from collections import namedtuple
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import MetaData, inspect, text
+from sqlalchemy.schema import CreateTable
+from src.models.user import db
+from src.models.ecommerce.book import Book
+from src.models.ecommerce.cart import CartItem
+from src.models.ecommerce.order import Order, OrderItem
+from src.models.ecommerce.payments import PaymentJob
+from src.models.ecommerce.search import create_search_structures
+
+Migration = namedtuple('Migration', ['version', 'description', 'upgrade'])
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register the decorated ``upgrade(conn)`` function as migration ``version``"""
+    def decorator(upgrade):
+        if any(existing.version == version for existing in MIGRATIONS):
+            raise ValueError(f'Duplicate migration version: {version}')
+        MIGRATIONS.append(Migration(version, description, upgrade))
+        MIGRATIONS.sort(key=lambda item: item.version)
+        return upgrade
+    return decorator
+
+
+@migration(1, 'Add orders.idempotency_key')
+def add_order_idempotency_key(conn):
+    columns = {column['name'] for column in inspect(conn).get_columns('orders')}
+    if 'idempotency_key' not in columns:
+        conn.execute(text('ALTER TABLE orders ADD COLUMN idempotency_key VARCHAR(64)'))
+    conn.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_orders_idempotency_key ON orders (idempotency_key)'
+    ))
+
+
+@migration(2, 'Merge duplicate cart lines and make (user_id, book_id) unique')
+def unique_cart_lines(conn):
+    # Fold every duplicate line into the oldest one before the unique index goes on
+    conn.execute(text(
+        'UPDATE cart_items SET quantity = ('
+        ' SELECT SUM(other.quantity) FROM cart_items other'
+        ' WHERE other.user_id = cart_items.user_id AND other.book_id = cart_items.book_id'
+        ') WHERE id IN ('
+        ' SELECT MIN(id) FROM cart_items GROUP BY user_id, book_id HAVING COUNT(*) > 1'
+        ')'
+    ))
+    conn.execute(text(
+        'DELETE FROM cart_items WHERE id NOT IN ('
+        ' SELECT keep.id FROM (SELECT MIN(id) AS id FROM cart_items GROUP BY user_id, book_id) keep'
+        ')'
+    ))
+    conn.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_cart_items_user_book ON cart_items (user_id, book_id)'
+    ))
+
+
+@migration(3, 'Index the predicates used by the catalog, cart and order routes')
+def index_hot_predicates(conn):
+    featured = 'featured' if conn.dialect.name == 'postgresql' else 'featured = 1'
+    for statement in (
+        'CREATE INDEX IF NOT EXISTS ix_books_category ON books (category)',
+        'CREATE INDEX IF NOT EXISTS ix_books_created_at_id ON books (created_at, id)',
+        f'CREATE INDEX IF NOT EXISTS ix_books_featured ON books (id) WHERE {featured}',
+        'CREATE INDEX IF NOT EXISTS ix_orders_user_id_created_at ON orders (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS ix_order_items_order_id ON order_items (order_id)',
+        'CREATE INDEX IF NOT EXISTS ix_order_items_book_id ON order_items (book_id)',
+    ):
+        conn.execute(text(statement))
+
+
+@migration(4, 'Scope order idempotency keys to their user')
+def idempotency_key_per_user(conn):
+    # A global index turned a second user's reuse of a key into an IntegrityError
+    conn.execute(text('DROP INDEX IF EXISTS uq_orders_idempotency_key'))
+    conn.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_orders_user_idempotency_key ON orders (user_id, idempotency_key)'
+    ))
+
+
+@migration(5, 'Keep payment jobs in the database so every worker can answer a poll')
+def add_payment_jobs(conn):
+    PaymentJob.__table__.create(conn, checkfirst=True)
+
+
+@migration(6, 'Allow orders without a user for guest checkout')
+def nullable_order_user(conn):
+    columns = {column['name']: column for column in inspect(conn).get_columns('orders')}
+    if columns['user_id']['nullable']:
+        return
+    if conn.dialect.name != 'sqlite':
+        conn.execute(text('ALTER TABLE orders ALTER COLUMN user_id DROP NOT NULL'))
+        return
+
+    # SQLite cannot alter a column: rebuild the table from the model, keeping rows and indexes
+    indexes = [row[0] for row in conn.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'orders' AND sql IS NOT NULL"
+    ))]
+    rebuilt = Order.__table__.to_metadata(MetaData(), name='orders_rebuilt')
+    conn.execute(CreateTable(rebuilt))
+    kept = ', '.join(name for name in columns if name in rebuilt.c)
+    conn.execute(text(f'INSERT INTO orders_rebuilt ({kept}) SELECT {kept} FROM orders'))
+    conn.execute(text('DROP TABLE orders'))
+    conn.execute(text('ALTER TABLE orders_rebuilt RENAME TO orders'))
+    for statement in indexes:
+        conn.execute(text(statement))
+
+
+@migration(7, 'Create the full-text search index over books')
+def add_search_index(conn):
+    create_search_structures(conn)
+
+
+def _ensure_version_table(conn):
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_migrations ('
+        ' version INTEGER PRIMARY KEY,'
+        ' description VARCHAR(255) NOT NULL,'
+        ' applied_at TIMESTAMP NOT NULL)'
+    ))
+
+
+def applied_versions(engine=None):
+    """Return the set of migration versions already applied"""
+    engine = engine if engine is not None else db.engine
+    with engine.begin() as conn:
+        _ensure_version_table(conn)
+        return {row[0] for row in conn.execute(text('SELECT version FROM schema_migrations'))}
+
+
+def upgrade(target=None, engine=None):
+    """Apply pending migrations up to ``target`` (all by default), one transaction each
+
+    Returns the list of migrations that were applied.
+    """
+    engine = engine if engine is not None else db.engine
+    done = applied_versions(engine)
+    applied = []
+    for step in MIGRATIONS:
+        if step.version in done or (target is not None and step.version > target):
+            continue
+        with engine.begin() as conn:
+            step.upgrade(conn)
+            conn.execute(text(
+                'INSERT INTO schema_migrations (version, description, applied_at) '
+                'VALUES (:version, :description, :applied_at)'
+            ), {'version': step.version, 'description': step.description, 'applied_at': datetime.utcnow()})
+        applied.append(step)
+    return applied
+
+
+# The queries the hot routes build, through the same model helpers; values are placeholders
+HOT_QUERIES = {
+    'get_cart': lambda: CartItem.for_user(1),
+    'add_to_cart': lambda: CartItem.for_user(1).filter_by(book_id=1),
+    'get_orders': lambda: Order.for_user(1),
+    'order_items': lambda: OrderItem.query.filter(OrderItem.order_id.in_([1, 2])),
+    'books_by_category': lambda: Book.query.filter_by(category='Crime Thriller'),
+    'featured_books': lambda: Book.query.filter_by(featured=True),
+    'books_by_created_at': lambda: Book.query.order_by(Book.created_at, Book.id).limit(24),
+    'checkout_idempotency': lambda: Order.query.filter_by(user_id=1, idempotency_key='key'),
+}
+
+
+def bound_statement(query, dialect):
+    """Compile ``query`` the way it is executed: SQL with placeholders, and its parameters"""
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(dialect=dialect, compile_kwargs={'render_postcompile': True})
+    params = compiled.construct_params()
+    if compiled.positiontup is not None:
+        params = tuple(params[name] for name in compiled.positiontup)
+    return str(compiled), params
+
+
+def _sqlite_full_scans(conn, sql, params):
+    rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql, params).all()
+    return [row[-1] for row in rows if row[-1].startswith('SCAN') and ' USING ' not in row[-1]]
+
+
+def _postgres_full_scans(conn, sql, params):
+    # Seq scans are only chosen when no index path exists once they are discouraged
+    conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+    plan = conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + sql, params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    scans = []
+    nodes = [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        if node['Node Type'] == 'Seq Scan':
+            scans.append('Seq Scan on %s' % node.get('Relation Name'))
+        nodes.extend(node.get('Plans', ()))
+    return scans
+
+
+def full_scans(sql, params=(), engine=None):
+    """Return the full table scans in the plan of ``sql`` run with the bound ``params``
+
+    Parameters are bound rather than inlined so the planner sees the
+    statement exactly as the app sends it; a partial index, for one, only
+    matches a predicate it can prove from the SQL text.
+    """
+    engine = engine if engine is not None else db.engine
+    if engine.dialect.name == 'postgresql':
+        scans = _postgres_full_scans
+    elif engine.dialect.name == 'sqlite':
+        scans = _sqlite_full_scans
+    else:
+        raise NotImplementedError(f'No plan checker for {engine.dialect.name}')
+    with engine.begin() as conn:
+        return scans(conn, sql, params)
+
+
+def check_query_plans(engine=None):
+    """Return ``{query_name: [full scan descriptions]}`` for every hot query that scans a table"""
+    engine = engine if engine is not None else db.engine
+    failures = {}
+    for name, build in HOT_QUERIES.items():
+        scans = full_scans(*bound_statement(build(), engine.dialect), engine=engine)
+        if scans:
+            failures[name] = scans
+    return failures
+
+
+@click.command('migrate')
+@click.option('--target', type=int, help='Stop after this version')
+@with_appcontext
+def migrate_command(target):
+    """Apply pending schema migrations"""
+    applied = upgrade(target)
+    for step in applied:
+        click.echo(f'Applied {step.version}: {step.description}')
+    if not applied:
+        click.echo('Schema is up to date')
+
+
+@click.command('check-query-plans')
+@with_appcontext
+def check_query_plans_command():
+    """Fail if any hot route query plans a full table scan"""
+    failures = check_query_plans()
+    for name, scans in failures.items():
+        click.echo(f'{name}: {"; ".join(scans)}', err=True)
+    if failures:
+        raise SystemExit(1)
+    click.echo(f'All {len(HOT_QUERIES)} hot queries use an index')
+
+
+def init_app(app):
+    """Register the ``migrate`` and ``check-query-plans`` CLI commands"""
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(check_query_plans_command)
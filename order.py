@@ -1,17 +1,55 @@
 from datetime import datetime
+from sqlalchemy.orm import selectinload
 from src.models.user import db
+from src.models.ecommerce.book import Book
+from src.models.ecommerce.serializers import Field, Schema
+
+ORDER_ITEM_SCHEMA = Schema('OrderItem', [
+    Field('id'),
+    Field('order_id'),
+    Field('book_id'),
+    Field('book_title', getter=lambda item: item.book.title if item.book else None),
+    Field('quantity'),
+    Field('price'),
+    Field('subtotal', getter=lambda item: item.price * item.quantity),
+    Field('created_at', 'datetime')
+])
+
+ORDER_SCHEMA = Schema('Order', [
+    Field('id'),
+    Field('user_id'),
+    Field('total_amount'),
+    Field('status'),
+    Field('shipping_address'),
+    Field('billing_address'),
+    Field('payment_id'),
+    Field('created_at', 'datetime'),
+    Field('updated_at', 'datetime'),
+    Field('items', schema=ORDER_ITEM_SCHEMA, many=True)
+])
+
+def orders_version(user_id):
+    """Data version name covering one user's orders"""
+    return f'orders:{user_id}'
+
 
 class Order(db.Model):
     """Order model for storing customer orders"""
     __tablename__ = 'orders'
+    __table_args__ = (
+        db.Index('ix_orders_user_id_created_at', 'user_id', 'created_at'),
+        # Keys are chosen by clients, so they only need to be unique per user
+        db.Index('uq_orders_user_idempotency_key', 'user_id', 'idempotency_key', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)  # None for orders checked out from a guest cart
     total_amount = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(50), default='pending')  # pending, paid, shipped, delivered, cancelled
     shipping_address = db.Column(db.Text, nullable=True)
     billing_address = db.Column(db.Text, nullable=True)
     payment_id = db.Column(db.String(255), nullable=True)  # Reference to payment gateway transaction
+    idempotency_key = db.Column(db.String(64), nullable=True)  # Client supplied key that makes checkout retries safe
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -23,25 +61,37 @@ class Order(db.Model):
         self.shipping_address = shipping_address
         self.billing_address = billing_address
 
+    @classmethod
+    def with_items(cls, session=None):
+        """Query orders with their items and book titles loaded up front
+
+        Items come from one extra ``IN`` query per batch of orders and each
+        item's book title is joined onto it, so serializing any number of
+        orders costs two round trips. ``session`` overrides ``db.session``,
+        for example with a read replica session.
+        """
+        query = cls.query if session is None else session.query(cls)
+        return query.options(
+            selectinload(cls.items).joinedload(OrderItem.book).load_only(Book.title)
+        )
+
+    @classmethod
+    def for_user(cls, user_id, session=None):
+        """Query a user's orders, eagerly loaded as in ``with_items``"""
+        return cls.with_items(session).filter_by(user_id=user_id)
+
     def to_dict(self):
         """Convert order object to dictionary"""
-        return {
-            'id': self.id,
-            'user_id': self.user_id,
-            'total_amount': self.total_amount,
-            'status': self.status,
-            'shipping_address': self.shipping_address,
-            'billing_address': self.billing_address,
-            'payment_id': self.payment_id,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-            'updated_at': self.updated_at.strftime('%Y-%m-%d %H:%M:%S'),
-            'items': [item.to_dict() for item in self.items] if hasattr(self, 'items') else []
-        }
+        return ORDER_SCHEMA.serialize(self)
 
 
 class OrderItem(db.Model):
     """Order item model for storing items in an order"""
     __tablename__ = 'order_items'
+    __table_args__ = (
+        db.Index('ix_order_items_order_id', 'order_id'),
+        db.Index('ix_order_items_book_id', 'book_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False)
@@ -62,13 +112,4 @@ class OrderItem(db.Model):
 
     def to_dict(self):
         """Convert order item object to dictionary"""
-        return {
-            'id': self.id,
-            'order_id': self.order_id,
-            'book_id': self.book_id,
-            'book_title': self.book.title if self.book else None,
-            'quantity': self.quantity,
-            'price': self.price,
-            'subtotal': self.price * self.quantity,
-            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S')
-        }
+        return ORDER_ITEM_SCHEMA.serialize(self)
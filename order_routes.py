@@ -1,33 +1,60 @@
-from flask import Blueprint, jsonify, request
-from src.models.ecommerce.order import Order, OrderItem
-from src.models.ecommerce.cart import CartItem
-from src.models.ecommerce.book import Book
+import click
+from flask import Blueprint, after_this_request, jsonify, request
+from src.database import mark_written, read_session
+from src.models.ecommerce.order import ORDER_SCHEMA, Order, orders_version
+from src.models.ecommerce.checkout import (
+    PAYMENT_EVENT_STATUSES, CheckoutError, confirm_order_payment, order_amount_cents, place_order
+)
+from src.models.ecommerce.guest_cart import clear_guest_cart, guest_carts_enabled, load_guest_cart
+from src.models.ecommerce.payments import (
+    PaymentError, WebhookSignatureError, get_payment_gateway, get_payment_jobs, is_intent_id, verify_webhook,
+    webhook_secret
+)
+from src.models.ecommerce.streaming import stream_json_response
+from src.models.ecommerce.webhook_queue import (
+    DEFAULT_BATCH_SIZE, DEFAULT_POLL_INTERVAL, get_webhook_queue, run_worker
+)
 from src.models.user import db
-import stripe
-import os
 
 order_bp = Blueprint('order', __name__)
 
-# Configure Stripe - in production, this would use environment variables
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY', 'sk_test_example')
+STREAM_BATCH_SIZE = 200  # Rows fetched per round trip when streaming order history
+ORDER_SUMMARY_FIELDS = ('id', 'status', 'total_amount', 'created_at')
+
+def _remember_intent(order, intent):
+    """Store the intent an order is being paid with, so only it can confirm the order"""
+    if order.payment_id != intent.id:
+        order.payment_id = intent.id
+        db.session.commit()
+        mark_written(orders_version(order.user_id))
 
 @order_bp.route('/orders', methods=['GET'])
 def get_orders():
-    """Get user's orders"""
+    """Get user's orders, streamed as chunked JSON when ``stream=true``"""
     # In a real app, get user_id from session/token
     user_id = request.args.get('user_id', 1)  # Default to 1 for demo
     
-    orders = Order.query.filter_by(user_id=user_id).all()
+    if request.args.get('stream', '').lower() == 'true':
+        # Read orders in batches from a server-side cursor and stream them out
+        orders = Order.for_user(user_id, read_session(orders_version(user_id))) \
+            .order_by(Order.id).yield_per(STREAM_BATCH_SIZE)
+        return stream_json_response('orders', orders, ORDER_SCHEMA.compile())
+    
+    orders = Order.for_user(user_id, read_session(orders_version(user_id))).all()
     
     return jsonify({
         'success': True,
-        'orders': [order.to_dict() for order in orders]
+        'orders': ORDER_SCHEMA.serialize_many(orders)
     }), 200
 
 @order_bp.route('/orders/<int:order_id>', methods=['GET'])
 def get_order(order_id):
     """Get a specific order by ID"""
-    order = Order.query.get(order_id)
+    # In a real app, get user_id from session/token
+    user_id = request.args.get('user_id', 1)  # Default to 1 for demo
+    
+    # Orders the user placed or paid for moments ago are read from the primary
+    order = Order.with_items(read_session(orders_version(user_id))).filter_by(id=order_id).first()
     
     if not order:
         return jsonify({
@@ -40,67 +67,102 @@ def get_order(order_id):
         'order': order.to_dict()
     }), 200
 
-@order_bp.route('/checkout', methods=['POST'])
-def checkout():
-    """Process checkout and create order"""
+def _place_order_from_request():
+    """Validate a checkout request and place its order
+
+    Shared by ``checkout`` and ``checkout_and_pay``. Returns ``(order,
+    created, None)``, or ``(None, False, error_response)`` when the payload
+    is incomplete or the cart cannot be checked out.
+    """
     data = request.get_json()
     
     # Validate required fields
     required_fields = ['shipping_address', 'billing_address']
     for field in required_fields:
         if field not in data:
-            return jsonify({
+            return None, False, (jsonify({
                 'success': False,
                 'message': f'Missing required field: {field}'
-            }), 400
+            }), 400)
     
     # In a real app, get user_id from session/token
-    user_id = data.get('user_id', 1)  # Default to 1 for demo
-    
-    # Get cart items
-    cart_items = CartItem.query.filter_by(user_id=user_id).all()
+    user_id = data.get('user_id')
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+    # A cart kept in the guest cookie is merged in the order's transaction
+    guest_lines = load_guest_cart() if guest_carts_enabled() else None
+    if user_id is None and guest_lines is None:
+        user_id = 1  # Default to 1 for demo
+    # Otherwise a guest without a user_id checks out the cookie cart as an order with no user
     
-    if not cart_items:
-        return jsonify({
+    try:
+        order, created = place_order(
+            user_id,
+            data['shipping_address'],
+            data['billing_address'],
+            idempotency_key=idempotency_key,
+            guest_lines=guest_lines
+        )
+    except CheckoutError as e:
+        response = {
             'success': False,
-            'message': 'Cart is empty'
-        }), 400
+            'message': str(e)
+        }
+        if getattr(e, 'book_ids', None):
+            response['book_ids'] = e.book_ids
+        return None, False, (jsonify(response), e.status_code)
     
-    # Calculate total amount
-    total_amount = sum(item.book.price * item.quantity for item in cart_items if item.book)
-    
-    # Create order
-    order = Order(
-        user_id=user_id,
-        total_amount=total_amount,
-        shipping_address=data['shipping_address'],
-        billing_address=data['billing_address']
-    )
-    
-    db.session.add(order)
-    db.session.flush()  # Get order ID without committing
-    
-    # Create order items
-    for cart_item in cart_items:
-        if cart_item.book:
-            order_item = OrderItem(
-                order_id=order.id,
-                book_id=cart_item.book_id,
-                quantity=cart_item.quantity,
-                price=cart_item.book.price
-            )
-            db.session.add(order_item)
-    
-    # Clear cart
-    CartItem.query.filter_by(user_id=user_id).delete()
+    if guest_lines:
+        after_this_request(clear_guest_cart)
+    if created and user_id is not None:
+        mark_written(orders_version(user_id))
+    return order, created, None
+
+@order_bp.route('/checkout', methods=['POST'])
+def checkout():
+    """Process checkout and create order"""
+    order, created, error = _place_order_from_request()
+    if error:
+        return error
     
-    db.session.commit()
+    order = Order.with_items().filter_by(id=order.id).one()
     
     return jsonify({
         'success': True,
-        'message': 'Order created successfully',
+        'message': 'Order created successfully' if created else 'Order already placed',
         'order': order.to_dict()
-    }), 201
+    }), 201 if created else 200
+
+@order_bp.route('/checkout/pay', methods=['POST'])
+def checkout_and_pay():
+    """Create the order and its payment intent in one request
+
+    Returns the client secret with a compact order summary; the order is
+    marked paid by the ``payment_intent.succeeded`` webhook. Retrying with
+    the same idempotency key returns the same order and intent.
+    """
+    order, created, error = _place_order_from_request()
+    if error:
+        return error
+    
+    summary = ORDER_SCHEMA.serialize(order, ORDER_SUMMARY_FIELDS)
+    
+    try:
+        # Intents are keyed on the order id, so a retry reuses the same one
+        intent = get_payment_gateway().create_intent(order.id, order_amount_cents(order))
+    except PaymentError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e),
+            'order': summary
+        }), 502
+    
+    _remember_intent(order, intent)
+    
+    return jsonify({
+        'success': True,
+        'order': summary,
+        'clientSecret': intent.client_secret
+    }), 201 if created else 200
 
 @order_bp.route('/payment/create-intent', methods=['POST'])
 def create_payment_intent():
@@ -122,30 +184,79 @@ def create_payment_intent():
             'message': 'Order not found'
         }), 404
     
-    try:
-        # Create a PaymentIntent with the order amount and currency
-        intent = stripe.PaymentIntent.create(
-            amount=int(order.total_amount * 100),  # Convert to cents
-            currency='usd',
-            metadata={
-                'order_id': order.id
-            }
-        )
-        
+    # In a real app, get user_id from session/token
+    user_id = data.get('user_id', 1)  # Default to 1 for demo
+    if order.user_id != user_id:
+        # Only the order's owner may pay for it, whichever way the intent is created
+        return jsonify({
+            'success': False,
+            'message': 'Order not found'
+        }), 404
+    
+    amount = order_amount_cents(order)
+    
+    if data.get('async'):
+        # Hand the gateway call to a background thread and let the client poll
+        job_id = get_payment_jobs().submit_create_intent(order.id, user_id, amount)
         return jsonify({
             'success': True,
-            'clientSecret': intent.client_secret
-        }), 200
-        
-    except Exception as e:
+            'job_id': job_id
+        }), 202
+    
+    try:
+        # Create a PaymentIntent with the order amount and currency
+        intent = get_payment_gateway().create_intent(order.id, amount)
+    except PaymentError as e:
         return jsonify({
             'success': False,
             'message': str(e)
-        }), 400
+        }), 502
+    
+    _remember_intent(order, intent)
+    
+    return jsonify({
+        'success': True,
+        'clientSecret': intent.client_secret
+    }), 200
+
+@order_bp.route('/payment/create-intent/<job_id>', methods=['GET'])
+def get_payment_intent_job(job_id):
+    """Poll a payment intent queued with ``async``"""
+    # In a real app, get user_id from session/token
+    user_id = request.args.get('user_id', 1, type=int)  # Default to 1 for demo
+    state, job = get_payment_jobs().status(job_id, user_id)
+    
+    if state == 'unknown':
+        return jsonify({
+            'success': False,
+            'message': 'Payment job not found'
+        }), 404
+    
+    if state == 'failed':
+        return jsonify({
+            'success': False,
+            'status': state,
+            'message': job.error
+        }), 502
+    
+    response = {
+        'success': True,
+        'status': state
+    }
+    if state == 'done':
+        order = Order.query.get(job.order_id)
+        if order is not None:
+            _remember_intent(order, job.intent())
+        response['clientSecret'] = job.client_secret
+    return jsonify(response), 200
 
 @order_bp.route('/payment/confirm', methods=['POST'])
 def confirm_payment():
-    """Confirm payment and update order status"""
+    """Confirm payment and update order status
+
+    The payment is looked up with the gateway, so a client can only confirm
+    an intent that really succeeded for this order's full amount.
+    """
     data = request.get_json()
     
     # Validate required fields
@@ -165,14 +276,88 @@ def confirm_payment():
             'message': 'Order not found'
         }), 404
     
-    # Update order with payment information
-    order.payment_id = data['payment_id']
-    order.status = 'paid'
+    # Only the intent created for this order may confirm it
+    payment_id = data['payment_id']
+    if not is_intent_id(payment_id) or payment_id != order.payment_id:
+        return jsonify({
+            'success': False,
+            'message': 'Payment does not belong to this order'
+        }), 400
+    
+    try:
+        intent = get_payment_gateway().retrieve_intent(payment_id)
+        confirm_order_payment(order, intent)
+    except PaymentError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 502
+    except CheckoutError as e:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
     
     db.session.commit()
+    mark_written(orders_version(order.user_id))
+    order = Order.with_items().filter_by(id=order.id).one()
     
     return jsonify({
         'success': True,
         'message': 'Payment confirmed',
         'order': order.to_dict()
     }), 200
+
+@order_bp.route('/payment/webhook', methods=['POST'])
+def payment_webhook():
+    """Receive signed payment events from Stripe
+
+    Events are only verified and queued here, once per event id; the
+    ``process-webhooks`` worker applies them to orders in batches.
+    """
+    secret = webhook_secret()
+    if secret is None:
+        # Without a secret nothing can be verified; refuse rather than trust the event
+        return jsonify({
+            'success': False,
+            'message': 'Webhooks are not configured'
+        }), 503
+    
+    payload = request.get_data()
+    try:
+        event = verify_webhook(payload, request.headers.get('Stripe-Signature'), secret)
+    except WebhookSignatureError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    
+    if not isinstance(event, dict) or not event.get('id'):
+        return jsonify({
+            'success': False,
+            'message': 'Event id is required'
+        }), 400
+    
+    queued = False
+    if event.get('type') in PAYMENT_EVENT_STATUSES:
+        queued = get_webhook_queue().enqueue(event['id'], event['type'], payload)
+    
+    return jsonify({
+        'success': True,
+        'received': True,
+        'queued': queued
+    }), 200
+
+@order_bp.cli.command('process-webhooks')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True, help='Events applied per commit')
+@click.option('--poll-interval', default=DEFAULT_POLL_INTERVAL, show_default=True, help='Seconds to sleep when idle')
+@click.option('--once', is_flag=True, help='Exit once the queue is empty')
+@click.option('--retry-failed', is_flag=True, help='Give events parked as failed another round of attempts')
+def process_webhooks_command(batch_size, poll_interval, once, retry_failed):
+    """Apply queued payment webhook events to orders"""
+    queue = get_webhook_queue()
+    if retry_failed:
+        click.echo(f'Requeued {queue.requeue_failed()} failed events')
+    run_worker(queue, batch_size, poll_interval, once)
+    click.echo(', '.join(f'{status}: {count}' for status, count in sorted(queue.stats().items())) or 'Queue is empty')
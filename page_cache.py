@@ -0,0 +1,161 @@
+"""Full-page and fragment caching for rendered templates.
+
+Rendered HTML is stored in the catalog cache backend under keys built from
+the page or fragment name plus the version tokens of the data it shows (see
+``catalog_cache.data_versions``). Admin writes bump those tokens through
+``invalidate_book``, so no key has to be deleted. With the shared Redis
+backend (``CATALOG_CACHE_REDIS_URL``) a change is visible on the next request
+to any worker. With the default in-process backend each worker keeps its own
+tokens: only the worker that handled the write sees the change at once, and
+the others keep serving their pages for up to ``PAGE_CACHE_TTL`` plus
+``PAGE_CACHE_STALE_TTL`` seconds, and their fragments for up to
+``FRAGMENT_CACHE_TTL``.
+
+Pages are fresh for ``PAGE_CACHE_TTL`` seconds and are then served stale for
+up to ``PAGE_CACHE_STALE_TTL`` more while one background thread per process
+renders a replacement, so visitors never wait for a render once a page is
+warm. Fragments are cached inside any template with::
+
+    {% cache 'featured-books', 'featured' %} ... {% endcache %}
+
+where the first argument names the fragment and the rest name the data
+versions it depends on.
+"""
+import logging
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from flask import Response, current_app, has_app_context, request
+from jinja2 import nodes
+from jinja2.ext import Extension
+from src.models.ecommerce.catalog_cache import data_versions, get_catalog_cache
+from src.models.ecommerce.http_cache import apply_validators, is_not_modified, not_modified
+
+DEFAULT_PAGE_TTL = 60
+DEFAULT_STALE_TTL = 600
+DEFAULT_FRAGMENT_TTL = 300
+
+logger = logging.getLogger(__name__)
+
+_refresh_lock = threading.Lock()
+_refreshing = set()
+
+
+def page_key(name, versions=(), variant=''):
+    return f'page:{name}:{variant}:{".".join(data_versions(*versions))}'
+
+
+def fragment_key(name, versions=()):
+    return f'fragment:{name}:{".".join(data_versions(*versions))}'
+
+
+def _pack_page(rendered_at, body):
+    return b'%.6f\n%s' % (rendered_at, body)
+
+
+def _unpack_page(entry):
+    rendered_at, body = entry.split(b'\n', 1)
+    return float(rendered_at), body
+
+
+def _render_page(key, render, timeout):
+    # Rounded as it is packed, so a hit derives the same ETag as the render did
+    rendered_at = round(time.time(), 6)
+    body = render().encode('utf-8')
+    get_catalog_cache().set(key, _pack_page(rendered_at, body), ttl=timeout)
+    return rendered_at, body
+
+
+def _refresh_in_background(key, render, timeout):
+    """Re-render a stale page off the request path, at most once per key at a time"""
+    with _refresh_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    app = current_app._get_current_object()
+    path = request.path
+
+    def refresh():
+        try:
+            with app.test_request_context(path):
+                _render_page(key, render, timeout)
+        except Exception:
+            logger.exception('Background render of %s failed, serving the stale page', key)
+        finally:
+            with _refresh_lock:
+                _refreshing.discard(key)
+
+    threading.Thread(target=refresh, name='page-cache-refresh', daemon=True).start()
+
+
+def cached_page(name, render, versions=(), variant=''):
+    """Serve the page ``render()`` produces from the cache, rendering only on a miss
+
+    ``versions`` names the data sets the page shows and ``variant``
+    distinguishes renders of the same template, such as another query string.
+    The response carries an ETag and Last-Modified for the render it holds.
+    """
+    config = current_app.config
+    ttl = config.get('PAGE_CACHE_TTL', DEFAULT_PAGE_TTL)
+    timeout = ttl + config.get('PAGE_CACHE_STALE_TTL', DEFAULT_STALE_TTL)
+
+    key = page_key(name, versions, variant)
+    entry = get_catalog_cache().get(key)
+    if entry is None:
+        rendered_at, body = _render_page(key, render, timeout)
+    else:
+        rendered_at, body = _unpack_page(entry)
+        if time.time() - rendered_at > ttl:
+            _refresh_in_background(key, render, timeout)
+
+    etag = '%08x-%d' % (zlib.crc32(key.encode('utf-8')), rendered_at * 1000000)
+    last_modified = datetime.utcfromtimestamp(rendered_at)
+    if is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified, 'page')
+    response = Response(body, status=200, mimetype='text/html')
+    return apply_validators(response, etag, last_modified, 'page')
+
+
+def cached_fragment(name, render, versions=()):
+    """Return the HTML ``render()`` produces for fragment ``name``, cached per data version"""
+    cache = get_catalog_cache()
+    key = fragment_key(name, versions)
+    body = cache.get(key)
+    if body is not None:
+        return body.decode('utf-8')
+    html = render()
+    cache.set(key, html.encode('utf-8'), ttl=current_app.config.get('FRAGMENT_CACHE_TTL', DEFAULT_FRAGMENT_TTL))
+    return html
+
+
+class FragmentCacheExtension(Extension):
+    """Adds the ``{% cache name, version, ... %}...{% endcache %}`` tag
+
+    Outside a Flask app, as in static builds, the body is rendered inline.
+    """
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_cache_support', [nodes.List(args)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _cache_support(self, args, caller):
+        if not has_app_context():
+            return caller()
+        name, *versions = args
+        return cached_fragment(name, caller, versions)
+
+
+def init_page_cache(app):
+    """Enable the ``{% cache %}`` template tag"""
+    app.jinja_env.add_extension(FragmentCacheExtension)
@@ -0,0 +1,317 @@
+"""Payment gateway abstraction.
+
+``StripeGateway`` talks to the Stripe REST API over a pooled ``requests``
+session, with connect/read timeouts and retries with exponential backoff
+for connection errors, 429s and 5xx responses. Each PaymentIntent is created
+with an idempotency key derived from the order id, so a retry never creates
+a second intent for the same order.
+
+``PaymentJobs`` runs gateway calls on a small thread pool so a web worker
+can answer with ``202 Accepted`` right away and let the client poll for the
+result instead of being held for the whole external round trip. Job state
+lives in the ``payment_jobs`` table, so any worker can answer a poll; job ids
+are random and a job is only shown to the user who owns its order.
+
+``verify_webhook`` checks the ``Stripe-Signature`` header of an incoming
+event against ``STRIPE_WEBHOOK_SECRET`` before anything in it is trusted;
+without that setting every webhook is refused.
+
+Point ``STRIPE_API_BASE`` at ``fake_gateway.py`` and set
+``STRIPE_WEBHOOK_SECRET`` to its ``--webhook-secret`` to exercise all of
+this offline.
+"""
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import re
+import secrets
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from sqlalchemy import delete, update
+from src.models.user import db
+
+PaymentIntent = namedtuple('PaymentIntent', ['id', 'client_secret', 'status', 'amount', 'metadata'], defaults=(None,))
+
+RETRY_STATUSES = frozenset([409, 429, 500, 502, 503, 504])
+WEBHOOK_TOLERANCE = 300  # Seconds a signed webhook stays valid, against replays
+INTENT_ID_RE = re.compile(r'^pi_[A-Za-z0-9_]+$')
+JOB_STALE_AFTER = 60  # Seconds a pending job may go without a result before another worker reruns it
+JOB_TTL = 24 * 3600  # Seconds finished jobs are kept for polling
+
+_lock = threading.Lock()
+_gateways = {}
+_jobs = {}
+
+
+class PaymentError(Exception):
+    """Raised when the gateway rejects a request or cannot be reached"""
+
+
+class WebhookSignatureError(PaymentError):
+    """Raised when a webhook payload is not signed with the endpoint secret"""
+
+
+def intent_idempotency_key(order_id):
+    return f'order-{order_id}-intent'
+
+
+def is_intent_id(value):
+    """Whether ``value`` looks like a PaymentIntent id"""
+    return isinstance(value, str) and INTENT_ID_RE.match(value) is not None
+
+
+def sign_webhook(payload, secret, timestamp=None):
+    """Build a ``Stripe-Signature`` header value for ``payload`` bytes"""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode('utf-8'), b'%d.%s' % (timestamp, payload), hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def verify_webhook(payload, header, secret, tolerance=WEBHOOK_TOLERANCE):
+    """Return the event in ``payload`` bytes if ``header`` carries a valid signature for it
+
+    Raises ``WebhookSignatureError`` for a missing, malformed, wrong or
+    expired signature, and when no ``secret`` is configured.
+    """
+    if not secret:
+        raise WebhookSignatureError('No webhook signing secret is configured')
+    pairs = [item.split('=', 1) for item in (header or '').split(',') if '=' in item]
+    timestamps = [value for key, value in pairs if key.strip() == 't']
+    signatures = [value for key, value in pairs if key.strip() == 'v1']
+    if not timestamps or not signatures or not timestamps[0].isdigit():
+        raise WebhookSignatureError('Missing or malformed Stripe-Signature header')
+
+    timestamp = int(timestamps[0])
+    expected = sign_webhook(payload, secret, timestamp).rsplit('v1=', 1)[1]
+    if not any(hmac.compare_digest(expected, signature) for signature in signatures):
+        raise WebhookSignatureError('Webhook signature does not match')
+    if abs(time.time() - timestamp) > tolerance:
+        raise WebhookSignatureError('Webhook timestamp is outside the tolerance')
+
+    try:
+        return json.loads(payload)
+    except ValueError:
+        raise WebhookSignatureError('Webhook payload is not valid JSON')
+
+
+def webhook_secret():
+    """Signing secret for webhooks sent to the current app, or ``None`` when none is configured"""
+    return current_app.config.get('STRIPE_WEBHOOK_SECRET') or os.getenv('STRIPE_WEBHOOK_SECRET') or None
+
+
+class PaymentGateway:
+    """Interface implemented by payment providers"""
+
+    def create_intent(self, order_id, amount, currency='usd'):
+        """Create a payment intent for ``amount`` (in cents) and return a ``PaymentIntent``"""
+        raise NotImplementedError
+
+    def retrieve_intent(self, intent_id):
+        """Return the current ``PaymentIntent`` for ``intent_id``"""
+        raise NotImplementedError
+
+
+class StripeGateway(PaymentGateway):
+    """Stripe PaymentIntents over a pooled HTTP session"""
+
+    def __init__(self, api_key, base_url='https://api.stripe.com', timeout=(3.05, 10),
+                 max_retries=2, backoff=0.25, pool_size=10):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        self.session.auth = (api_key, '')
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _request(self, method, path, data=None, idempotency_key=None):
+        headers = {}
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
+
+        for attempt in itertools.count():
+            last_attempt = attempt >= self.max_retries
+            try:
+                response = self.session.request(
+                    method, self.base_url + path, data=data, headers=headers, timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last_attempt:
+                    raise PaymentError(f'Payment gateway unreachable: {e}')
+            else:
+                if response.status_code < 400:
+                    return response.json()
+                if last_attempt or response.status_code not in RETRY_STATUSES:
+                    try:
+                        message = response.json()['error']['message']
+                    except (ValueError, KeyError, TypeError):
+                        message = f'Payment gateway returned {response.status_code}'
+                    raise PaymentError(message)
+
+            # Full jitter keeps retries from many workers from arriving in lockstep
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def _to_intent(body):
+        return PaymentIntent(
+            body['id'], body.get('client_secret'), body.get('status'), body.get('amount'), body.get('metadata') or {}
+        )
+
+    def create_intent(self, order_id, amount, currency='usd'):
+        body = self._request('POST', '/v1/payment_intents', data={
+            'amount': amount,
+            'currency': currency,
+            'metadata[order_id]': order_id
+        }, idempotency_key=intent_idempotency_key(order_id))
+        return self._to_intent(body)
+
+    def retrieve_intent(self, intent_id):
+        if not is_intent_id(intent_id):
+            raise PaymentError(f'Invalid payment intent id: {intent_id!r}')
+        return self._to_intent(self._request('GET', f'/v1/payment_intents/{quote(intent_id, safe="")}'))
+
+
+class PaymentJob(db.Model):
+    """A queued intent creation and its outcome, shared by every worker"""
+    __tablename__ = 'payment_jobs'
+
+    id = db.Column(db.String(32), primary_key=True)  # Random, so jobs cannot be guessed
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Integer, nullable=False)  # In cents
+    currency = db.Column(db.String(3), nullable=False, default='usd')
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending, done, failed
+    intent_id = db.Column(db.String(255), nullable=True)
+    client_secret = db.Column(db.String(255), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def intent(self):
+        """The ``PaymentIntent`` a finished job created"""
+        return PaymentIntent(self.intent_id, self.client_secret, None, self.amount, {'order_id': str(self.order_id)})
+
+
+class PaymentJobs:
+    """Runs gateway calls in background threads and records their results in ``payment_jobs``
+
+    The thread pool belongs to one worker but the table is shared, so a job
+    can be polled through any worker. A job left pending for
+    ``JOB_STALE_AFTER`` seconds, e.g. because its worker died, is run again
+    by whichever worker is polled; intents are created with an order-derived
+    idempotency key, so that returns the same intent.
+    """
+
+    def __init__(self, gateway, max_workers=4):
+        self.gateway = gateway
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='payments')
+
+    def submit_create_intent(self, order_id, user_id, amount, currency='usd'):
+        """Queue intent creation for ``user_id``'s order and return a job id for ``status``
+
+        A pending or finished job for the same order is reused. Commits.
+        """
+        job = PaymentJob.query.filter(
+            PaymentJob.order_id == order_id, PaymentJob.user_id == user_id, PaymentJob.status != 'failed'
+        ).first()
+        if job is not None:
+            return job.id
+
+        job = PaymentJob(
+            id=secrets.token_urlsafe(24), order_id=order_id, user_id=user_id, amount=amount, currency=currency
+        )
+        db.session.add(job)
+        db.session.execute(delete(PaymentJob.__table__).where(
+            PaymentJob.created_at < datetime.utcnow() - timedelta(seconds=JOB_TTL)))
+        db.session.commit()
+        self._start(job)
+        return job.id
+
+    def _start(self, job):
+        self._executor.submit(
+            self._run, current_app._get_current_object(), job.id, job.order_id, job.amount, job.currency
+        )
+
+    def _run(self, app, job_id, order_id, amount, currency):
+        with app.app_context():
+            try:
+                intent = self.gateway.create_intent(order_id, amount, currency)
+            except Exception as e:
+                values = {'status': 'failed', 'error': str(e) or e.__class__.__name__}
+            else:
+                values = {'status': 'done', 'intent_id': intent.id, 'client_secret': intent.client_secret}
+            db.session.execute(
+                update(PaymentJob.__table__)
+                .where(PaymentJob.id == job_id, PaymentJob.status == 'pending')
+                .values(updated_at=datetime.utcnow(), **values)
+            )
+            db.session.commit()
+
+    def status(self, job_id, user_id):
+        """Return ``(state, job)`` with state pending, done, failed or unknown
+
+        Jobs of other users' orders are unknown. A stale pending job is
+        resubmitted here.
+        """
+        job = db.session.get(PaymentJob, job_id, populate_existing=True)
+        if job is None or job.user_id != user_id:
+            return 'unknown', None
+        stale = datetime.utcnow() - timedelta(seconds=JOB_STALE_AFTER)
+        if job.status == 'pending' and job.updated_at < stale:
+            claimed = db.session.execute(
+                update(PaymentJob.__table__)
+                .where(PaymentJob.id == job.id, PaymentJob.status == 'pending', PaymentJob.updated_at < stale)
+                .values(updated_at=datetime.utcnow())
+            ).rowcount
+            db.session.commit()
+            if claimed:
+                self._start(job)
+        return job.status, job
+
+
+def _create_gateway(config):
+    return StripeGateway(
+        api_key=config.get('STRIPE_SECRET_KEY') or os.getenv('STRIPE_SECRET_KEY', 'sk_test_example'),
+        base_url=config.get('STRIPE_API_BASE') or os.getenv('STRIPE_API_BASE', 'https://api.stripe.com'),
+        timeout=config.get('PAYMENT_TIMEOUT', (3.05, 10)),
+        max_retries=config.get('PAYMENT_MAX_RETRIES', 2)
+    )
+
+
+def get_payment_gateway():
+    """Return the payment gateway for the current app, creating it on first use"""
+    app = current_app._get_current_object()
+    gateway = _gateways.get(app)
+    if gateway is None:
+        with _lock:
+            gateway = _gateways.get(app)
+            if gateway is None:
+                gateway = _gateways[app] = app.config.get('PAYMENT_GATEWAY') or _create_gateway(app.config)
+    return gateway
+
+
+def get_payment_jobs():
+    """Return the background payment job runner for the current app"""
+    app = current_app._get_current_object()
+    jobs = _jobs.get(app)
+    if jobs is None:
+        gateway = get_payment_gateway()
+        with _lock:
+            jobs = _jobs.get(app)
+            if jobs is None:
+                jobs = _jobs[app] = PaymentJobs(gateway, max_workers=app.config.get('PAYMENT_WORKERS', 4))
+    return jobs
@@ -0,0 +1,47 @@
+"""Helpers for counting the SQL statements issued by a block of code.
+
+Used to pin read paths to a fixed number of round trips::
+
+    with assert_max_queries(2):
+        client.get('/api/orders?user_id=1')
+"""
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from src.models.user import db
+
+
+class QueryCounter:
+    """Collects the statements executed while it is listening"""
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+@contextmanager
+def count_queries(engine=None):
+    """Yield a ``QueryCounter`` recording every statement run on ``engine``"""
+    engine = engine if engine is not None else db.engine
+    counter = QueryCounter()
+    event.listen(engine, 'before_cursor_execute', counter._before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', counter._before_cursor_execute)
+
+
+@contextmanager
+def assert_max_queries(limit, engine=None):
+    """Fail with ``AssertionError`` if the block issues more than ``limit`` statements"""
+    with count_queries(engine) as counter:
+        yield counter
+    if counter.count > limit:
+        raise AssertionError('Expected at most %d queries, %d were executed:\n%s' % (
+            limit, counter.count, '\n'.join(counter.statements)))
@@ -0,0 +1,332 @@
+"""Co-purchase recommendations ("readers who bought this also bought").
+
+``flask book recommendations`` folds orders into co-occurrence counts and
+publishes the top ``RECOMMENDATIONS_TOP_K`` neighbours of every book to a
+compact, memory-mapped index that ``/api/books/<id>/recommendations``
+serves from.
+
+The job is incremental. Pair counts and the number of orders per book live
+in a small SQLite file next to the index, together with the id of the last
+order folded in. Each run only reads ``order_items`` of newer orders and
+recomputes the neighbour lists of the books they contain; every other list
+is copied over from the previous index. A book's ranking is its
+co-purchase count and its score is the share of the book's orders that
+include the neighbour, both of which only change when the book itself is
+bought again, so incremental runs give the same index as a full rebuild.
+Orders younger than ``SETTLE_SECONDS`` are left for the next run so that
+transactions still committing are not skipped. Only orders that were paid
+(``COUNTED_STATUSES``) are counted, and since orders are folded once, a run
+stops short of the oldest order still awaiting payment; an order that stays
+unpaid for ``PAYMENT_WINDOW_SECONDS`` is taken as abandoned and no longer
+holds the job back. ``--full`` starts over.
+
+The index file is a header followed by four native-endian arrays in CSR
+layout, indexed directly by book id::
+
+    indptr  uint32[max_book_id + 2]   neighbours of book b are indptr[b]:indptr[b + 1]
+    indices uint32[nnz]               neighbour book ids, best first
+    counts  uint32[nnz]               orders containing both books
+    scores  float32[nnz]              counts / orders containing book b
+
+It is replaced atomically and reopened by every worker within
+``RELOAD_INTERVAL`` seconds, so a lookup is two array reads and a slice
+with no query involved.
+"""
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from array import array
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from itertools import combinations, groupby
+from operator import itemgetter
+
+from flask import current_app
+from sqlalchemy import func
+from src.models.user import db
+from src.models.ecommerce.checkout import PAYABLE_STATUSES
+from src.models.ecommerce.order import Order, OrderItem
+
+DEFAULT_TOP_K = 20
+SETTLE_SECONDS = 60
+PAYMENT_WINDOW_SECONDS = 24 * 3600  # Unpaid orders older than this are abandoned
+COUNTED_STATUSES = ('paid', 'shipped', 'delivered')
+RELOAD_INTERVAL = 5
+FOLD_BATCH_ORDERS = 10000  # Orders folded per SQLite transaction
+MAX_BASKET_SIZE = 50  # Larger orders are bulk purchases and say little about taste
+
+MAGIC = b'CCRK'
+FORMAT_VERSION = 1
+ENDIAN_MARK = 0x01020304  # Reads back differently on a machine of the other byte order
+# magic, endian mark, version, top_k, rows, nnz, high water order id, built at
+HEADER = struct.Struct('=4sIHHIIQd')
+
+Neighbour = namedtuple('Neighbour', ['book_id', 'score', 'count'])
+UpdateReport = namedtuple('UpdateReport', ['orders', 'rows', 'pairs'])
+_LoadedIndex = namedtuple('_LoadedIndex', ['index', 'signature', 'checked_at'])
+
+_lock = threading.Lock()
+_indexes = {}
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS co_counts ('
+    ' book_id INTEGER NOT NULL,'
+    ' other_id INTEGER NOT NULL,'
+    ' count INTEGER NOT NULL,'
+    ' PRIMARY KEY (book_id, other_id)'
+    ') WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS book_orders ('
+    ' book_id INTEGER PRIMARY KEY,'
+    ' orders INTEGER NOT NULL'
+    ')',
+    'CREATE TABLE IF NOT EXISTS state ('
+    ' name TEXT PRIMARY KEY,'
+    ' value INTEGER NOT NULL'
+    ')'
+)
+
+
+class RecommendationIndex:
+    """Read-only view of a neighbour index file through ``mmap``"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as handle:
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, mark, version, self.top_k, rows, nnz, self.high_water, self.built_at = \
+            HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != FORMAT_VERSION or mark != ENDIAN_MARK:
+            raise ValueError(f'{path} is not a recommendation index this build can read')
+
+        view = memoryview(self._map)
+        offset = HEADER.size
+
+        def take(typecode, length):
+            nonlocal offset
+            size = length * 4
+            part = view[offset:offset + size].cast(typecode)
+            offset += size
+            return part
+
+        self.indptr = take('I', rows + 1)
+        self.indices = take('I', nnz)
+        self.counts = take('I', nnz)
+        self.scores = take('f', nnz)
+
+    @property
+    def max_book_id(self):
+        return len(self.indptr) - 2
+
+    def row(self, book_id):
+        """Return the ``(start, end)`` bounds of a book's neighbours in the arrays"""
+        if not 0 <= book_id <= self.max_book_id:
+            return 0, 0
+        return self.indptr[book_id], self.indptr[book_id + 1]
+
+    def neighbours(self, book_id, limit=None):
+        """Books most often bought with ``book_id``, best first"""
+        start, end = self.row(book_id)
+        if limit is not None:
+            end = min(end, start + limit)
+        return [Neighbour(self.indices[i], self.scores[i], self.counts[i]) for i in range(start, end)]
+
+
+def _connect(counts_path):
+    conn = sqlite3.connect(counts_path, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def _high_water(conn):
+    row = conn.execute("SELECT value FROM state WHERE name = 'high_water'").fetchone()
+    return row[0] if row else 0
+
+
+def _flush(conn, pairs, totals, high_water):
+    """Add one batch of counts to the store and advance the high water mark in one transaction"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany(
+            'INSERT INTO co_counts (book_id, other_id, count) VALUES (?, ?, ?)'
+            ' ON CONFLICT (book_id, other_id) DO UPDATE SET count = count + excluded.count',
+            [(a, b, count) for (a, b), count in pairs.items()]
+        )
+        conn.executemany(
+            'INSERT INTO book_orders (book_id, orders) VALUES (?, ?)'
+            ' ON CONFLICT (book_id) DO UPDATE SET orders = orders + excluded.orders',
+            list(totals.items())
+        )
+        conn.execute(
+            "INSERT INTO state (name, value) VALUES ('high_water', ?)"
+            ' ON CONFLICT (name) DO UPDATE SET value = excluded.value', (high_water,)
+        )
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    pairs.clear()
+    totals.clear()
+
+
+def fold_orders(conn, settle=SETTLE_SECONDS, payment_window=PAYMENT_WINDOW_SECONDS):
+    """Fold paid orders placed since the last run into the counts
+
+    Returns the number of orders read and the ids of the books they contain.
+    """
+    high_water = _high_water(conn)
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=settle)
+    through = db.session.query(func.max(Order.id)).filter(Order.created_at <= cutoff).scalar()
+    if through is None or through <= high_water:
+        return 0, set()
+
+    # Orders are read once, so stop before one that may still be paid
+    unpaid = db.session.query(func.min(Order.id)).filter(
+        Order.id > high_water,
+        Order.id <= through,
+        Order.status.in_(PAYABLE_STATUSES),
+        Order.created_at > now - timedelta(seconds=payment_window)
+    ).scalar()
+    if unpaid is not None:
+        through = unpaid - 1
+        if through <= high_water:
+            return 0, set()
+
+    items = db.session.query(OrderItem.order_id, OrderItem.book_id) \
+        .join(Order, Order.id == OrderItem.order_id) \
+        .filter(OrderItem.order_id > high_water, OrderItem.order_id <= through,
+                Order.status.in_(COUNTED_STATUSES)) \
+        .order_by(OrderItem.order_id) \
+        .yield_per(FOLD_BATCH_ORDERS)
+
+    pairs, totals, touched = defaultdict(int), defaultdict(int), set()
+    orders = 0
+    for order_id, rows in groupby(items, key=itemgetter(0)):
+        books = sorted({book_id for _, book_id in rows})
+        orders += 1
+        if len(books) <= MAX_BASKET_SIZE:
+            touched.update(books)
+            for book_id in books:
+                totals[book_id] += 1
+            for a, b in combinations(books, 2):
+                pairs[a, b] += 1
+                pairs[b, a] += 1
+        if orders % FOLD_BATCH_ORDERS == 0:
+            _flush(conn, pairs, totals, order_id)
+    _flush(conn, pairs, totals, through)
+    return orders, touched
+
+
+def _top_neighbours(conn, book_id, top_k):
+    row = conn.execute('SELECT orders FROM book_orders WHERE book_id = ?', (book_id,)).fetchone()
+    if not row:
+        return []
+    orders = row[0]
+    return [(other_id, count, count / orders) for other_id, count in conn.execute(
+        'SELECT other_id, count FROM co_counts WHERE book_id = ? ORDER BY count DESC, other_id LIMIT ?',
+        (book_id, top_k)
+    )]
+
+
+def write_index(path, conn, changed, top_k, previous=None):
+    """Write a new index: rows of ``changed`` books from the counts, the rest from ``previous``"""
+    max_book_id = max(changed, default=-1)
+    if previous is not None:
+        max_book_id = max(max_book_id, previous.max_book_id)
+
+    indptr, indices, counts, scores = array('I', [0]), array('I'), array('I'), array('f')
+    for book_id in range(max_book_id + 1):
+        if book_id in changed:
+            for other_id, count, score in _top_neighbours(conn, book_id, top_k):
+                indices.append(other_id)
+                counts.append(count)
+                scores.append(score)
+        elif previous is not None:
+            start, end = previous.row(book_id)
+            indices.extend(previous.indices[start:end])
+            counts.extend(previous.counts[start:end])
+            scores.extend(previous.scores[start:end])
+        indptr.append(len(indices))
+
+    header = HEADER.pack(MAGIC, ENDIAN_MARK, FORMAT_VERSION, top_k, len(indptr) - 1, len(indices),
+                         _high_water(conn), time.time())
+    with open(path + '.tmp', 'wb') as handle:
+        handle.write(header)
+        for part in (indptr, indices, counts, scores):
+            part.tofile(handle)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(path + '.tmp', path)
+    return len(indices)
+
+
+def update_recommendations(index_path, counts_path, top_k=DEFAULT_TOP_K, full=False, settle=SETTLE_SECONDS):
+    """Fold new orders into the counts and republish the index; returns an ``UpdateReport``"""
+    if full:
+        for name in (counts_path, counts_path + '-wal', counts_path + '-shm'):
+            if os.path.exists(name):
+                os.remove(name)
+    conn = _connect(counts_path)
+    try:
+        orders, changed = fold_orders(conn, settle)
+
+        previous = None
+        if not full and os.path.exists(index_path):
+            try:
+                previous = RecommendationIndex(index_path)
+            except ValueError:
+                previous = None
+        if previous is None or previous.top_k != top_k:
+            # No usable index to copy rows from: rebuild every row from the counts
+            previous = None
+            changed = {book_id for book_id, in conn.execute('SELECT book_id FROM book_orders')}
+        elif not changed:
+            return UpdateReport(orders, 0, len(previous.indices))
+
+        pairs = write_index(index_path, conn, changed, top_k, previous)
+        return UpdateReport(orders, len(changed), pairs)
+    finally:
+        conn.close()
+
+
+def recommendation_paths(app):
+    """Return the ``(index, counts)`` file paths configured for ``app``"""
+    index_path = app.config.get('RECOMMENDATIONS_PATH') or os.path.join(app.instance_path, 'recommendations.idx')
+    counts_path = app.config.get('RECOMMENDATIONS_COUNTS_PATH') or os.path.join(
+        os.path.dirname(os.path.abspath(index_path)), 'recommendation_counts.db'
+    )
+    return index_path, counts_path
+
+
+def get_recommendation_index():
+    """Return the current app's index, or ``None`` before the first build
+
+    The file is checked for replacement at most every ``RELOAD_INTERVAL``
+    seconds.
+    """
+    app = current_app._get_current_object()
+    now = time.monotonic()
+    entry = _indexes.get(app)
+    if entry is not None and now - entry.checked_at < RELOAD_INTERVAL:
+        return entry.index
+
+    with _lock:
+        entry = _indexes.get(app)
+        if entry is not None and now - entry.checked_at < RELOAD_INTERVAL:
+            return entry.index
+        path = recommendation_paths(app)[0]
+        try:
+            stat = os.stat(path)
+            signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature = None
+        if entry is not None and entry.signature == signature:
+            index = entry.index
+        else:
+            index = RecommendationIndex(path) if signature else None
+        _indexes[app] = _LoadedIndex(index, signature, now)
+    return index
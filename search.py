@@ -0,0 +1,322 @@
+"""Full-text search over the book catalog.
+
+Three interchangeable backends implement the same small interface:
+
+* ``SQLiteSearchIndex`` keeps an FTS5 virtual table next to ``books``.
+* ``PostgresSearchIndex`` ranks a weighted ``tsvector`` expression that is
+  covered by a GIN index, so it needs no separate sync step.
+* ``InMemorySearchIndex`` is a pure Python inverted index used when neither
+  of the above is available.
+
+All of them match every query term, treat each term as a prefix and return
+book ids ordered by relevance. The database structures are created by a
+schema migration (``create_search_structures``), never while serving a
+request, and the indexes write inside the caller's transaction without ever
+committing it. Without the structures the in-memory index is used.
+"""
+import logging
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+from math import log
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.orm import load_only
+from src.models.user import db
+from src.models.ecommerce.book import Book
+
+# Indexed columns and their relative weight when ranking matches
+INDEXED_FIELDS = (
+    ('title', 4.0),
+    ('author', 3.0),
+    ('category', 2.0),
+    ('description', 1.0),
+)
+
+# Weight labels follow INDEXED_FIELDS: title A, author B, category C, description D
+POSTGRES_DOCUMENT = (
+    "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(author, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(category, '')), 'C') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'D')"
+)
+
+SQLITE_FILL = (
+    "INSERT INTO books_fts (rowid, title, author, category, description) "
+    "SELECT id, title, author, category, description FROM books"
+)
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+_lock = threading.Lock()
+_indexes = {}
+
+
+def tokenize(value):
+    """Split ``value`` into lowercase search terms"""
+    return [token.lower() for token in _TOKEN_RE.findall(value or '')]
+
+
+class SearchUnavailable(Exception):
+    """The database has no full-text structures for this backend"""
+
+
+def create_search_structures(conn):
+    """Create and fill the full-text structures for ``conn``'s database
+
+    Run by the schema migrations. SQLite builds without FTS5 are left alone
+    and search from the in-memory index instead.
+    """
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_books_search ON books USING GIN ((%s))" % POSTGRES_DOCUMENT))
+    elif conn.dialect.name == 'sqlite':
+        if not conn.execute(text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar():
+            return
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5("
+            "title, author, category, description, tokenize = 'unicode61')"
+        ))
+        conn.execute(text("DELETE FROM books_fts"))
+        conn.execute(text(SQLITE_FILL))
+
+
+class SearchIndex:
+    """Interface shared by the search backends"""
+
+    name = None
+    # Whether index_book/remove_book write inside the caller's database
+    # transaction; other indexes must only be updated once it has committed
+    transactional = True
+
+    def ensure(self):
+        """Check the backing structures exist (or load the index), raising ``SearchUnavailable`` if not"""
+
+    def index_book(self, book):
+        """Add ``book`` to the index or refresh its entry"""
+
+    def remove_book(self, book_id):
+        """Drop the entry for ``book_id`` from the index"""
+
+    def rebuild(self):
+        """Re-index the whole catalog, e.g. after a bulk import; the caller commits"""
+
+    def search(self, query, limit=20, offset=0):
+        """Return ``(book_ids, total)`` for ``query`` ordered by relevance"""
+        raise NotImplementedError
+
+
+class SQLiteSearchIndex(SearchIndex):
+    """FTS5 index stored in a ``books_fts`` virtual table keyed by book id"""
+
+    name = 'sqlite'
+
+    def ensure(self):
+        exists = db.session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'"
+        )).first()
+        if not exists:
+            raise SearchUnavailable('books_fts is missing; run flask migrate')
+
+    def rebuild(self):
+        db.session.execute(text("DELETE FROM books_fts"))
+        db.session.execute(text(SQLITE_FILL))
+
+    def index_book(self, book):
+        self.remove_book(book.id)
+        db.session.execute(text(
+            "INSERT INTO books_fts (rowid, title, author, category, description) "
+            "VALUES (:id, :title, :author, :category, :description)"
+        ), {
+            'id': book.id,
+            'title': book.title,
+            'author': book.author,
+            'category': book.category,
+            'description': book.description
+        })
+
+    def remove_book(self, book_id):
+        db.session.execute(text("DELETE FROM books_fts WHERE rowid = :id"), {'id': book_id})
+
+    def search(self, query, limit=20, offset=0):
+        terms = tokenize(query)
+        if not terms:
+            return [], 0
+
+        match = ' '.join('"%s"*' % term for term in terms)
+        weights = ', '.join(str(weight) for _, weight in INDEXED_FIELDS)
+        rows = db.session.execute(text(
+            # bm25() is only allowed in a plain full-text query, so rank in a
+            # subquery and count the matches outside it
+            "SELECT rowid, count(*) OVER () FROM ("
+            " SELECT rowid, bm25(books_fts, %s) AS rank FROM books_fts WHERE books_fts MATCH :match"
+            ") ORDER BY rank, rowid LIMIT :limit OFFSET :offset" % weights
+        ), {'match': match, 'limit': limit, 'offset': offset}).all()
+
+        if not rows and offset:
+            total = db.session.execute(text(
+                "SELECT count(*) FROM books_fts WHERE books_fts MATCH :match"
+            ), {'match': match}).scalar()
+            return [], total
+        return [row[0] for row in rows], rows[0][1] if rows else 0
+
+
+class PostgresSearchIndex(SearchIndex):
+    """Weighted ``tsvector`` search backed by a GIN expression index"""
+
+    name = 'postgresql'
+
+    DOCUMENT = POSTGRES_DOCUMENT
+
+    def search(self, query, limit=20, offset=0):
+        terms = tokenize(query)
+        if not terms:
+            return [], 0
+
+        tsquery = ' & '.join('%s:*' % term for term in terms)
+        rows = db.session.execute(text(
+            "SELECT id, count(*) OVER () FROM books, to_tsquery('simple', :query) AS query "
+            "WHERE (%s) @@ query "
+            "ORDER BY ts_rank((%s), query) DESC, id LIMIT :limit OFFSET :offset"
+            % (self.DOCUMENT, self.DOCUMENT)
+        ), {'query': tsquery, 'limit': limit, 'offset': offset}).all()
+
+        if not rows and offset:
+            total = db.session.execute(text(
+                "SELECT count(*) FROM books WHERE (%s) @@ to_tsquery('simple', :query)"
+                % self.DOCUMENT
+            ), {'query': tsquery}).scalar()
+            return [], total
+        return [row[0] for row in rows], rows[0][1] if rows else 0
+
+
+class InMemorySearchIndex(SearchIndex):
+    """Inverted index held in process memory
+
+    Postings map each term to ``{book_id: weight}``; a sorted term list lets
+    prefix lookups run as a bisect plus a short scan instead of a full pass
+    over the vocabulary. Each worker process holds its own copy and only
+    sees catalog writes made through it, so prefer a database backend when
+    running several workers.
+    """
+
+    name = 'memory'
+    transactional = False
+
+    def __init__(self):
+        self._postings = defaultdict(dict)
+        self._terms = []
+        self._book_terms = {}
+        self._lock = threading.RLock()
+        self._loaded = False
+
+    def ensure(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            columns = [Book.id] + [getattr(Book, field) for field, _ in INDEXED_FIELDS]
+            for book in Book.query.options(load_only(*columns)).yield_per(1000):
+                self.index_book(book)
+            self._loaded = True
+
+    def rebuild(self):
+        with self._lock:
+            self._postings.clear()
+            del self._terms[:]
+            self._book_terms.clear()
+            self._loaded = False
+            self.ensure()
+
+    def index_book(self, book):
+        weights = defaultdict(float)
+        for field, weight in INDEXED_FIELDS:
+            for term in tokenize(getattr(book, field)):
+                weights[term] += weight
+
+        with self._lock:
+            self.remove_book(book.id)
+            for term, weight in weights.items():
+                postings = self._postings[term]
+                if not postings:
+                    insort(self._terms, term)
+                postings[book.id] = weight
+            self._book_terms[book.id] = set(weights)
+
+    def remove_book(self, book_id):
+        with self._lock:
+            for term in self._book_terms.pop(book_id, ()):
+                postings = self._postings[term]
+                postings.pop(book_id, None)
+                if not postings:
+                    del self._postings[term]
+                    del self._terms[bisect_left(self._terms, term)]
+
+    def _expand(self, prefix):
+        """Yield every indexed term starting with ``prefix``"""
+        position = bisect_left(self._terms, prefix)
+        while position < len(self._terms) and self._terms[position].startswith(prefix):
+            yield self._terms[position]
+            position += 1
+
+    def search(self, query, limit=20, offset=0):
+        terms = tokenize(query)
+        if not terms:
+            return [], 0
+
+        with self._lock:
+            total_docs = max(len(self._book_terms), 1)
+            scores = None
+            for prefix in terms:
+                matches = defaultdict(float)
+                for term in self._expand(prefix):
+                    postings = self._postings[term]
+                    idf = log(1 + total_docs / len(postings))
+                    for book_id, weight in postings.items():
+                        matches[book_id] += weight * idf
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {book_id: score + matches[book_id]
+                              for book_id, score in scores.items() if book_id in matches}
+                if not scores:
+                    return [], 0
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [book_id for book_id, _ in ranked[offset:offset + limit]], len(ranked)
+
+
+def _create_index():
+    """Pick the best backend for the configured database"""
+    backend = current_app.config.get('SEARCH_BACKEND', 'auto')
+    dialect = db.engine.dialect.name
+
+    if backend in ('auto', 'postgresql') and dialect == 'postgresql':
+        index = PostgresSearchIndex()
+    elif backend in ('auto', 'sqlite') and dialect == 'sqlite':
+        index = SQLiteSearchIndex()
+    else:
+        index = InMemorySearchIndex()
+
+    try:
+        index.ensure()
+    except SearchUnavailable as e:
+        logger.warning('Falling back to in-memory search: %s', e)
+        index = InMemorySearchIndex()
+        index.ensure()
+    return index
+
+
+def get_search_index():
+    """Return the search index for the current app, creating it on first use"""
+    app = current_app._get_current_object()
+    index = _indexes.get(app)
+    if index is None:
+        with _lock:
+            index = _indexes.get(app)
+            if index is None:
+                index = _indexes[app] = _create_index()
+    return index
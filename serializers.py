@@ -0,0 +1,209 @@
+"""Compiled model serializers.
+
+Each model declares a ``Schema`` once. ``Schema.compile`` generates (and
+caches) a specialized Python function per field selection that reads the
+attributes it needs and builds the output dict in a single expression, so
+list endpoints avoid the per-row loop, ``getattr`` calls and ``strftime``
+of a hand-written ``to_dict``. Selections are put in schema order before
+they are looked up and at most ``MAX_COMPILED`` functions are kept per
+schema, so client-chosen ``fields`` cannot grow the cache without bound.
+
+``Schema.row_serializer`` does the same for plain result tuples from
+``select(...)`` so bulk paths can serialize without building ORM objects,
+and ``dumps`` encodes straight to bytes with ``orjson`` when it is
+installed. Callbacks registered with ``on_encode`` are given the time spent
+in every ``dumps`` and ``encode`` call; ``metrics`` uses this to count it as
+serialization time of the current request.
+"""
+import json
+import time
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:  # Optional speedup
+    orjson = None
+
+MAX_COMPILED = 128  # Generated functions kept per schema and kind
+
+
+@lru_cache(maxsize=8192)
+def format_date(value):
+    """Format a date as ``YYYY-MM-DD``, cached since catalogs share few distinct dates"""
+    return value.isoformat()
+
+
+def format_datetime(value):
+    """Format a naive datetime as ``YYYY-MM-DD HH:MM:SS``
+
+    Same output as ``strftime('%Y-%m-%d %H:%M:%S')`` but several times faster.
+    """
+    return value.isoformat(' ', 'seconds')
+
+
+FORMATTERS = {
+    'date': format_date,
+    'datetime': format_datetime
+}
+
+
+_encode_callbacks = []
+
+
+def on_encode(callback):
+    """Call ``callback(seconds)`` after every ``dumps`` and ``encode``"""
+    if callback not in _encode_callbacks:
+        _encode_callbacks.append(callback)
+
+
+def _dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def _encoded(started):
+    elapsed = time.perf_counter() - started
+    for callback in _encode_callbacks:
+        callback(elapsed)
+
+
+def dumps(value):
+    """Encode ``value`` as compact JSON bytes"""
+    if not _encode_callbacks:
+        return _dumps(value)
+    started = time.perf_counter()
+    try:
+        return _dumps(value)
+    finally:
+        _encoded(started)
+
+
+def encode(serialize, obj):
+    """``dumps(serialize(obj))``, timed as one step"""
+    if not _encode_callbacks:
+        return _dumps(serialize(obj))
+    started = time.perf_counter()
+    try:
+        return _dumps(serialize(obj))
+    finally:
+        _encoded(started)
+
+
+class Field:
+    """One output key of a ``Schema``
+
+    By default the value is read from the attribute of the same name.
+    ``formatter`` names a formatter (``'date'``, ``'datetime'``) or is any
+    callable applied to non-null values. ``getter`` computes the value from
+    the whole object instead. ``schema`` serializes a related object, or a
+    collection of them with ``many=True``.
+    """
+
+    def __init__(self, name, formatter=None, attribute=None, getter=None, schema=None, many=False):
+        attribute = attribute or name
+        if not attribute.isidentifier():
+            raise ValueError(f'Invalid attribute name: {attribute!r}')
+        self.name = name
+        self.attribute = attribute
+        self.formatter = FORMATTERS.get(formatter, formatter)
+        self.getter = getter
+        self.schema = schema
+        self.many = many
+
+    @property
+    def is_column(self):
+        """Whether the value comes straight from one column"""
+        return self.getter is None and self.schema is None
+
+
+class Schema:
+    """Declarative description of how a model is serialized"""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = tuple(fields)
+        self.field_names = tuple(field.name for field in self.fields)
+        self._by_name = {field.name: field for field in self.fields}
+        self._compiled = lru_cache(maxsize=MAX_COMPILED)(self._build)
+        self._row_compiled = lru_cache(maxsize=MAX_COMPILED)(self._build_row)
+
+    def _field(self, name):
+        try:
+            return self._by_name[name]
+        except KeyError:
+            raise ValueError(f'Unknown field for {self.name}: {name}')
+
+    def compile(self, fields=None):
+        """Return a function serializing one object, limited to ``fields`` if given
+
+        The output keeps schema order whatever the order of ``fields``.
+        """
+        if not fields:
+            return self._compiled(self.field_names)
+        wanted = frozenset(fields)
+        for name in wanted:
+            self._field(name)
+        return self._compiled(tuple(name for name in self.field_names if name in wanted))
+
+    def _build(self, names):
+        namespace = {}
+        lines = ['def serialize(obj):']
+        items = []
+        for index, name in enumerate(names):
+            field = self._field(name)
+            source = f'obj.{field.attribute}'
+            if field.getter is not None:
+                namespace[f'_get{index}'] = field.getter
+                value = f'_get{index}(obj)'
+            elif field.schema is not None:
+                namespace[f'_nested{index}'] = field.schema.compile()
+                if field.many:
+                    value = f'[_nested{index}(item) for item in {source}]'
+                else:
+                    lines.append(f'    v{index} = {source}')
+                    value = f'_nested{index}(v{index}) if v{index} is not None else None'
+            elif field.formatter is not None:
+                namespace[f'_format{index}'] = field.formatter
+                lines.append(f'    v{index} = {source}')
+                value = f'_format{index}(v{index}) if v{index} is not None else None'
+            else:
+                value = source
+            items.append(f'{name!r}: {value}')
+        lines.append('    return {%s}' % ', '.join(items))
+        exec(compile('\n'.join(lines), f'<{self.name} serializer>', 'exec'), namespace)
+        return namespace['serialize']
+
+    def row_serializer(self, columns):
+        """Return a function serializing result tuples laid out as ``columns``
+
+        Only column-backed fields can be used; the tuple positions are baked
+        into the generated function.
+        """
+        return self._row_compiled(tuple(columns))
+
+    def _build_row(self, key):
+        namespace = {}
+        items = []
+        for index, name in enumerate(key):
+            field = self._field(name)
+            if not field.is_column:
+                raise ValueError(f'{self.name}.{name} is not a column field')
+            if field.formatter is not None:
+                namespace[f'_format{index}'] = field.formatter
+                value = f'_format{index}(row[{index}]) if row[{index}] is not None else None'
+            else:
+                value = f'row[{index}]'
+            items.append(f'{name!r}: {value}')
+        source = 'def serialize(row):\n    return {%s}' % ', '.join(items)
+        exec(compile(source, f'<{self.name} row serializer>', 'exec'), namespace)
+        return namespace['serialize']
+
+    def serialize(self, obj, fields=None):
+        """Serialize one object to a dict"""
+        return self.compile(fields)(obj)
+
+    def serialize_many(self, objects, fields=None):
+        """Serialize an iterable of objects to a list of dicts"""
+        serialize = self.compile(fields)
+        return [serialize(obj) for obj in objects]
@@ -0,0 +1,72 @@
+"""Health checks and pre-fork warm up for the production server.
+
+``/healthz`` is a liveness probe: it answers as long as the worker can run
+Python. ``/readyz`` is the readiness probe load balancers should route on; it
+fails with 503 until the app has been warmed and while the database is
+unreachable.
+"""
+import os
+import time
+
+from flask import current_app, jsonify
+from sqlalchemy import text
+
+DEFAULT_WARMUP_PATHS = ('/',)
+
+
+def warm_up(app):
+    """Compile every template and prime caches by requesting ``WARMUP_PATHS``
+
+    With ``preload_app`` this runs once in the gunicorn master so the work is
+    shared copy-on-write by every worker; otherwise each worker warms itself.
+    """
+    started = time.perf_counter()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    client = app.test_client()
+    for path in app.config.get('WARMUP_PATHS', DEFAULT_WARMUP_PATHS):
+        client.get(path).close()
+
+    app.extensions['server']['warmed_up'] = True
+    app.extensions['server']['warm_up_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+
+def _database_ready():
+    sqlalchemy = current_app.extensions.get('sqlalchemy')
+    if sqlalchemy is None:
+        return True
+    try:
+        with sqlalchemy.engine.connect() as conn:
+            conn.execute(text('SELECT 1'))
+    except Exception:
+        return False
+    return True
+
+
+def healthz():
+    """Liveness probe"""
+    return jsonify({'status': 'ok'})
+
+
+def readyz():
+    """Readiness probe"""
+    state = current_app.extensions['server']
+    checks = {
+        'warmed_up': state['warmed_up'] or not current_app.config.get('REQUIRE_WARMUP', False),
+        'database': _database_ready()
+    }
+    ready = all(checks.values())
+    return jsonify({
+        'status': 'ready' if ready else 'unavailable',
+        'checks': checks,
+        'warm_up_ms': state['warm_up_ms']
+    }), 200 if ready else 503
+
+
+def init_server(app):
+    """Register the health check routes"""
+    app.config.setdefault('REQUIRE_WARMUP', os.environ.get('REQUIRE_WARMUP') == '1')
+    app.extensions['server'] = {'warmed_up': False, 'warm_up_ms': None}
+    app.add_url_rule('/healthz', 'healthz', healthz)
+    app.add_url_rule('/readyz', 'readyz', readyz)
@@ -0,0 +1,289 @@
+"""Static build of the catalog and content pages.
+
+``flask site build`` renders the homepage, catalog listings, one page per
+category, one page per book and the content pages from the site navigation
+into a directory of ``index.html`` files, plus ``sitemap.xml`` and
+``robots.txt``. Page data is loaded once in the parent process and rendering
+is spread over a process pool, each worker holding its own Jinja
+``Environment`` so compiled templates are reused across the pages it renders.
+
+Builds are incremental. ``.site-manifest.json`` records, per page, a hash of
+its template together with every template it extends, includes or imports,
+and a hash of its data; a page is only re-rendered when one of them changed
+or its file is missing, and files of pages that no longer exist are removed.
+The web tier then only needs to serve the API and the cart and checkout
+routes.
+"""
+import hashlib
+import json
+import os
+import re
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from jinja2 import Environment, FileSystemLoader, meta, select_autoescape
+from sqlalchemy import func
+from src.models.user import db
+from src.models.ecommerce.book import BOOK_SCHEMA, Book
+from src.models.ecommerce.order import OrderItem
+from src.page_cache import FragmentCacheExtension
+
+MANIFEST_NAME = '.site-manifest.json'
+DEFAULT_OUTPUT_DIR = 'build/site'
+HOME_FEATURED_LIMIT = 4
+NEW_RELEASES_LIMIT = 24
+BESTSELLERS_LIMIT = 24
+PAGES_PER_TASK = 50
+
+# Content pages from the site navigation, rendered when their template exists
+CONTENT_PAGES = {
+    'about/': 'about.html',
+    'contact/': 'contact.html',
+    'faq/': 'faq.html',
+    'privacy/': 'privacy.html',
+    'terms/': 'terms.html',
+    'returns/': 'returns.html'
+}
+
+Page = namedtuple('Page', ['path', 'template', 'context', 'lastmod'])
+BuildReport = namedtuple('BuildReport', ['rendered', 'unchanged', 'removed'])
+
+site_cli = AppGroup('site', help='Build the static site.')
+
+_SLUG_RE = re.compile(r'[^a-z0-9]+')
+
+
+def slugify(text):
+    return _SLUG_RE.sub('-', (text or '').lower()).strip('-')
+
+
+def book_path(book):
+    return f'books/{slugify(book["title"])}-{book["id"]}/'
+
+
+def category_path(category):
+    return f'books/category/{slugify(category)}/'
+
+
+def create_environment(template_dir, asset_manifest=None):
+    """Build the Jinja environment pages are rendered with, outside of any Flask app"""
+    asset_manifest = asset_manifest or {}
+
+    def asset_url(name):
+        hashed = asset_manifest.get(name)
+        return f'/assets/{hashed}' if hashed else f'/static/{name}'
+
+    def url_for(endpoint, **values):
+        if endpoint == 'static':
+            return f'/static/{values["filename"]}'
+        if endpoint == 'assets':
+            return f'/assets/{values["filename"]}'
+        raise ValueError(f'url_for({endpoint!r}) is not available in static builds')
+
+    env = Environment(
+        loader=FileSystemLoader(template_dir),
+        autoescape=select_autoescape(),
+        extensions=[FragmentCacheExtension]
+    )
+    env.globals.update(asset_url=asset_url, url_for=url_for)
+    return env
+
+
+def template_hashes(env):
+    """Hash every template together with all the templates it depends on
+
+    A template with a dynamic ``extends``/``include`` may pull in anything,
+    so it is hashed against the whole template directory.
+    """
+    sources, references = {}, {}
+    for name in env.list_templates():
+        source = env.loader.get_source(env, name)[0]
+        sources[name] = source
+        references[name] = set(meta.find_referenced_templates(env.parse(source)))
+
+    everything = hashlib.sha256()
+    for name in sorted(sources):
+        everything.update(name.encode('utf-8') + b'\0' + sources[name].encode('utf-8'))
+
+    hashes = {}
+    for name in sources:
+        seen, pending = set(), [name]
+        while pending:
+            current = pending.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+            pending.extend(reference for reference in references.get(current, ()) if reference)
+        if None in set().union(*(references.get(dependency, set()) for dependency in seen)):
+            hashes[name] = everything.hexdigest()
+            continue
+        digest = hashlib.sha256()
+        for dependency in sorted(seen):
+            digest.update(dependency.encode('utf-8') + b'\0' + sources.get(dependency, '').encode('utf-8'))
+        hashes[name] = digest.hexdigest()
+    return hashes
+
+
+def _data_hash(context):
+    return hashlib.sha256(json.dumps(context, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def collect_pages(templates):
+    """Load the catalog once and return a ``Page`` for every page to publish
+
+    Only pages whose template is in ``templates`` are returned.
+    """
+    books = BOOK_SCHEMA.serialize_many(Book.query.order_by(Book.id))
+    by_id = {book['id']: book for book in books}
+    categories = sorted({book['category'] for book in books if book['category']})
+    newest = sorted(books, key=lambda book: (book['created_at'] or '', book['id']), reverse=True)
+
+    sold = db.session.query(OrderItem.book_id, func.sum(OrderItem.quantity).label('sold')) \
+        .group_by(OrderItem.book_id) \
+        .order_by(func.sum(OrderItem.quantity).desc(), OrderItem.book_id) \
+        .limit(BESTSELLERS_LIMIT)
+    bestsellers = [by_id[book_id] for book_id, _ in sold if book_id in by_id]
+
+    def updated(items):
+        return max((book['updated_at'] for book in items if book['updated_at']), default=None)
+
+    pages = [
+        Page('', 'index.html', {
+            'featured_books': [book for book in books if book['featured']][:HOME_FEATURED_LIMIT],
+            'new_releases': newest[:NEW_RELEASES_LIMIT]
+        }, updated(books)),
+        Page('books/', 'books.html', {'books': books, 'categories': categories}, updated(books)),
+        Page('books/new-releases/', 'new_releases.html', {'books': newest[:NEW_RELEASES_LIMIT]},
+             updated(newest[:NEW_RELEASES_LIMIT])),
+        Page('books/bestsellers/', 'bestsellers.html', {'books': bestsellers}, updated(bestsellers)),
+    ]
+    for category in categories:
+        members = [book for book in books if book['category'] == category]
+        pages.append(Page(category_path(category), 'category.html',
+                          {'category': category, 'books': members}, updated(members)))
+    for book in books:
+        pages.append(Page(book_path(book), 'book.html', {'book': book}, book['updated_at']))
+    for path, template in CONTENT_PAGES.items():
+        pages.append(Page(path, template, {}, None))
+
+    return [page for page in pages if page.template in templates]
+
+
+_worker_env = None
+
+
+def _init_worker(template_dir, asset_manifest):
+    global _worker_env
+    _worker_env = create_environment(template_dir, asset_manifest)
+
+
+def _render_pages(output_dir, pages):
+    """Render a batch of ``(path, template, context)`` in a worker process"""
+    for path, template, context in pages:
+        html = _worker_env.get_template(template).render(context, page_path='/' + path)
+        target = os.path.join(output_dir, path, 'index.html')
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target + '.tmp', 'w', encoding='utf-8') as handle:
+            handle.write(html)
+        os.replace(target + '.tmp', target)
+    return len(pages)
+
+
+def write_sitemap(output_dir, base_url, pages):
+    """Write ``sitemap.xml`` and a ``robots.txt`` pointing at it"""
+    base_url = base_url.rstrip('/')
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+    ]
+    for page in sorted(pages, key=lambda page: page.path):
+        lines.append(f'  <url><loc>{escape(f"{base_url}/{page.path}")}</loc>'
+                     + (f'<lastmod>{page.lastmod[:10]}</lastmod>' if page.lastmod else '')
+                     + '</url>')
+    lines.append('</urlset>')
+    with open(os.path.join(output_dir, 'sitemap.xml'), 'w', encoding='utf-8') as handle:
+        handle.write('\n'.join(lines) + '\n')
+    with open(os.path.join(output_dir, 'robots.txt'), 'w', encoding='utf-8') as handle:
+        handle.write(f'User-agent: *\nDisallow: /api/\nDisallow: /cart/\nSitemap: {base_url}/sitemap.xml\n')
+
+
+def build_site(template_dir, output_dir, base_url, asset_manifest=None, workers=None, force=False):
+    """Render every stale page into ``output_dir`` and return a ``BuildReport``"""
+    os.makedirs(output_dir, exist_ok=True)
+    env = create_environment(template_dir, asset_manifest)
+    hashes = template_hashes(env)
+    pages = collect_pages(hashes)
+
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    try:
+        with open(manifest_path, encoding='utf-8') as handle:
+            previous = json.load(handle)
+    except (OSError, ValueError):
+        previous = {}
+
+    manifest, stale = {}, []
+    for page in pages:
+        state = {'template': hashes[page.template], 'data': _data_hash(page.context)}
+        manifest[page.path] = state
+        target = os.path.join(output_dir, page.path, 'index.html')
+        if force or previous.get(page.path) != state or not os.path.exists(target):
+            stale.append((page.path, page.template, page.context))
+
+    if stale:
+        chunks = [stale[start:start + PAGES_PER_TASK] for start in range(0, len(stale), PAGES_PER_TASK)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(template_dir, asset_manifest or {})) as executor:
+            for _ in executor.map(_render_pages, [output_dir] * len(chunks), chunks):
+                pass
+
+    removed = 0
+    for path in set(previous) - set(manifest):
+        target = os.path.join(output_dir, path, 'index.html')
+        if os.path.exists(target):
+            os.remove(target)
+            removed += 1
+            try:
+                os.rmdir(os.path.dirname(target))
+            except OSError:
+                pass
+
+    write_sitemap(output_dir, base_url, pages)
+    with open(manifest_path, 'w', encoding='utf-8') as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+    return BuildReport(len(stale), len(pages) - len(stale), removed)
+
+
+@site_cli.command('build')
+@click.option('--output', default=None, help=f'Output directory [default: {DEFAULT_OUTPUT_DIR}]')
+@click.option('--base-url', default=None, help='Absolute site URL used in the sitemap [default: SITE_URL]')
+@click.option('--workers', type=int, default=None, help='Render processes [default: CPU count]')
+@click.option('--force', is_flag=True, help='Re-render every page')
+def build_command(output, base_url, workers, force):
+    """Render the catalog and content pages to static HTML"""
+    app = current_app
+    base_url = base_url or app.config.get('SITE_URL')
+    if not base_url:
+        raise click.UsageError('Pass --base-url or set SITE_URL')
+
+    started = time.perf_counter()
+    report = build_site(
+        os.path.join(app.root_path, app.template_folder),
+        output or app.config.get('STATIC_SITE_DIR', DEFAULT_OUTPUT_DIR),
+        base_url,
+        asset_manifest=app.extensions.get('assets'),
+        workers=workers,
+        force=force
+    )
+    elapsed = time.perf_counter() - started
+    click.echo(f'Rendered {report.rendered}, unchanged {report.unchanged}, '
+               f'removed {report.removed} in {elapsed:.2f}s')
+
+
+def init_static_site(app):
+    """Register the ``flask site`` CLI group"""
+    app.cli.add_command(site_cli)
@@ -0,0 +1,42 @@
+"""Chunked JSON responses for large result sets.
+
+``stream_json_response`` writes the usual ``{"success": true, "<key>": [...]}``
+envelope but encodes the list one element at a time from an iterator, so a
+query consumed with ``yield_per`` never has more than one batch of rows and
+one chunk of output in memory, and the first bytes leave before the last
+row is read. Encoding each element counts as serialization time of the
+request in ``metrics``, even though it happens after the view returned.
+"""
+import json
+
+from flask import Response, stream_with_context
+from src.models.ecommerce.serializers import encode
+
+DEFAULT_CHUNK_SIZE = 100
+
+
+def iter_json_list(key, items, serialize, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the encoded envelope for ``items`` in chunks of ``chunk_size`` elements"""
+    yield ('{"success":true,%s:[' % json.dumps(key)).encode('utf-8')
+
+    chunk = []
+    separator = b''
+    for item in items:
+        chunk.append(encode(serialize, item))
+        if len(chunk) >= chunk_size:
+            yield separator + b','.join(chunk)
+            separator = b','
+            chunk = []
+
+    if chunk:
+        yield separator + b','.join(chunk)
+    yield b']}'
+
+
+def stream_json_response(key, items, serialize, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Return a chunked ``application/json`` response listing ``items`` under ``key``"""
+    return Response(
+        stream_with_context(iter_json_list(key, items, serialize, chunk_size)),
+        status=200,
+        mimetype='application/json'
+    )
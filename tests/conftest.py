@@ -0,0 +1,51 @@
+import pytest
+from flask import Flask
+from src.models.user import db
+from src.database import init_database
+from src.models.ecommerce.book import Book
+from src.models.ecommerce.book_routes import book_bp
+from src.models.ecommerce.cart_routes import cart_bp
+from src.models.ecommerce.order_routes import order_bp
+
+
+@pytest.fixture
+def app_config():
+    """Extra settings for the ``app`` fixture; override in a test module"""
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, app_config):
+    """App bound to a fresh SQLite file, so several threads can share the database"""
+    app = Flask(__name__)
+    app.config.update(
+        TESTING=True,
+        SQLALCHEMY_DATABASE_URI=f'sqlite:///{tmp_path / "test.db"}',
+        SQLALCHEMY_ENGINE_OPTIONS={'connect_args': {'timeout': 30}},
+        **app_config
+    )
+    init_database(app)
+    for blueprint in (book_bp, cart_bp, order_bp):
+        app.register_blueprint(blueprint, url_prefix='/api')
+    with app.app_context():
+        for engine in db.engines.values():
+            db.metadata.create_all(engine)
+        yield app
+        db.session.remove()
+        for engine in db.engines.values():
+            db.metadata.drop_all(engine)
+
+
+@pytest.fixture
+def make_book(app):
+    def make_book(**fields):
+        book = Book(**{'title': 'Book', 'author': 'Author', 'price': 10.0, 'stock': 10, **fields})
+        db.session.add(book)
+        db.session.commit()
+        return book
+    return make_book
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
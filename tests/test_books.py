@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+import pytest
+from src.models.user import db
+
+
+def _backdate(book, created_at):
+    book.created_at = created_at
+    db.session.commit()
+    return book
+
+
+@pytest.fixture
+def catalog(make_book):
+    start = datetime(2024, 1, 1)
+    # Pairs of books share a created_at so the id tiebreak is exercised
+    return [_backdate(make_book(title=f'Book {index}'), start + timedelta(days=index // 2)) for index in range(7)]
+
+
+def _pages(client, query, limit=3):
+    ids, cursor = [], None
+    while True:
+        body = client.get('/api/books', query_string={
+            **query, 'limit': limit, **({'cursor': cursor} if cursor else {})
+        }).get_json()
+        ids.extend(book['id'] for book in body['books'])
+        cursor = body['next_cursor']
+        if cursor is None:
+            return ids
+
+
+@pytest.mark.parametrize('query, key, reverse', [
+    ({}, lambda book: book.id, False),
+    ({'order_by': 'created_at'}, lambda book: (book.created_at, book.id), False),
+    ({'order_by': 'created_at', 'order': 'desc'}, lambda book: (book.created_at, book.id), True),
+])
+def test_pages_cover_the_listing_once_in_order(catalog, client, query, key, reverse):
+    assert _pages(client, query) == [book.id for book in sorted(catalog, key=key, reverse=reverse)]
+
+
+def test_cursor_is_stable_when_rows_are_added_before_it(catalog, client, make_book):
+    first = client.get('/api/books?order_by=created_at&limit=3').get_json()
+    _backdate(make_book(title='Backdated'), datetime(2023, 1, 1))
+
+    second = client.get('/api/books', query_string={
+        'order_by': 'created_at', 'limit': 3, 'cursor': first['next_cursor']
+    }).get_json()
+
+    assert [book['id'] for book in second['books']] == [catalog[3].id, catalog[4].id, catalog[5].id]
+
+
+def test_fields_limit_the_keys_returned(catalog, client):
+    body = client.get('/api/books?limit=2&fields=title,price').get_json()
+
+    assert [sorted(book) for book in body['books']] == [['id', 'price', 'title']] * 2
+
+
+@pytest.mark.parametrize('query, message', [
+    ({'limit': 2, 'fields': 'title,secret'}, 'Unknown field: secret'),
+    ({'limit': 'many'}, 'limit must be an integer'),
+    ({'limit': 2, 'order_by': 'price'}, 'order_by must be id or created_at'),
+    ({'cursor': 'not-a-cursor'}, 'Invalid cursor'),
+])
+def test_bad_parameters_are_rejected(catalog, client, query, message):
+    response = client.get('/api/books', query_string=query)
+
+    assert response.status_code == 400
+    assert response.get_json()['message'].startswith(message)
+
+
+def test_cursor_only_fits_its_own_ordering(catalog, client):
+    cursor = client.get('/api/books?limit=2').get_json()['next_cursor']
+
+    response = client.get('/api/books', query_string={'order_by': 'created_at', 'cursor': cursor})
+
+    assert response.status_code == 400
+
+
+def test_limit_is_capped(app, client, make_book):
+    for index in range(105):
+        make_book(title=f'Book {index}')
+
+    body = client.get('/api/books?limit=500').get_json()
+
+    assert len(body['books']) == 100
+    assert body['next_cursor'] is not None
@@ -0,0 +1,147 @@
+import threading
+
+import pytest
+from src.models.user import db
+from src.models.ecommerce.cart import CartItem
+from src.models.ecommerce.query_stats import count_queries
+
+
+def _add(client, book_id, quantity, **extra):
+    return client.post('/api/cart/add', json={'user_id': 1, 'book_id': book_id, 'quantity': quantity, **extra})
+
+
+def test_add_returns_the_line_and_totals(client, make_book):
+    book = make_book(price=12.5)
+
+    _add(client, book.id, 1)
+    response = _add(client, book.id, 2)
+
+    body = response.get_json()
+    assert response.status_code == 200
+    assert body['cart_item']['quantity'] == 3
+    assert (body['item_count'], body['quantity'], body['total']) == (1, 3, 37.5)
+
+
+def test_add_is_one_write(client, make_book):
+    book = make_book()
+
+    with count_queries() as counter:
+        _add(client, book.id, 1)
+
+    writes = [statement for statement in counter.statements if not statement.lstrip().startswith('SELECT')]
+    assert len(writes) == 1
+    assert 'ON CONFLICT' in writes[0]
+
+
+def test_concurrent_adds_share_one_line(app, make_book):
+    book_id = make_book().id
+    barrier = threading.Barrier(8)
+
+    def add():
+        with app.app_context():
+            barrier.wait()
+            CartItem.add(1, book_id, 1)
+            db.session.commit()
+
+    threads = [threading.Thread(target=add) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    db.session.expire_all()
+    assert [(item.book_id, item.quantity) for item in CartItem.query.all()] == [(book_id, 8)]
+
+
+def test_add_of_a_missing_book_is_404(client):
+    assert _add(client, 999, 1).status_code == 404
+
+
+@pytest.mark.parametrize('quantity', [0, -2])
+def test_add_refuses_non_positive_quantities(client, make_book, quantity):
+    book = make_book()
+
+    assert _add(client, book.id, quantity).status_code == 400
+    assert CartItem.query.count() == 0
+    with pytest.raises(ValueError):
+        CartItem.add(1, book.id, quantity)
+
+
+@pytest.mark.parametrize('operation', [
+    {'op': 'add', 'quantity': 0},
+    {'op': 'add', 'quantity': -1},
+    {'op': 'update', 'quantity': -5},
+])
+def test_batch_refuses_non_positive_quantities(client, make_book, operation):
+    book = make_book()
+    _add(client, book.id, 2)
+
+    response = client.post('/api/cart/batch', json={
+        'user_id': 1, 'operations': [{**operation, 'book_id': book.id}]
+    })
+
+    assert response.status_code == 400
+    assert CartItem.query.one().quantity == 2
+
+
+def test_totals_are_one_aggregate_query(app, make_book):
+    cheap, dear = make_book(price=2.5), make_book(price=12.0)
+    db.session.add_all([CartItem(1, cheap.id, 4), CartItem(1, dear.id, 1), CartItem(2, dear.id, 7)])
+    db.session.commit()
+
+    with count_queries() as counter:
+        totals = CartItem.totals_for(1)
+
+    assert counter.count == 1
+    assert (totals.item_count, totals.quantity, totals.total) == (2, 5, 22.0)
+
+
+def test_empty_cart_totals_are_zero(app):
+    assert tuple(CartItem.totals_for(1)) == (0, 0, 0.0)
+
+
+def test_summary_prices_the_cart_at_current_prices(client, make_book):
+    book = make_book(price=3.0)
+    _add(client, book.id, 3)
+    book.price = 4.0
+    db.session.commit()
+
+    body = client.get('/api/cart/summary?user_id=1').get_json()
+
+    assert (body['item_count'], body['quantity'], body['total']) == (1, 3, 12.0)
+
+
+def _cart(client):
+    body = client.get('/api/cart?user_id=1').get_json()
+    return {key: body[key] for key in ('cart_items', 'total', 'item_count', 'quantity')}
+
+
+@pytest.fixture
+def filled_cart(client, make_book):
+    books = [make_book(price=5.0), make_book(price=8.0)]
+    for book in books:
+        _add(client, book.id, 2)
+    return [line['id'] for line in _cart(client)['cart_items']]
+
+
+@pytest.mark.parametrize('mutate', [
+    lambda client, ids: client.put('/api/cart/update?include_cart=1',
+                                   json={'user_id': 1, 'cart_item_id': ids[0], 'quantity': 5}),
+    lambda client, ids: client.delete(f'/api/cart/remove/{ids[1]}?user_id=1&include_cart=1'),
+    lambda client, ids: client.post('/api/cart/batch?include_cart=1', json={'user_id': 1, 'operations': [
+        {'op': 'update', 'cart_item_id': ids[0], 'quantity': 1}, {'op': 'remove', 'cart_item_id': ids[1]}
+    ]}),
+    lambda client, ids: client.delete('/api/cart/clear?user_id=1&include_cart=1'),
+])
+def test_mutations_return_the_cart_a_refetch_would(client, filled_cart, mutate):
+    body = mutate(client, filled_cart).get_json()
+
+    assert body['success']
+    assert {key: body[key] for key in ('cart_items', 'total', 'item_count', 'quantity')} == _cart(client)
+
+
+def test_cart_is_only_returned_on_request(client, filled_cart):
+    body = client.put('/api/cart/update', json={'user_id': 1, 'cart_item_id': filled_cart[0], 'quantity': 3}).get_json()
+
+    assert body['success']
+    assert 'cart_items' not in body
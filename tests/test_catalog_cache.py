@@ -0,0 +1,88 @@
+import time
+
+from src.models.ecommerce.catalog_cache import LRUCache, RedisCache, get_catalog_cache
+from src.models.ecommerce.query_stats import count_queries
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, name):
+        return self.data.get(name)
+
+    def set(self, name, value, ex=None):
+        self.data[name] = value.encode('utf-8') if isinstance(value, str) else value
+
+    def delete(self, *names):
+        for name in names:
+            self.data.pop(name, None)
+
+    def scan_iter(self, match):
+        return [name for name in list(self.data) if name.startswith(match.rstrip('*'))]
+
+
+def test_cache_hits_skip_the_database(app, client, make_book):
+    book = make_book(title='Cached')
+    first = client.get(f'/api/books/{book.id}')
+
+    with count_queries() as counter:
+        second = client.get(f'/api/books/{book.id}')
+
+    assert counter.count == 0
+    assert second.data == first.data
+
+
+def test_admin_writes_invalidate_detail_and_listings(app, client, make_book):
+    book = make_book(title='Before', category='Cozy')
+    client.get(f'/api/books/{book.id}')
+    client.get('/api/books?category=Cozy')
+    client.get('/api/books')
+
+    assert client.put(f'/api/admin/books/{book.id}', json={'title': 'After', 'category': 'Noir'}).status_code == 200
+
+    assert client.get(f'/api/books/{book.id}').get_json()['book']['title'] == 'After'
+    assert client.get('/api/books?category=Cozy').get_json()['books'] == []
+    assert [item['title'] for item in client.get('/api/books?category=Noir').get_json()['books']] == ['After']
+    assert [item['title'] for item in client.get('/api/books').get_json()['books']] == ['After']
+
+
+def test_deleted_book_is_not_served_from_the_cache(app, client, make_book):
+    book = make_book()
+    client.get(f'/api/books/{book.id}')
+
+    client.delete(f'/api/admin/books/{book.id}')
+
+    assert client.get(f'/api/books/{book.id}').status_code == 404
+
+
+def test_lru_evicts_the_least_recent_entry_and_expires_old_ones():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set('a', b'1')
+    cache.set('b', b'2')
+    cache.get('a')
+    cache.set('c', b'3')
+
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (b'1', None, b'3')
+
+    cache.set('short', b'4', ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get('short') is None
+
+
+def test_redis_backend_prefixes_and_clears_only_its_keys():
+    client = FakeRedis()
+    client.set('other', 'kept')
+    cache = RedisCache(client)
+
+    cache.set('book:1', b'{}')
+    assert cache.get('book:1') == b'{}'
+    assert 'catalog:book:1' in client.data
+
+    cache.clear()
+    assert client.data == {'other': b'kept'}
+
+
+def test_app_cache_defaults_to_the_in_process_lru(app):
+    assert get_catalog_cache() is get_catalog_cache()
+    assert isinstance(get_catalog_cache(), LRUCache)
@@ -0,0 +1,67 @@
+import io
+import json
+
+from src.models.user import db
+from src.models.ecommerce.book import Book
+from src.models.ecommerce.catalog_io import import_books, read_csv
+
+CSV_HEADER = 'isbn,title,author,price,stock\n'
+
+
+def _records(*isbns):
+    return [(row_number, {'isbn': isbn, 'title': f'Title {isbn}', 'author': 'Author', 'price': '9.99'})
+            for row_number, isbn in enumerate(isbns, start=1)]
+
+
+def test_invalid_rows_are_reported_and_the_rest_imported(app, client):
+    body = CSV_HEADER + (
+        '111,First,Ann,10,3\n'
+        '222,,Bob,10,3\n'
+        '333,Third,Cid,cheap,3\n'
+        '444,Fourth,Dee,12.5,-1\n'
+        '555,Fifth,Eve,7,1\n'
+    )
+
+    response = client.post('/api/admin/books/import?format=csv', data=body)
+
+    report = response.get_json()
+    assert response.status_code == 200
+    assert (report['inserted'], report['updated'], report['error_count']) == (2, 0, 3)
+    assert [error['row'] for error in report['errors']] == [2, 3, 4]
+    assert 'title' in report['errors'][0]['message']
+    assert sorted(isbn for isbn, in db.session.query(Book.isbn)) == ['111', '555']
+
+
+def test_reimport_updates_on_isbn(app):
+    import_books(read_csv(io.StringIO(CSV_HEADER + '111,First,Ann,10,3\n')))
+
+    report = import_books(read_csv(io.StringIO(CSV_HEADER + '111-,First edition,Ann,12,5\n')))
+
+    assert (report.inserted, report.updated) == (0, 1)
+    book = Book.query.filter_by(isbn='111').one()
+    assert (book.title, book.price, book.stock) == ('First edition', 12.0, 5)
+
+
+def test_rejected_batch_is_rolled_back_and_reported(app):
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE TRIGGER reject_isbn BEFORE INSERT ON books WHEN NEW.isbn = '666'"
+            " BEGIN SELECT RAISE(ABORT, 'isbn rejected'); END"
+        )
+
+    report = import_books(_records('111', '222', '666', '333', '444'), batch_size=2)
+
+    assert (report.inserted, report.updated, report.error_count) == (3, 0, 2)
+    assert [error['row'] for error in report.errors] == [3, 4]
+    assert 'isbn rejected' in report.errors[0]['message']
+    assert sorted(isbn for isbn, in db.session.query(Book.isbn)) == ['111', '222', '444']
+
+
+def test_export_streams_every_book(app, client, make_book):
+    make_book(title='Exported', isbn='999')
+
+    response = client.get('/api/admin/books/export?format=jsonl')
+
+    rows = [json.loads(line) for line in response.data.decode('utf-8').splitlines() if line]
+    assert response.status_code == 200
+    assert [(row['isbn'], row['title']) for row in rows] == [('999', 'Exported')]
@@ -0,0 +1,116 @@
+import threading
+
+import pytest
+from src.models.user import db
+from src.models.ecommerce.book import Book
+from src.models.ecommerce.cart import CartItem
+from src.models.ecommerce.checkout import EmptyCartError, InvalidQuantityError, OutOfStockError, place_order
+from src.models.ecommerce.order import Order
+
+BUYERS = 16
+
+
+def _checkout_concurrently(app, user_ids):
+    """Run ``place_order`` for every user at once; return ``{user_id: order or exception}``"""
+    barrier = threading.Barrier(len(user_ids))
+    results = {}
+
+    def buy(user_id):
+        with app.app_context():
+            barrier.wait()
+            try:
+                order, _ = place_order(user_id, 'Ship to', 'Bill to')
+                results[user_id] = order.id
+            except Exception as error:
+                results[user_id] = error
+
+    threads = [threading.Thread(target=buy, args=(user_id,)) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_last_copy_is_sold_once(app, make_book):
+    book_id = make_book(stock=1).id
+    user_ids = list(range(1, BUYERS + 1))
+    db.session.add_all([CartItem(user_id, book_id, 1) for user_id in user_ids])
+    db.session.commit()
+
+    results = _checkout_concurrently(app, user_ids)
+
+    orders = [result for result in results.values() if isinstance(result, int)]
+    failures = [result for result in results.values() if not isinstance(result, int)]
+    assert len(orders) == 1
+    assert all(isinstance(error, OutOfStockError) for error in failures), failures
+    assert len(failures) == BUYERS - 1
+
+    db.session.expire_all()
+    assert db.session.get(Book, book_id).stock == 0
+    assert Order.query.count() == 1
+    # Buyers who missed out keep their cart line
+    assert CartItem.query.count() == BUYERS - 1
+
+
+def test_retry_returns_the_original_order(app, make_book):
+    book_id = make_book(stock=5).id
+    db.session.add(CartItem(1, book_id, 1))
+    db.session.commit()
+
+    first, first_created = place_order(1, 'Ship to', 'Bill to', idempotency_key='retry-key')
+    retry, retry_created = place_order(1, 'Ship to', 'Bill to', idempotency_key='retry-key')
+
+    assert first_created and not retry_created
+    assert retry.id == first.id
+    db.session.expire_all()
+    assert db.session.get(Book, book_id).stock == 4
+
+
+def test_idempotency_keys_are_per_user(app, make_book):
+    book_id = make_book(stock=5).id
+    db.session.add_all([CartItem(1, book_id, 1), CartItem(2, book_id, 1)])
+    db.session.commit()
+
+    first, first_created = place_order(1, 'Ship to', 'Bill to', idempotency_key='shared-key')
+    second, second_created = place_order(2, 'Ship to', 'Bill to', idempotency_key='shared-key')
+
+    assert first_created and second_created
+    assert first.id != second.id
+    assert second.user_id == 2
+    db.session.expire_all()
+    assert db.session.get(Book, book_id).stock == 3
+
+
+def test_empty_cart_is_refused(app):
+    with pytest.raises(EmptyCartError):
+        place_order(1, 'Ship to', 'Bill to')
+
+
+@pytest.mark.parametrize('quantity', [0, -3])
+def test_non_positive_lines_are_refused(app, make_book, quantity):
+    book_id = make_book(stock=0, price=30.0).id
+    db.session.add(CartItem(1, book_id, quantity))
+    db.session.commit()
+
+    with pytest.raises(InvalidQuantityError):
+        place_order(1, 'Ship to', 'Bill to')
+
+    db.session.expire_all()
+    assert db.session.get(Book, book_id).stock == 0
+    assert Order.query.count() == 0
+
+
+@pytest.mark.parametrize('path', ['/api/checkout', '/api/checkout/pay'])
+def test_checkout_routes_share_validation(client, make_book, path):
+    book_id = make_book(stock=1).id
+    db.session.add(CartItem(1, book_id, 2))
+    db.session.commit()
+
+    missing = client.post(path, json={'user_id': 1, 'shipping_address': 'Ship to'})
+    short = client.post(path, json={'user_id': 1, 'shipping_address': 'Ship to', 'billing_address': 'Bill to'})
+
+    assert missing.status_code == 400
+    assert missing.get_json()['message'] == 'Missing required field: billing_address'
+    assert short.status_code == 409
+    assert short.get_json()['book_ids'] == [book_id]
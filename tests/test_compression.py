@@ -0,0 +1,65 @@
+import gzip
+
+import pytest
+from src.assets import compress_response
+from src.models.ecommerce import book_routes
+
+
+@pytest.fixture
+def app_config():
+    return {'COMPRESS_MIN_SIZE': 256}
+
+
+@pytest.fixture
+def catalog(app, make_book):
+    app.after_request(compress_response)
+    return [make_book(title=f'Book {index}', description='A cold case. ' * 10) for index in range(10)]
+
+
+@pytest.fixture
+def compressions(monkeypatch):
+    calls = []
+
+    def counting_gzip(body):
+        calls.append(len(body))
+        return gzip.compress(body)
+
+    monkeypatch.setattr(book_routes, 'gzip_body', counting_gzip)
+    return calls
+
+
+def test_json_is_gzipped_only_when_accepted(catalog, client):
+    plain = client.get('/api/books?fields=title,description', headers={'Accept-Encoding': 'identity'})
+    compressed = client.get('/api/books?fields=title,description', headers={'Accept-Encoding': 'gzip'})
+
+    assert 'Content-Encoding' not in plain.headers
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+    assert gzip.decompress(compressed.data) == plain.data
+
+
+def test_small_bodies_are_sent_as_is(catalog, client):
+    response = client.get('/api/books?category=Unknown&fields=title', headers={'Accept-Encoding': 'gzip'})
+
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_cached_listing_is_compressed_once(catalog, client, compressions):
+    plain = client.get('/api/books', headers={'Accept-Encoding': 'identity'})
+    first = client.get('/api/books', headers={'Accept-Encoding': 'gzip'})
+    second = client.get('/api/books', headers={'Accept-Encoding': 'gzip'})
+
+    assert len(compressions) == 1
+    assert first.headers['Content-Encoding'] == second.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(second.data) == plain.data
+
+
+def test_write_replaces_the_cached_gzip_variant(catalog, client, compressions):
+    client.get('/api/books', headers={'Accept-Encoding': 'gzip'})
+
+    assert client.put(f'/api/admin/books/{catalog[0].id}', json={'price': 42.0}).status_code == 200
+    response = client.get('/api/books', headers={'Accept-Encoding': 'gzip'})
+
+    assert len(compressions) == 2
+    assert b'42.0' in gzip.decompress(response.data)
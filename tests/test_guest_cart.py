@@ -0,0 +1,142 @@
+import pytest
+from src.models.user import db
+from src.models.ecommerce.book import Book
+from src.models.ecommerce.cart import CartItem
+from src.models.ecommerce.cart_routes import _guest_update
+from src.models.ecommerce.order import Order
+from src.models.ecommerce.payments import PaymentGateway, PaymentIntent
+from src.models.ecommerce.query_stats import count_queries
+
+
+@pytest.fixture
+def guest_app(app):
+    app.secret_key = 'test-secret'
+    return app
+
+
+def test_guest_cart_lives_in_the_cookie(guest_app, client, make_book):
+    book = make_book(price=7.5)
+
+    with count_queries() as counter:
+        response = client.post('/api/cart/add', json={'book_id': book.id, 'quantity': 2})
+
+    assert response.status_code == 200
+    assert response.get_json()['total'] == 15.0
+    assert not [statement for statement in counter.statements if not statement.lstrip().startswith('SELECT')]
+    assert CartItem.query.count() == 0
+    assert client.get('/api/cart').get_json()['quantity'] == 2
+
+
+@pytest.mark.parametrize('payload', [
+    {'book_id': 'abc', 'quantity': 1},
+    {'book_id': None, 'quantity': 1},
+    {'book_id': 1, 'quantity': 'many'},
+])
+def test_add_rejects_non_numeric_ids(guest_app, client, make_book, payload):
+    make_book()
+
+    assert client.post('/api/cart/add', json=payload).status_code == 400
+    assert client.post('/api/cart/add', json={**payload, 'user_id': 1}).status_code == 400
+
+
+class FakeGateway(PaymentGateway):
+    def create_intent(self, order_id, amount, currency='usd'):
+        return PaymentIntent(f'pi_{order_id}', f'pi_{order_id}_secret', 'requires_payment_method', amount,
+                             {'order_id': str(order_id)})
+
+
+def test_guest_cart_checks_out_and_pays(guest_app, client, make_book):
+    guest_app.config['PAYMENT_GATEWAY'] = FakeGateway()
+    book = make_book(price=6.0, stock=5)
+    db.session.add(CartItem(1, book.id, 3))  # The demo user's cart must not be checked out
+    db.session.commit()
+    client.post('/api/cart/add', json={'book_id': book.id, 'quantity': 2})
+
+    response = client.post('/api/checkout/pay', json={
+        'user_id': None, 'shipping_address': 'Ship to', 'billing_address': 'Bill to'
+    })
+
+    assert response.status_code == 201
+    body = response.get_json()
+    assert body['clientSecret'] == f"pi_{body['order']['id']}_secret"
+    assert body['order']['total_amount'] == 12.0
+    assert 'guest_cart=;' in response.headers['Set-Cookie']
+    order = db.session.get(Order, body['order']['id'])
+    assert order.user_id is None
+    assert [(item.book_id, item.quantity) for item in order.items] == [(book.id, 2)]
+    assert db.session.get(Book, book.id).stock == 3
+    assert CartItem.query.filter_by(user_id=1).one().quantity == 3
+
+
+def test_empty_guest_cart_cannot_check_out(guest_app, client, make_book):
+    make_book()
+
+    response = client.post('/api/checkout', json={'shipping_address': 'Ship to', 'billing_address': 'Bill to'})
+
+    assert response.status_code == 400
+    assert Order.query.count() == 0
+
+
+def test_checkout_merges_the_guest_cart_of_a_signed_in_user(guest_app, client, make_book):
+    book = make_book(price=4.0)
+    client.post('/api/cart/add', json={'book_id': book.id, 'quantity': 2})
+
+    response = client.post('/api/checkout', json={
+        'user_id': 5, 'shipping_address': 'Ship to', 'billing_address': 'Bill to'
+    })
+
+    assert response.status_code == 201
+    assert response.get_json()['order']['total_amount'] == 8.0
+    assert 'guest_cart=;' in response.headers['Set-Cookie']
+
+
+@pytest.mark.parametrize('cart_item_id', ['abc', None, [1]])
+def test_update_rejects_non_numeric_cart_item_ids(guest_app, client, make_book, cart_item_id):
+    make_book()
+
+    assert client.put('/api/cart/update', json={'cart_item_id': cart_item_id, 'quantity': 1}).status_code == 400
+    assert client.put('/api/cart/update', json={
+        'cart_item_id': cart_item_id, 'quantity': 1, 'user_id': 1
+    }).status_code == 400
+
+
+def test_update_takes_string_ids_and_removes_at_zero(guest_app, client, make_book):
+    book = make_book()
+    client.post('/api/cart/add', json={'book_id': book.id, 'quantity': 1})
+
+    response = client.put('/api/cart/update', json={'cart_item_id': str(book.id), 'quantity': 4})
+    assert response.status_code == 200
+    assert response.get_json()['quantity'] == 4
+
+    response = client.put('/api/cart/update', json={'cart_item_id': book.id, 'quantity': 0})
+    assert response.status_code == 200
+    assert response.get_json()['cart_items'] == []
+
+
+def test_batch_converts_cart_item_ids_and_refuses_non_positive_quantities(guest_app, client, make_book):
+    book = make_book()
+    client.post('/api/cart/add', json={'book_id': book.id, 'quantity': 1})
+
+    response = client.post('/api/cart/batch', json={'operations': [
+        {'op': 'update', 'cart_item_id': str(book.id), 'quantity': 3}
+    ]})
+    assert response.status_code == 200
+    assert response.get_json()['quantity'] == 3
+
+    for quantity in (0, -2):
+        response = client.post('/api/cart/batch', json={'operations': [
+            {'op': 'add', 'book_id': book.id, 'quantity': quantity}
+        ]})
+        assert response.status_code == 400
+    assert client.get('/api/cart').get_json()['quantity'] == 3
+
+
+def test_dropped_line_is_a_bad_request(guest_app, make_book):
+    book = make_book()
+
+    with guest_app.test_request_context():
+        response, status = _guest_update({book.id: 1}, [{'op': 'remove', 'book_id': book.id}], 'Removed',
+                                         book_id=book.id)
+
+    assert status == 400
+    assert not response.get_json()['success']
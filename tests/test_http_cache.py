@@ -0,0 +1,46 @@
+import pytest
+from src.models.ecommerce.query_stats import count_queries
+
+
+@pytest.fixture
+def catalog(make_book):
+    return [make_book(title=f'Book {index}', category='Cozy') for index in range(5)]
+
+
+@pytest.mark.parametrize('path', [
+    '/api/books?limit=2',
+    '/api/books?category=Cozy',
+    '/api/books?fields=title',
+    '/api/books/featured',
+])
+def test_listing_revalidates_without_touching_the_database(catalog, client, path):
+    with count_queries() as counter:
+        first = client.get(path)
+    assert first.status_code == 200
+    assert not [statement for statement in counter.statements if 'count(' in statement.lower()]
+
+    with count_queries() as counter:
+        response = client.get(path, headers={'If-None-Match': first.headers['ETag']})
+
+    assert response.status_code == 304
+    assert counter.count == 0
+
+
+def test_pages_and_filters_get_their_own_tags(catalog, client):
+    tags = {client.get(path).headers['ETag'] for path in (
+        '/api/books?limit=2',
+        f"/api/books?limit=2&cursor={client.get('/api/books?limit=2').get_json()['next_cursor']}",
+        '/api/books?limit=2&category=Cozy',
+    )}
+
+    assert len(tags) == 3
+
+
+def test_catalog_write_changes_the_listing_tag(catalog, client):
+    first = client.get('/api/books?limit=2')
+
+    assert client.put(f'/api/admin/books/{catalog[4].id}', json={'price': 99.0}).status_code == 200
+
+    response = client.get('/api/books?limit=2', headers={'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != first.headers['ETag']
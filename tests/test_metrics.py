@@ -0,0 +1,48 @@
+import pytest
+from src.models.user import db
+from src.metrics import DB_QUERIES, SERIALIZE_TIME, init_metrics
+from src.models.ecommerce.order import Order
+
+
+@pytest.fixture
+def metered(app):
+    init_metrics(app)
+    return app
+
+
+def _observed(histogram, endpoint):
+    """``(sum, count)`` recorded so far for ``endpoint``"""
+    _, total, count = histogram._values.get((endpoint,), (None, 0.0, 0))
+    return total, count
+
+
+def test_streamed_body_counts_towards_serialization(metered, client):
+    db.session.add_all([Order(1, 10.0, 'Ship to', 'Bill to') for _ in range(300)])
+    db.session.commit()
+    serialized, requests = _observed(SERIALIZE_TIME, 'order.get_orders')
+    queries, _ = _observed(DB_QUERIES, 'order.get_orders')
+
+    response = client.get('/api/orders?user_id=1&stream=true')
+    assert len(response.get_json()['orders']) == 300
+    response.close()
+
+    after_serialized, after_requests = _observed(SERIALIZE_TIME, 'order.get_orders')
+    after_queries, _ = _observed(DB_QUERIES, 'order.get_orders')
+    assert after_requests == requests + 1
+    assert after_serialized > serialized
+    # Rows are fetched while the body streams: orders, then their items per batch
+    assert after_queries - queries >= 2
+
+
+def test_encoded_rows_count_towards_serialization(metered, client, make_book):
+    for index in range(50):
+        make_book(title=f'Book {index}')
+    serialized, requests = _observed(SERIALIZE_TIME, 'book.get_books')
+
+    response = client.get('/api/books?limit=50')
+
+    assert response.status_code == 200
+    assert 'serialize;dur=' in response.headers['Server-Timing']
+    after_serialized, after_requests = _observed(SERIALIZE_TIME, 'book.get_books')
+    assert after_requests == requests + 1
+    assert after_serialized > serialized
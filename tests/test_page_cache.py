@@ -0,0 +1,74 @@
+import time
+
+import pytest
+from flask import render_template_string
+from jinja2 import Environment
+from src.page_cache import FragmentCacheExtension, cached_page, init_page_cache
+from src.models.ecommerce.catalog_cache import FEATURED_VERSION, invalidate_book
+
+FRAGMENT = "{% cache 'greeting', 'featured' %}{{ render() }}{% endcache %}"
+
+
+@pytest.fixture
+def renders(app):
+    calls = []
+
+    def render():
+        calls.append(time.time())
+        return f'<p>render {len(calls)}</p>'
+
+    app.add_url_rule('/home', 'home', lambda: cached_page('home', render, versions=(FEATURED_VERSION,)))
+    init_page_cache(app)
+    return calls
+
+
+def test_page_is_rendered_once_per_data_version(client, renders):
+    first = client.get('/home')
+    second = client.get('/home')
+
+    assert len(renders) == 1
+    assert first.data == second.data == b'<p>render 1</p>'
+
+    invalidate_book(featured=True)
+    assert client.get('/home').data == b'<p>render 2</p>'
+
+
+def test_conditional_request_gets_a_304(client, renders):
+    etag = client.get('/home').headers['ETag']
+
+    response = client.get('/home', headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert len(renders) == 1
+
+
+def test_stale_page_is_served_while_it_renders_in_the_background(app, client, renders):
+    app.config['PAGE_CACHE_TTL'] = 0
+    client.get('/home')
+
+    assert client.get('/home').data == b'<p>render 1</p>'
+    for _ in range(100):
+        if len(renders) == 2:
+            break
+        time.sleep(0.01)
+
+    assert len(renders) == 2
+    assert client.get('/home').data == b'<p>render 2</p>'
+
+
+def test_fragment_is_cached_per_data_version(app):
+    init_page_cache(app)
+    counter = iter(range(1, 10))
+
+    with app.test_request_context('/'):
+        assert render_template_string(FRAGMENT, render=lambda: next(counter)) == '1'
+        assert render_template_string(FRAGMENT, render=lambda: next(counter)) == '1'
+
+        invalidate_book(featured=True)
+        assert render_template_string(FRAGMENT, render=lambda: next(counter)) == '2'
+
+
+def test_fragment_renders_inline_outside_the_app():
+    env = Environment(extensions=[FragmentCacheExtension])
+
+    assert env.from_string(FRAGMENT).render(render=lambda: 'inline') == 'inline'
@@ -0,0 +1,103 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from src.models.user import db
+from src.models.ecommerce.order import Order
+from src.models.ecommerce.payments import PaymentGateway, PaymentIntent, PaymentJob, PaymentJobs
+
+
+class FakeGateway(PaymentGateway):
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def create_intent(self, order_id, amount, currency='usd'):
+        self.calls.append(order_id)
+        self.release.wait(5)
+        return PaymentIntent(f'pi_{order_id}', f'pi_{order_id}_secret', 'requires_payment_method', amount,
+                             {'order_id': str(order_id)})
+
+
+@pytest.fixture
+def gateway(app):
+    gateway = app.config['PAYMENT_GATEWAY'] = FakeGateway()
+    return gateway
+
+
+@pytest.fixture
+def order(app):
+    order = Order(1, 12.5, 'Ship to', 'Bill to')
+    db.session.add(order)
+    db.session.commit()
+    return order
+
+
+def _poll(client, job_id, user_id=1):
+    for _ in range(100):
+        response = client.get(f'/api/payment/create-intent/{job_id}?user_id={user_id}')
+        if response.get_json().get('status') != 'pending':
+            return response
+        time.sleep(0.01)
+    return response
+
+
+def test_job_is_served_from_the_database(client, gateway, order):
+    response = client.post('/api/payment/create-intent', json={'order_id': order.id, 'user_id': 1, 'async': True})
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+    assert len(job_id) == 32
+
+    response = _poll(client, job_id)
+    assert response.get_json() == {'success': True, 'status': 'done', 'clientSecret': f'pi_{order.id}_secret'}
+    db.session.expire_all()
+    assert db.session.get(Order, order.id).payment_id == f'pi_{order.id}'
+
+    # Another worker, with its own thread pool, sees the same job
+    assert PaymentJobs(gateway).status(job_id, 1)[0] == 'done'
+
+
+def test_jobs_are_only_shown_to_the_order_owner(client, gateway, order):
+    response = client.post('/api/payment/create-intent', json={'order_id': order.id, 'user_id': 2, 'async': True})
+    assert response.status_code == 404
+
+    job_id = client.post('/api/payment/create-intent',
+                         json={'order_id': order.id, 'user_id': 1, 'async': True}).get_json()['job_id']
+    assert client.get(f'/api/payment/create-intent/{job_id}?user_id=2').status_code == 404
+    assert client.get('/api/payment/create-intent/order-1-intent?user_id=1').status_code == 404
+
+
+def test_only_the_owner_creates_an_intent_synchronously(client, gateway, order):
+    response = client.post('/api/payment/create-intent', json={'order_id': order.id, 'user_id': 2})
+
+    assert response.status_code == 404
+    assert gateway.calls == []
+    assert db.session.get(Order, order.id).payment_id is None
+
+    response = client.post('/api/payment/create-intent', json={'order_id': order.id, 'user_id': 1})
+    assert response.status_code == 200
+    assert gateway.calls == [order.id]
+
+
+def test_resubmitting_reuses_the_job(client, gateway, order):
+    gateway.release.clear()
+    payload = {'order_id': order.id, 'user_id': 1, 'async': True}
+    first = client.post('/api/payment/create-intent', json=payload).get_json()['job_id']
+    second = client.post('/api/payment/create-intent', json=payload).get_json()['job_id']
+    gateway.release.set()
+
+    assert first == second
+    assert _poll(client, first).get_json()['status'] == 'done'
+    assert gateway.calls == [order.id]
+
+
+def test_stale_pending_job_is_run_again(client, gateway, order):
+    job = PaymentJob(id='stale-job', order_id=order.id, user_id=1, amount=1250)
+    job.updated_at = datetime.utcnow() - timedelta(minutes=5)
+    db.session.add(job)
+    db.session.commit()
+
+    assert _poll(client, 'stale-job').get_json()['status'] == 'done'
+    assert gateway.calls == [order.id]
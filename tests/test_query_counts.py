@@ -0,0 +1,51 @@
+import pytest
+from src.models.user import db
+from src.models.ecommerce.cart import CartItem
+from src.models.ecommerce.order import Order, OrderItem
+from src.models.ecommerce.query_stats import assert_max_queries
+
+# Round trips each read path may take, however many rows it returns
+ROUTE_QUERIES = [
+    ('/api/books', 2),  # Listing validators, then the books
+    ('/api/books?category=Crime%20Thriller', 2),
+    ('/api/books/featured', 2),
+    ('/api/cart?user_id=1', 1),  # Lines joined with their books
+    ('/api/orders?user_id=1', 2),  # Orders, then every item with its book title
+]
+
+
+@pytest.fixture
+def shop(app, make_book):
+    """Fill the catalog, user 1's cart and order history with ``size`` books"""
+    def shop(size):
+        books = [make_book(title=f'Book {index}', category='Crime Thriller', featured=True) for index in range(size)]
+        db.session.add_all([CartItem(1, book.id, 1) for book in books])
+        for book in books:
+            order = Order(1, book.price, 'Ship to', 'Bill to')
+            order.items = [OrderItem(None, other.id, 1, other.price) for other in books[:3]]
+            db.session.add(order)
+        db.session.commit()
+        db.session.expunge_all()
+    return shop
+
+
+@pytest.mark.parametrize('size', [1, 50])
+@pytest.mark.parametrize('path, limit', ROUTE_QUERIES)
+def test_read_paths_take_constant_queries(shop, client, path, limit, size):
+    shop(size)
+
+    with assert_max_queries(limit):
+        response = client.get(path)
+
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('path', ['/api/books', '/api/books/featured'])
+def test_cached_listing_only_revalidates(shop, client, path):
+    shop(50)
+    client.get(path)
+
+    with assert_max_queries(1):
+        response = client.get(path)
+
+    assert response.status_code == 200
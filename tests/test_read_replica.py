@@ -0,0 +1,53 @@
+import pytest
+from flask import Flask
+from src.database import REPLICA_BIND, init_database
+from src.models.user import db
+from src.models.ecommerce.cart import CartItem
+
+
+@pytest.fixture
+def app_config(tmp_path):
+    # A replica that never catches up: anything read from it is missing
+    return {
+        'DATABASE_REPLICA_URL': f'sqlite:///{tmp_path / "replica.db"}',
+        'DATABASE_REPLICA_LAG': 60,
+        'DATABASE_REPLICA_SINGLE_PROCESS': True
+    }
+
+
+def test_replica_serves_users_without_recent_writes(app, client, make_book):
+    book = make_book()
+    db.session.add(CartItem(1, book.id, 1))
+    db.session.commit()
+    order_id = client.post('/api/checkout', json={
+        'user_id': 1, 'shipping_address': 'Ship to', 'billing_address': 'Bill to'
+    }).get_json()['order']['id']
+
+    assert client.get(f'/api/orders/{order_id}?user_id=2').status_code == 404
+
+
+def test_order_is_read_from_the_primary_after_checkout(app, client, make_book):
+    book = make_book()
+    db.session.add(CartItem(1, book.id, 1))
+    db.session.commit()
+
+    response = client.post('/api/checkout', json={
+        'user_id': 1, 'shipping_address': 'Ship to', 'billing_address': 'Bill to'
+    })
+    order_id = response.get_json()['order']['id']
+
+    assert client.get(f'/api/orders/{order_id}?user_id=1').status_code == 200
+    assert len(client.get('/api/orders?user_id=1').get_json()['orders']) == 1
+
+
+@pytest.mark.parametrize('config, replica', [
+    ({'DATABASE_REPLICA_SINGLE_PROCESS': False}, False),
+    ({'DATABASE_REPLICA_SINGLE_PROCESS': False, 'CATALOG_CACHE_REDIS_URL': 'redis://cache:6379/0'}, True),
+])
+def test_replica_needs_a_shared_cache(tmp_path, app_config, config, replica):
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI=f'sqlite:///{tmp_path / "primary.db"}', **{**app_config, **config})
+
+    init_database(app)
+
+    assert (REPLICA_BIND in app.config.get('SQLALCHEMY_BINDS', {})) is replica
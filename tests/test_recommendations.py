@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+
+import pytest
+from src.models.user import db
+from src.models.ecommerce.order import Order, OrderItem
+from src.models.ecommerce.recommendations import PAYMENT_WINDOW_SECONDS, RecommendationIndex, update_recommendations
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / 'recommendations.idx'), str(tmp_path / 'counts.db')
+
+
+@pytest.fixture
+def place(app, make_book):
+    books = [make_book(title=f'Book {index}').id for index in range(4)]
+
+    def place(book_indexes, status='paid', age=3600):
+        order = Order(1, 10.0, 'Ship to', 'Bill to')
+        order.status = status
+        order.created_at = datetime.utcnow() - timedelta(seconds=age)
+        order.items = [OrderItem(None, books[index], 1, 10.0) for index in book_indexes]
+        db.session.add(order)
+        db.session.commit()
+        return order
+    place.books = books
+    return place
+
+
+def _neighbours(paths, book_id):
+    return [neighbour.book_id for neighbour in RecommendationIndex(paths[0]).neighbours(book_id)]
+
+
+def test_only_paid_orders_are_counted(paths, place):
+    place([0, 1], status='cancelled')
+    place([0, 2], status='shipped')
+
+    report = update_recommendations(*paths)
+
+    assert report.orders == 1
+    assert _neighbours(paths, place.books[0]) == [place.books[2]]
+
+
+def test_orders_paid_after_a_run_are_counted_later(paths, place):
+    pending = place([0, 1], status='pending')
+    place([0, 2])
+
+    update_recommendations(*paths)
+    assert _neighbours(paths, place.books[0]) == []
+
+    pending.status = 'paid'
+    db.session.commit()
+    update_recommendations(*paths)
+
+    assert sorted(_neighbours(paths, place.books[0])) == sorted(place.books[1:3])
+    assert update_recommendations(*paths, full=True).orders == 2
+    assert sorted(_neighbours(paths, place.books[0])) == sorted(place.books[1:3])
+
+
+def test_abandoned_orders_do_not_hold_the_job_back(paths, place):
+    place([0, 1], status='pending', age=PAYMENT_WINDOW_SECONDS + 60)
+    place([0, 2])
+
+    update_recommendations(*paths)
+
+    assert _neighbours(paths, place.books[0]) == [place.books[2]]
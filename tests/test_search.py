@@ -0,0 +1,69 @@
+import pytest
+from src.models.user import db
+from src.migrations import upgrade
+from src.models.ecommerce.query_stats import count_queries
+from src.models.ecommerce.search import get_search_index
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def app_config(request):
+    return {'SEARCH_BACKEND': request.param}
+
+
+@pytest.fixture
+def catalog(app, make_book):
+    books = [
+        make_book(title='The Cold Case', author='Ann Wright', description='A detective story'),
+        make_book(title='Harbour Lights', author='Bob Marsh', description='A cold winter'),
+        make_book(title='Silent Witness', author='Cid Lane', category='Crime Thriller'),
+    ]
+    upgrade()
+    return books
+
+
+def _search(client, query):
+    body = client.get('/api/books/search', query_string={'q': query}).get_json()
+    return [book['id'] for book in body['books']], body['total']
+
+
+def test_terms_are_prefixes_and_title_matches_rank_first(catalog, client, app_config):
+    assert get_search_index().name == app_config['SEARCH_BACKEND']
+
+    assert _search(client, 'col') == ([catalog[0].id, catalog[1].id], 2)
+    assert _search(client, 'crime thrill') == ([catalog[2].id], 1)
+    assert _search(client, 'nothing') == ([], 0)
+
+
+def test_admin_writes_are_searchable_at_once(catalog, client):
+    assert client.put(f'/api/admin/books/{catalog[2].id}', json={'title': 'Quiet Harbour'}).status_code == 200
+    assert _search(client, 'silent') == ([], 0)
+    assert _search(client, 'quiet') == ([catalog[2].id], 1)
+
+    created = client.post('/api/admin/books', json={'title': 'Harbour Nights', 'author': 'Dee', 'price': 5})
+    assert _search(client, 'harbour')[1] == 3
+
+    assert client.delete(f"/api/admin/books/{created.get_json()['book']['id']}").status_code == 200
+    assert _search(client, 'harbour')[1] == 2
+
+
+def test_opening_the_index_runs_no_ddl_and_never_commits(app, make_book):
+    # No migration: the FTS table is missing and must not be created here
+    book = make_book(title='Pending')
+    book.title = 'Renamed'
+
+    with count_queries() as counter:
+        get_search_index()
+    db.session.rollback()
+
+    assert not [statement for statement in counter.statements
+                if statement.lstrip().split()[0].upper() in ('CREATE', 'ALTER', 'DROP', 'DELETE', 'INSERT')]
+    assert db.session.get(type(book), book.id).title == 'Pending'
+
+
+def test_missing_fts_table_falls_back_to_memory(app, make_book):
+    make_book(title='Unmigrated')
+
+    index = get_search_index()
+
+    assert index.name == 'memory'
+    assert index.search('unmigrated')[1] == 1
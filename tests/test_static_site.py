@@ -0,0 +1,81 @@
+import os
+
+import pytest
+from src.models.user import db
+from src.static_site import build_site
+
+TEMPLATES = {
+    'base.html': '<html>{% block body %}{% endblock %}</html>',
+    'index.html': '{% extends "base.html" %}{% block body %}{{ new_releases|length }} new{% endblock %}',
+    'book.html': '{% extends "base.html" %}{% block body %}{{ book.title }}{% endblock %}',
+    'category.html': '{{ category }}: {{ books|map(attribute="title")|join(", ") }}',
+}
+
+
+@pytest.fixture
+def site(tmp_path, make_book):
+    template_dir = tmp_path / 'templates'
+    template_dir.mkdir()
+    for name, source in TEMPLATES.items():
+        (template_dir / name).write_text(source)
+    books = [make_book(title='Cold Case', category='Crime'), make_book(title='Warm Welcome', category='Cozy')]
+    output_dir = tmp_path / 'site'
+
+    def build():
+        return build_site(str(template_dir), str(output_dir), 'https://example.com/', workers=1)
+
+    return books, template_dir, output_dir, build
+
+
+def _read(output_dir, path):
+    return (output_dir / path / 'index.html').read_text()
+
+
+def test_build_writes_pages_sitemap_and_robots(site):
+    books, _, output_dir, build = site
+
+    report = build()
+
+    assert (report.rendered, report.unchanged, report.removed) == (5, 0, 0)
+    assert _read(output_dir, '') == '<html>2 new</html>'
+    assert _read(output_dir, f'books/cold-case-{books[0].id}') == '<html>Cold Case</html>'
+    assert _read(output_dir, 'books/category/crime') == 'Crime: Cold Case'
+    sitemap = (output_dir / 'sitemap.xml').read_text()
+    assert f'<loc>https://example.com/books/cold-case-{books[0].id}/</loc>' in sitemap
+    assert 'Sitemap: https://example.com/sitemap.xml' in (output_dir / 'robots.txt').read_text()
+
+
+def test_rebuild_only_renders_what_changed(site):
+    books, _, output_dir, build = site
+    build()
+
+    assert build().rendered == 0
+
+    books[0].title = 'Colder Case'
+    db.session.commit()
+    report = build()
+
+    # The book under its new path, its category and the homepage listing it
+    assert (report.rendered, report.removed) == (3, 1)
+    assert not (output_dir / f'books/cold-case-{books[0].id}').exists()
+    assert _read(output_dir, f'books/colder-case-{books[0].id}') == '<html>Colder Case</html>'
+
+
+def test_editing_a_base_template_rerenders_its_children(site):
+    _, template_dir, output_dir, build = site
+    build()
+
+    (template_dir / 'base.html').write_text('<main>{% block body %}{% endblock %}</main>')
+    report = build()
+
+    # Every page extending base.html; the category pages do not
+    assert report.rendered == 3
+    assert _read(output_dir, '') == '<main>2 new</main>'
+
+
+def test_missing_output_file_is_rendered_again(site):
+    books, _, output_dir, build = site
+    build()
+    os.remove(output_dir / f'books/warm-welcome-{books[1].id}' / 'index.html')
+
+    assert build().rendered == 1
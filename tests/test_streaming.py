@@ -0,0 +1,40 @@
+import json
+
+import pytest
+from src.models.user import db
+from src.models.ecommerce.order import Order
+from src.models.ecommerce.streaming import iter_json_list
+
+
+@pytest.mark.parametrize('count', [0, 1, 3, 7])
+def test_chunks_join_into_the_json_envelope(count):
+    chunks = list(iter_json_list('items', [{'n': n} for n in range(count)], lambda item: item, chunk_size=3))
+
+    assert json.loads(b''.join(chunks)) == {'success': True, 'items': [{'n': n} for n in range(count)]}
+    # Envelope start and end plus one chunk per three items
+    assert len(chunks) == 2 + -(-count // 3)
+
+
+def test_streamed_catalog_matches_the_plain_listing(app, client, make_book):
+    for index in range(5):
+        make_book(title=f'Book {index}')
+
+    response = client.get('/api/books?stream=true&fields=title', buffered=False)
+    assert response.is_streamed
+    body = json.loads(b''.join(response.response))
+    response.close()
+
+    assert body == client.get('/api/books?fields=title').get_json()
+
+
+def test_streamed_orders_are_the_users_in_id_order(app, client):
+    db.session.add_all([Order(1, 5.0, 'Ship to', 'Bill to'), Order(2, 6.0, 'Ship to', 'Bill to'),
+                        Order(1, 7.0, 'Ship to', 'Bill to')])
+    db.session.commit()
+
+    response = client.get('/api/orders?user_id=1&stream=true', buffered=False)
+    assert response.is_streamed
+    body = json.loads(b''.join(response.response))
+    response.close()
+
+    assert [order['total_amount'] for order in body['orders']] == [5.0, 7.0]
@@ -0,0 +1,218 @@
+"""Durable local queue for payment webhook events.
+
+The webhook route only verifies the signature and appends the raw event to
+a SQLite file in WAL mode, keyed on the Stripe event id, so redeliveries of
+the same event are dropped by the primary key and the request is answered in
+well under a millisecond. ``flask order process-webhooks`` drains the queue
+in batches: every event in a batch is applied to its order inside its own
+savepoint and the whole batch is committed to the main database at once,
+which keeps write transactions on ``orders`` few and short during payment
+spikes.
+
+Applying an event is idempotent (see ``checkout.apply_payment_event``), so a
+worker that dies between committing a batch and marking it done only
+repeats work that changes nothing. Every claimed event ends its batch either
+done or back in ``pending`` with its attempt counted; events that keep
+failing are parked as ``failed`` (the dead letters) after ``MAX_ATTEMPTS``
+and can be retried with ``requeue_failed``. A batch that cannot be committed
+does not stop the worker: it backs off, up to ``MAX_BACKOFF`` seconds, and
+tries again. One worker per queue file is expected.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app
+from src.database import mark_written
+from src.models.user import db
+from src.models.ecommerce.checkout import apply_payment_event
+from src.models.ecommerce.order import orders_version
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_POLL_INTERVAL = 0.5
+MAX_ATTEMPTS = 5
+MAX_BACKOFF = 60
+
+logger = logging.getLogger(__name__)
+
+QueuedEvent = namedtuple('QueuedEvent', ['event_id', 'payload', 'attempts'])
+BatchResult = namedtuple('BatchResult', ['processed', 'failed'])
+
+_lock = threading.Lock()
+_queues = {}
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS webhook_events ('
+    ' event_id TEXT PRIMARY KEY,'
+    ' type TEXT NOT NULL,'
+    ' payload BLOB NOT NULL,'
+    " status TEXT NOT NULL DEFAULT 'pending',"
+    ' attempts INTEGER NOT NULL DEFAULT 0,'
+    ' last_error TEXT,'
+    ' received_at REAL NOT NULL,'
+    ' processed_at REAL'
+    ') WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS ix_webhook_events_pending'
+    " ON webhook_events (received_at) WHERE status = 'pending'"
+)
+
+
+class WebhookQueue:
+    """SQLite-backed queue of webhook events, deduplicated by event id"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        for statement in SCHEMA:
+            conn.execute(statement)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Survives process crashes; only an OS crash can lose the last commits
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def enqueue(self, event_id, event_type, payload):
+        """Store an event; returns ``False`` if one with this id was already received"""
+        cursor = self._conn().execute(
+            'INSERT OR IGNORE INTO webhook_events (event_id, type, payload, received_at) VALUES (?, ?, ?, ?)',
+            (event_id, event_type, payload, time.time())
+        )
+        return cursor.rowcount == 1
+
+    def claim(self, limit=DEFAULT_BATCH_SIZE):
+        """Mark up to ``limit`` of the oldest pending events as processing and return them"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                "SELECT event_id, payload, attempts FROM webhook_events WHERE status = 'pending'"
+                ' ORDER BY received_at LIMIT ?', (limit,)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE webhook_events SET status = 'processing' WHERE event_id = ?",
+                [(row[0],) for row in rows]
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return [QueuedEvent(*row) for row in rows]
+
+    def complete(self, event_ids):
+        self._conn().executemany(
+            "UPDATE webhook_events SET status = 'done', processed_at = ?, last_error = NULL WHERE event_id = ?",
+            [(time.time(), event_id) for event_id in event_ids]
+        )
+
+    def fail(self, event_id, error):
+        """Record a failed attempt, parking the event once it has used up its retries"""
+        self._conn().execute(
+            'UPDATE webhook_events SET attempts = attempts + 1, last_error = ?,'
+            " status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END"
+            ' WHERE event_id = ?', (error, MAX_ATTEMPTS, event_id)
+        )
+
+    def requeue_stale(self):
+        """Return events claimed by a worker that died to the pending state"""
+        return self._conn().execute(
+            "UPDATE webhook_events SET status = 'pending' WHERE status = 'processing'"
+        ).rowcount
+
+    def requeue_failed(self):
+        """Give parked events a fresh set of attempts"""
+        return self._conn().execute(
+            "UPDATE webhook_events SET status = 'pending', attempts = 0 WHERE status = 'failed'"
+        ).rowcount
+
+    def stats(self):
+        return dict(self._conn().execute('SELECT status, COUNT(*) FROM webhook_events GROUP BY status'))
+
+
+def process_batch(queue, batch_size=DEFAULT_BATCH_SIZE):
+    """Apply one batch of queued events with a single commit and return a ``BatchResult``"""
+    events = queue.claim(batch_size)
+    if not events:
+        return BatchResult(0, 0)
+
+    done, failed, users = [], [], set()
+    for item in events:
+        try:
+            with db.session.begin_nested():
+                order = apply_payment_event(json.loads(item.payload))
+        except Exception as e:
+            failed.append((item.event_id, repr(e)))
+            continue
+        done.append(item.event_id)
+        if order is not None:
+            users.add(order.user_id)
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        # Nothing in the batch was applied: count an attempt against every event
+        for event_id in done:
+            queue.fail(event_id, repr(e))
+        for event_id, error in failed:
+            queue.fail(event_id, error)
+        raise
+
+    for user_id in users:
+        mark_written(orders_version(user_id))
+    queue.complete(done)
+    for event_id, error in failed:
+        queue.fail(event_id, error)
+    return BatchResult(len(done), len(failed))
+
+
+def run_worker(queue, batch_size=DEFAULT_BATCH_SIZE, poll_interval=DEFAULT_POLL_INTERVAL, once=False):
+    """Drain ``queue`` forever, or until it is empty when ``once`` is set
+
+    A batch that fails as a whole is logged and retried after a backoff
+    that doubles up to ``MAX_BACKOFF`` seconds; the worker keeps running.
+    """
+    queue.requeue_stale()
+    backoff = poll_interval
+    while True:
+        try:
+            result = process_batch(queue, batch_size)
+        except Exception:
+            logger.exception('Webhook batch failed, retrying in %.2fs', backoff)
+            db.session.remove()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+            try:
+                # This is the only worker, so anything still claimed was ours
+                queue.requeue_stale()
+            except sqlite3.Error:
+                logger.exception('Could not requeue claimed webhook events')
+            continue
+        db.session.remove()
+        backoff = poll_interval
+        if result.processed + result.failed == 0:
+            if once:
+                return
+            time.sleep(poll_interval)
+
+
+def get_webhook_queue():
+    """Return the webhook queue for the current app, creating it on first use"""
+    app = current_app._get_current_object()
+    queue = _queues.get(app)
+    if queue is None:
+        with _lock:
+            queue = _queues.get(app)
+            if queue is None:
+                path = app.config.get('WEBHOOK_QUEUE_PATH') or os.path.join(app.instance_path, 'webhook_queue.db')
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                queue = _queues[app] = WebhookQueue(path)
+    return queue